@@ -0,0 +1 @@
+"""Benchmarks of rainbow, run with asv (see asv.conf.json) or as scripts"""
@@ -0,0 +1,61 @@
+"""asv benchmarks of live spectrum latency while hovering over a spectral image
+
+Runs headless: the inspector plot is drawn on the Agg backend with the same
+setup as InspectionWidget, see inspector_redraw.py.
+"""
+import numpy as np
+
+from rainbow import _fetch, _utils
+
+from .inspector_redraw import make_plot
+from .synthetic import synthetic_cube
+
+# cursor positions cycled through, one per mouse event
+NPOINTS = 1000
+
+
+class LiveSpectrum():
+    """Reading, normalizing and blitting the spectrum under the cursor"""
+    params = (['numpy', 'zarr'], [22, 64])
+    param_names = ['array', 'channels']
+
+    def setup(self, array, nchannels):
+        data = synthetic_cube(1024, nchannels, 4, 'uint16', planes=2)[1]
+        if array == 'zarr':
+            try:
+                import zarr
+            except ImportError:
+                raise NotImplementedError('zarr is not installed')
+            data = zarr.array(data, chunks=(nchannels, 1, 256, 256))
+        self.fetcher = _fetch.SpectrumFetcher(data, 0, [2, 3])
+
+        # a random walk of the cursor, so nearby events often hit the same block
+        rng = np.random.default_rng(0)
+        steps = rng.integers(-8, 9, (NPOINTS, 2))
+        yx = np.clip(512 + np.cumsum(steps, axis=0), 0, 1023)
+        self.points = np.column_stack([np.zeros(NPOINTS), np.ones(NPOINTS), yx])
+        self.event = 0
+
+        self.canvas, self.axes, self.line = make_plot(nchannels, animated=True)
+        self.canvas.draw()
+        self.background = self.canvas.copy_from_bbox(self.axes.bbox)
+        self.channels = range(nchannels)
+
+    def _next_point(self):
+        self.event = (self.event + 1) % NPOINTS
+        return self.points[self.event]
+
+    def time_fetch(self, array, nchannels):
+        self.fetcher.fetch(self._next_point())
+
+    def time_fetch_cold(self, array, nchannels):
+        self.fetcher.cache.clear()
+        self.fetcher.fetch(self._next_point())
+
+    def time_mouse_moved(self, array, nchannels):
+        # what _update_live_spectrum and _plot_spectrum do for one event
+        spectrum = _utils.safe_normalize_max(self.fetcher.fetch(self._next_point()))
+        self.line.set_data(self.channels, spectrum)
+        self.canvas.restore_region(self.background)
+        self.axes.draw_artist(self.line)
+        self.canvas.blit(self.axes.bbox)
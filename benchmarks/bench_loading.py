@@ -0,0 +1,69 @@
+"""asv benchmarks of loading endmembers and opening spectral images"""
+import importlib.util
+import shutil
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+from rainbow import _reader, _spectrum, _writer
+
+from .synthetic import ENDMEMBERS, synthetic_cube
+
+
+class ImportEndmembers():
+    """Parsing and resampling an endmember file, as the import button does"""
+
+    def setup(self):
+        self.grid = np.linspace(400, 700, 32)
+
+    def time_read_endmembers(self):
+        _spectrum._table_cache.clear()
+        _spectrum.read_endmembers(ENDMEMBERS)
+
+    def time_endmember_matrix(self):
+        _spectrum._table_cache.clear()
+        _spectrum._matrix_cache.clear()
+        _spectrum.endmember_matrix(ENDMEMBERS, self.grid)
+
+    def time_endmember_matrix_cached(self):
+        _spectrum.endmember_matrix(ENDMEMBERS, self.grid)
+
+
+class OpenImage():
+    """Opening a spectral image with the reader and reading one plane from it"""
+    params = (['tiff', 'ome-tiff', 'ome-zarr'],)
+    param_names = ['format']
+
+    def setup(self, fmt):
+        if importlib.util.find_spec('tifffile') is None or importlib.util.find_spec('zarr') is None:
+            raise NotImplementedError('tifffile and zarr are not installed')
+        import tifffile
+
+        B = synthetic_cube(512, 32, 4, 'uint16', planes=4)[1]
+        wavelengths = np.linspace(410, 720, B.shape[0])
+        self.directory = tempfile.mkdtemp()
+        if fmt == 'ome-zarr':
+            self.path = str(Path(self.directory) / 'cube.zarr')
+            out = _writer.create_zarr(self.path, B.shape, (B.shape[0], 1, 256, 256), 0,
+                                      ['%g nm' % w for w in wavelengths], dtype=B.dtype,
+                                      axes='czyx')
+            out[...] = B
+        else:
+            self.path = str(Path(self.directory) / 'cube.tif')
+            metadata = {'axes': 'CZYX'}
+            if fmt == 'ome-tiff':
+                metadata['Channel'] = {'EmissionWavelength': list(wavelengths)}
+            tifffile.imwrite(self.path, B, ome=fmt == 'ome-tiff', metadata=metadata,
+                             tile=(256, 256) if fmt == 'ome-tiff' else None,
+                             compression='zlib' if fmt == 'ome-tiff' else None)
+
+    def teardown(self, fmt):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def time_open(self, fmt):
+        _reader.napari_get_reader(self.path)(self.path)
+
+    def time_read_plane(self, fmt):
+        data = _reader.napari_get_reader(self.path)(self.path)[0][0]
+        np.asarray(data[:, 2])
@@ -0,0 +1,95 @@
+"""asv benchmarks of tiled unmixing throughput and memory on synthetic cubes"""
+import time
+
+from rainbow import _pipeline, _solvers
+
+from .synthetic import synthetic_cube, synthetic_tissue
+
+
+class Unmix():
+    """NNLS unmixing, as run by the unmix button, across cube shapes and dtypes"""
+    params = ([256, 512], [22, 64], [4, 10], ['uint16', 'float32'])
+    param_names = ['size', 'channels', 'endmembers', 'dtype']
+    timeout = 600
+
+    def setup(self, size, nchannels, nendmembers, dtype):
+        self.A, self.B = synthetic_cube(size, nchannels, nendmembers, dtype)
+        self.solver = _solvers.NNLSSolver(self.A)
+
+    def time_unmix(self, size, nchannels, nendmembers, dtype):
+        _pipeline.unmix(self.B, self.A, solver=self.solver)
+
+    def peakmem_unmix(self, size, nchannels, nendmembers, dtype):
+        _pipeline.unmix(self.B, self.A, solver=self.solver)
+
+    def track_pixels_per_second(self, size, nchannels, nendmembers, dtype):
+        start = time.perf_counter()
+        _pipeline.unmix(self.B, self.A, solver=self.solver)
+        return self.B[0].size / (time.perf_counter() - start)
+    track_pixels_per_second.unit = 'pixels/s'
+
+
+class Solvers():
+    """Every solver on the same cube, including setup of the solver itself"""
+    params = (list(_solvers.SOLVERS), [False, True])
+    param_names = ['solver', 'deduplicate']
+    timeout = 600
+
+    def setup(self, mode, dedup):
+        self.A, self.B = synthetic_cube(512, 22, 6, 'uint16')
+
+    def _unmix(self, mode, dedup):
+        solver = _solvers.make_solver(mode, self.A)
+        if dedup:
+            solver = _solvers.DedupSolver(solver)
+        _pipeline.unmix(self.B, self.A, solver=solver)
+
+    def time_unmix(self, mode, dedup):
+        self._unmix(mode, dedup)
+
+    def peakmem_unmix(self, mode, dedup):
+        self._unmix(mode, dedup)
+
+
+class WarmStart():
+    """Cold and warm-started NNLS on tissue-like cubes with many overlapping endmembers"""
+    params = ([10, 15, 20], ['nnls', 'warm-started nnls'])
+    param_names = ['endmembers', 'solver']
+    timeout = 600
+
+    def setup(self, nendmembers, mode):
+        self.A, self.B = synthetic_tissue(256, 64, nendmembers)
+
+    def time_unmix(self, nendmembers, mode):
+        _pipeline.unmix(self.B, self.A, solver=_solvers.SOLVERS[mode](self.A))
+
+    def track_pixels_per_second(self, nendmembers, mode):
+        solver = _solvers.SOLVERS[mode](self.A)
+        start = time.perf_counter()
+        _pipeline.unmix(self.B, self.A, solver=solver)
+        return self.B[0].size / (time.perf_counter() - start)
+    track_pixels_per_second.unit = 'pixels/s'
+
+    def track_iterations_per_pixel(self, nendmembers, mode):
+        # passive systems solved per pixel, the unit of work of active set NNLS
+        solver = _solvers.SOLVERS[mode](self.A)
+        _pipeline.unmix(self.B, self.A, solver=solver)
+        return solver.solves / self.B[0].size
+    track_iterations_per_pixel.unit = 'solves/pixel'
+
+
+class Lazy():
+    """Unmixing a single displayed plane of a lazy cube, as when moving a slider"""
+    params = ([512, 1024],)
+    param_names = ['size']
+
+    def setup(self, size):
+        from rainbow import _lazy
+        self.A, self.B = synthetic_cube(size, 22, 4, 'uint16', planes=4)
+        solver = _solvers.NNLSSolver(self.A)
+        self.unmixer = _lazy.LazyUnmixer(self.B, solver, 0, [2, 3])
+
+    def time_plane(self, size):
+        # a slider move to a plane that is not cached yet
+        self.unmixer.cache.clear()
+        self.unmixer.plane([1])
@@ -0,0 +1,69 @@
+"""Checks that the numerical core imports quickly and without GUI libraries
+
+Usage:
+    python benchmarks/import_time.py [--module rainbow.core] [--budget 0.5] [--repeat 5]
+
+Imports the module in fresh interpreters with `python -X importtime`, prints
+the slowest imports of the best run and exits with an error if the import
+takes longer than the budget in seconds or loads any of the GUI or optional
+packages. tests/test_import.py enforces the same limits for rainbow.core,
+use this script to find out which import broke them.
+"""
+import argparse
+import subprocess
+import sys
+
+# packages that must not be imported by the numerical core
+FORBIDDEN = ('napari', 'qtpy', 'PyQt5', 'PyQt6', 'PySide2', 'PySide6', 'matplotlib',
+             'scipy', 'dask', 'zarr', 'tifffile', 'vispy', 'magicgui')
+
+# seconds allowed for the import, enforced by tests/test_import.py
+BUDGET = 0.5
+
+
+def import_times(module):
+    """Imports module in a new interpreter, returning {name: (self, cumulative)} in seconds"""
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import %s' % module],
+        stderr=subprocess.PIPE, universal_newlines=True, check=True
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        times[name.strip()] = (int(self_us) / 1e6, int(cumulative_us) / 1e6)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--module', default='rainbow.core')
+    parser.add_argument('--budget', type=float, default=BUDGET)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--top', type=int, default=10)
+    args = parser.parse_args()
+
+    # the fastest run is the least disturbed by disk caches and other processes
+    runs = [import_times(args.module) for _ in range(args.repeat)]
+    times = min(runs, key=lambda t: t[args.module][1])
+    total = times[args.module][1]
+
+    print('%10s %12s  %s' % ('self (ms)', 'cumul. (ms)', 'module'))
+    for name, (self_s, cumulative) in sorted(times.items(), key=lambda t: -t[1][0])[:args.top]:
+        print('%10.1f %12.1f  %s' % (1e3 * self_s, 1e3 * cumulative, name))
+    print('import %s: %.3f s (budget %.3f s)' % (args.module, total, args.budget))
+
+    failed = False
+    forbidden = sorted(n for n in times if n.split('.')[0] in FORBIDDEN)
+    if forbidden:
+        print('imports forbidden packages: %s' % ', '.join(forbidden))
+        failed = True
+    if total > args.budget:
+        print('exceeds the import time budget')
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""Measures live spectrum redraw latency of the inspector plot, before and after blitting
+
+Usage:
+    python benchmarks/inspector_redraw.py [--channels 42] [--repeats 200]
+
+Runs headless on the Agg backend with the same figure setup as
+InspectionWidget. 'full draw' is the previous behavior (canvas.draw() per
+mouse event), 'blit' restores the cached background and redraws only the
+live Line2D.
+"""
+import argparse
+import time
+
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+
+def make_plot(nchannels, animated):
+    canvas = FigureCanvasAgg(Figure(figsize=(5, 3), facecolor='none', edgecolor='none'))
+    axes = canvas.figure.subplots()
+    (line,) = axes.plot(range(nchannels), np.full(nchannels, np.nan), animated=animated)
+    axes.set_xbound(-0.05 - nchannels * 0.05, nchannels * 1.05)
+    axes.set_ybound(-0.05, 1.05)
+    axes.patch.set_color('none')
+    axes.spines['right'].set_color('none')
+    axes.spines['top'].set_color('none')
+    axes.tick_params(axis='both', bottom=False)
+    return canvas, axes, line
+
+
+def full_draw(nchannels, spectra):
+    canvas, axes, line = make_plot(nchannels, animated=False)
+    canvas.draw()
+    latency = []
+    for spectrum in spectra:
+        start = time.perf_counter()
+        line.set_data(range(nchannels), spectrum)
+        canvas.draw()
+        latency.append(time.perf_counter() - start)
+    return np.array(latency)
+
+
+def blit(nchannels, spectra):
+    canvas, axes, line = make_plot(nchannels, animated=True)
+    canvas.draw()
+    background = canvas.copy_from_bbox(axes.bbox)
+    latency = []
+    for spectrum in spectra:
+        start = time.perf_counter()
+        line.set_data(range(nchannels), spectrum)
+        canvas.restore_region(background)
+        axes.draw_artist(line)
+        canvas.blit(axes.bbox)
+        latency.append(time.perf_counter() - start)
+    return np.array(latency)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--channels', type=int, default=42)
+    parser.add_argument('--repeats', type=int, default=200)
+    args = parser.parse_args()
+
+    spectra = np.random.default_rng(0).random((args.repeats, args.channels))
+    print('%10s %10s %10s %10s' % ('method', 'mean (ms)', 'p50 (ms)', 'p95 (ms)'))
+    for name, method in [('full draw', full_draw), ('blit', blit)]:
+        latency = 1000 * method(args.channels, spectra)
+        print('%10s %10.2f %10.2f %10.2f'
+              % (name, latency.mean(), np.median(latency), np.percentile(latency, 95)))
+
+
+if __name__ == '__main__':
+    main()
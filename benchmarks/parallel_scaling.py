@@ -0,0 +1,49 @@
+"""Measures the speedup of parallel unmixing across worker counts
+
+Usage:
+    python -m benchmarks.parallel_scaling [--size 1024] [--planes 4] [--executor thread]
+
+Unmixes a synthetic cube from the asv suite with 1, 2, 4, 8 and 16 workers
+and prints wall time and speedup relative to one worker.
+"""
+import argparse
+import os
+import time
+
+from rainbow import _pipeline, _solvers
+
+from .synthetic import synthetic_cube
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, default=1024)
+    parser.add_argument('--planes', type=int, default=4)
+    parser.add_argument('--channels', type=int, default=22)
+    parser.add_argument('--endmembers', type=int, default=10)
+    parser.add_argument('--tile', type=int, default=256)
+    parser.add_argument('--executor', choices=['thread', 'process'], default='thread')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8, 16])
+    args = parser.parse_args()
+
+    A, B = synthetic_cube(args.size, args.channels, args.endmembers, planes=args.planes)
+    solver = _solvers.NNLSSolver(A)
+    tile_shape = (B.shape[0], 1, args.tile, args.tile)
+    npixels = B.size // B.shape[0]
+    print('cube %s %s, %d endmembers, %d cores available'
+          % (B.shape, B.dtype, A.shape[1], os.cpu_count()))
+    print('%8s %10s %12s %8s' % ('workers', 'time (s)', 'pixels/s', 'speedup'))
+
+    baseline = None
+    for workers in args.workers:
+        start = time.perf_counter()
+        _pipeline.unmix(B, A, solver=solver, tile_shape=tile_shape,
+                        workers=workers, executor=args.executor)
+        elapsed = time.perf_counter() - start
+        baseline = baseline or elapsed
+        print('%8d %10.2f %12.0f %8.2f'
+              % (workers, elapsed, npixels / elapsed, baseline / elapsed))
+
+
+if __name__ == '__main__':
+    main()
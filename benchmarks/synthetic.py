@@ -0,0 +1,87 @@
+"""Reproducible synthetic spectral cubes mixed from the sample endmembers
+
+The spectra in sample-data/endmembers.csv are resampled to any number of
+channels and mixed with sparse random abundances plus noise. Tissue-like
+cubes instead mix many overlapping emission peaks in regions that share
+their labels. A given size, channel count, endmember count, dtype and seed
+always gives the same cube.
+"""
+from pathlib import Path
+
+import numpy as np
+
+from rainbow import _spectrum
+
+ENDMEMBERS = Path(__file__).parents[1] / 'sample-data' / 'endmembers.csv'
+
+# pixels generated at a time, bounding the memory used beyond the cube itself
+GENERATE_BLOCK = 2**16
+
+
+def sample_endmembers(nchannels, nendmembers):
+    """Returns the first nendmembers sample endmembers resampled to nchannels channels"""
+    names, wavelengths, data = _spectrum.read_spectra(ENDMEMBERS)
+    if nendmembers > data.shape[1]:
+        raise ValueError('the sample data has %i endmembers' % data.shape[1])
+    grid = np.linspace(wavelengths[0], wavelengths[-1], nchannels)
+    A = _spectrum.interp_spectra(wavelengths, _spectrum.normalize_columns(data[:, :nendmembers]), grid)
+    return names[:nendmembers], np.ascontiguousarray(A)
+
+
+def synthetic_cube(size, nchannels, nendmembers, dtype='uint16', planes=1, seed=0):
+    """Returns the endmember matrix and a (channels, planes, size, size) cube mixed from it
+
+    About 30% of the abundances are nonzero, scaled to a peak of about 1000
+    counts, with Gaussian noise of 10 counts, clipped at zero.
+    """
+    rng = np.random.default_rng(seed)
+    A = sample_endmembers(nchannels, nendmembers)[1]
+    npixels = planes * size * size
+    B = np.empty((nchannels, npixels), dtype=dtype)
+    for start in range(0, npixels, GENERATE_BLOCK):
+        n = min(GENERATE_BLOCK, npixels - start)
+        X = rng.random((nendmembers, n))
+        X *= rng.random(X.shape) < 0.3
+        mixed = A @ (1000 * X) + rng.normal(0, 10, (nchannels, n))
+        B[:, start:start + n] = np.clip(mixed, 0, None)
+    return A, B.reshape(nchannels, planes, size, size)
+
+
+def peak_endmembers(nchannels, nendmembers, width=0.06):
+    """Returns nendmembers overlapping Gaussian emission peaks spread evenly over nchannels channels
+
+    width is the standard deviation of each peak relative to the spectral range.
+    """
+    channels = np.linspace(0, 1, nchannels)[:, None]
+    centers = np.linspace(0.05, 0.95, nendmembers)[None, :]
+    A = np.exp(-0.5 * ((channels - centers) / width)**2)
+    return np.ascontiguousarray(A / A.max(axis=0))
+
+
+def synthetic_tissue(size, nchannels, nendmembers, dtype='uint16', regions=48, labels=3, seed=0):
+    """Returns peak endmembers and a (channels, 1, size, size) cube of spatially coherent regions
+
+    The image is split into Voronoi regions around random points, each
+    holding a random set of labels endmembers with fixed proportions, under
+    a smooth intensity field peaking at about 1000 counts. Gaussian noise of
+    10 counts is added and the result clipped at zero. Neighboring pixels
+    thus mostly share their nonzero endmembers, as in stained tissue.
+    """
+    rng = np.random.default_rng(seed)
+    A = peak_endmembers(nchannels, nendmembers)
+    points = rng.random((regions, 2)) * size
+    W = np.zeros((regions, nendmembers))
+    for region in W:
+        region[rng.choice(nendmembers, labels, replace=False)] = 0.2 + 0.8 * rng.random(labels)
+
+    npixels = size * size
+    B = np.empty((nchannels, npixels), dtype=dtype)
+    for start in range(0, npixels, GENERATE_BLOCK):
+        n = min(GENERATE_BLOCK, npixels - start)
+        y, x = np.divmod(np.arange(start, start + n), size)
+        nearest = np.argmin((y[:, None] - points[:, 0])**2 + (x[:, None] - points[:, 1])**2, axis=1)
+        field = 0.6 + 0.4 * np.sin(y / (0.15 * size)) * np.cos(x / (0.2 * size))
+        X = (1000 * field) * W[nearest].T
+        mixed = A @ X + rng.normal(0, 10, (nchannels, n))
+        B[:, start:start + n] = np.clip(mixed, 0, None)
+    return A, B.reshape(nchannels, 1, size, size)
@@ -1,9 +1,20 @@
 __version__ = "0.0.1"
 
-from ._inspect import InspectionWidget
-from ._unmixing import UnmixingWidget
-
 __all__ = (
     "InspectionWidget",
     "UnmixingWidget",
 )
+
+# widgets pull in napari, Qt and matplotlib, so they are imported on first
+# access and `import rainbow.core` stays headless
+_WIDGETS = {
+    "InspectionWidget": "._inspect",
+    "UnmixingWidget": "._unmixing",
+}
+
+
+def __getattr__(name):
+    if name in _WIDGETS:
+        from importlib import import_module
+        return getattr(import_module(_WIDGETS[name], __name__), name)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
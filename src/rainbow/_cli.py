@@ -0,0 +1,293 @@
+"""Unmixes batches of spectral images from the command line
+
+Usage:
+    rainbow-unmix IMAGE_OR_GLOB [...] --endmembers endmembers.csv --output-dir abundances/
+
+Images are opened with the rainbow reader (TIFF/OME-TIFF, OME-Zarr) and
+processed in parallel, one file per job. Abundances are written as OME-Zarr
+stores (or .npy memmaps) next to a checkpoint that records finished tiles,
+so rerunning an interrupted command only unmixes what is missing.
+"""
+import argparse
+import glob
+import hashlib
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+
+from . import _pipeline, _reader, _solvers, _spectrum, _writer
+
+# abundance file formats by extension
+FORMATS = {'zarr': '.zarr', 'npy': '.npy'}
+
+# minimum time in seconds between checkpoint writes, which are also written when a file is done
+CHECKPOINT_INTERVAL = 5.0
+
+
+def find_images(patterns, manifest=None):
+    """Expands paths and glob patterns, plus the lines of a manifest file, into image paths
+
+    Manifest lines hold one path or pattern each; empty lines and lines
+    starting with # are skipped. Paths are returned once, in order.
+    """
+    patterns = list(patterns)
+    if manifest is not None:
+        with open(manifest) as f:
+            lines = [line.strip() for line in f]
+        patterns += [line for line in lines if line and not line.startswith('#')]
+
+    paths = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern, recursive=True)) if glob.has_magic(pattern) else [pattern]
+        paths += [os.path.normpath(p) for p in matches]
+    return list(dict.fromkeys(paths))
+
+
+def output_paths(paths, output_dir, fmt='zarr'):
+    """Maps images to abundance files, keeping their folders relative to a common root"""
+    if not paths:
+        return {}
+    root = os.path.commonpath([os.path.dirname(os.path.abspath(p)) for p in paths])
+    outputs = {}
+    for path in paths:
+        stripped = path.rstrip('/\\')
+        folder = os.path.relpath(os.path.dirname(os.path.abspath(stripped)), root)
+        name = os.path.basename(stripped).split('.')[0]
+        outputs[path] = os.path.normpath(os.path.join(output_dir, folder, name + FORMATS[fmt]))
+
+    duplicates = len(outputs) - len(set(outputs.values()))
+    if duplicates:
+        raise ValueError('%i images would be written to the same abundance file, '
+                         'rename them or run them separately' % duplicates)
+    return outputs
+
+
+def open_image(path, channel_axis=None):
+    """Opens an image lazily with the rainbow reader, returning its data and rainbow metadata"""
+    reader = _reader.napari_get_reader(path)
+    if reader is None:
+        raise ValueError('%s is not a TIFF or OME-Zarr image' % path)
+    data, kwargs, _ = reader(path)[0]
+    data = data[0] if kwargs['multiscale'] else data
+    metadata = kwargs['metadata']['rainbow']
+
+    # an explicit channel axis replaces the one from the file, with channel units
+    current = metadata['axes']['c']['index'] if 'axes' in metadata else None
+    if channel_axis is not None and channel_axis % data.ndim != current:
+        metadata['axes'] = {'c': {'index': channel_axis % data.ndim,
+                                  'extent': data.shape[channel_axis]}}
+        metadata['wavelengths'] = list(range(data.shape[channel_axis]))
+        metadata['units'] = 'ch'
+    elif current is None:
+        raise ValueError('could not find the spectral axis of %s, set it with --channel-axis' % path)
+    return data, metadata
+
+
+def endmember_matrix(endmembers, metadata):
+    """Returns endmember names and the matrix sampled on an image's channels, as the widget does"""
+    grid = None if metadata.get('units', 'ch') == 'ch' else metadata['wavelengths']
+    names, A = _spectrum.endmember_matrix(endmembers, grid)
+    nchannels = metadata['axes']['c']['extent']
+    if A.shape[0] != nchannels:
+        raise ValueError(
+            'endmembers have %i wavelengths but the image has %i channels'
+            % (A.shape[0], nchannels)
+        )
+    return names, A
+
+
+def unmix_file(path, endmembers, output, mode='nnls', dedup=False, dtype='float32',
+               tile_size=_pipeline.DEFAULT_TILE_SIZE, workers=1, channel_axis=None, resume=True):
+    """Unmixes one image into an abundance file, resuming from its checkpoint
+
+    The checkpoint (output + '.checkpoint.json') lists the tiles already
+    written and the settings they were written with. Finished tiles are
+    skipped unless the settings changed, in which case the file is
+    rewritten. Returns the number of tiles unmixed by this call.
+    """
+    data, metadata = open_image(path, channel_axis)
+    cidx = metadata['axes']['c']['index']
+    names, A = endmember_matrix(endmembers, metadata)
+    solver = _solvers.make_solver(mode, A)
+    if dedup:
+        solver = _solvers.DedupSolver(solver)
+
+    tile_shape = _pipeline.default_tile_shape(data, cidx, tile_size)
+    tiles = list(_pipeline.iter_tiles(data.shape, tile_shape, cidx))
+    numbers = {_tile_key(index): i for i, index in enumerate(tiles)}
+    settings = {
+        'input': os.path.abspath(path),
+        'shape': list(data.shape),
+        'channel_axis': cidx,
+        'tile_shape': list(tile_shape),
+        'endmembers': hashlib.sha1(np.ascontiguousarray(A, dtype=np.float64).tobytes()).hexdigest(),
+        'solver': mode,
+        'dedup': dedup,
+        'dtype': np.dtype(dtype).name
+    }
+
+    checkpoint_path = output + '.checkpoint.json'
+    checkpoint = _read_checkpoint(checkpoint_path) if resume else None
+    if checkpoint is not None and checkpoint['settings'] == settings and os.path.exists(output):
+        done = set(checkpoint['done'])
+        out = _open_output(output)
+    else:
+        done = set()
+        out = _create_output(output, data, tile_shape, cidx, names, A, metadata, dtype)
+    pending = [index for i, index in enumerate(tiles) if i not in done]
+    if not pending:
+        return 0
+
+    unmixed = 0
+    saved = time.monotonic()
+    try:
+        for index in _pipeline.iter_unmix(data, solver, out, cidx, pending, workers=workers):
+            done.add(numbers[_tile_key(index)])
+            unmixed += 1
+            if time.monotonic() - saved > CHECKPOINT_INTERVAL:
+                _write_checkpoint(checkpoint_path, out, settings, done, len(tiles))
+                saved = time.monotonic()
+    finally:
+        # keep finished tiles when interrupted
+        _write_checkpoint(checkpoint_path, out, settings, done, len(tiles))
+    return unmixed
+
+
+def _tile_key(index):
+    return tuple((s.start, s.stop) for s in index)
+
+
+def _create_output(output, data, tile_shape, channel_axis, names, A, metadata, dtype):
+    """Creates an empty abundance file with one chunk per tile"""
+    parent = os.path.dirname(output)
+    if parent:
+        os.makedirs(parent, exist_ok=True)
+    shape = _pipeline.output_shape(data.shape, channel_axis, A.shape[1])
+    if output.endswith(FORMATS['zarr']):
+        chunks = _pipeline.output_shape(
+            [min(t, n) for t, n in zip(tile_shape, data.shape)], channel_axis, A.shape[1]
+        )
+        return _writer.create_zarr(output, shape, chunks, channel_axis, names,
+                                   metadata['wavelengths'], A, dtype, _axes(metadata, len(shape)))
+    return _writer.create_memmap(output, shape, names, metadata['wavelengths'], A, dtype)
+
+
+def _open_output(output):
+    """Opens an abundance file written by an earlier run for writing"""
+    if output.endswith(FORMATS['zarr']):
+        import zarr
+        return zarr.open_group(output, mode='r+')['0']
+    return np.load(output, mmap_mode='r+')
+
+
+def _axes(metadata, ndim):
+    """Returns OME axis letters from the file's axes and spectral axis, or None if they are ambiguous"""
+    letters = list(metadata.get('file_axes', '').lower())
+    if len(letters) != ndim:
+        return None
+    letters[metadata['axes']['c']['index']] = 'c'
+    if not set(letters) <= set('tczyx') or len(set(letters)) != ndim:
+        return None
+    return ''.join(letters)
+
+
+def _read_checkpoint(path):
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except ValueError:
+        # written only partly, start over
+        return None
+
+
+def _write_checkpoint(path, out, settings, done, ntiles):
+    """Records finished tiles once they are on disk, replacing the checkpoint atomically"""
+    if isinstance(out, np.memmap):
+        out.flush()
+    checkpoint = {
+        'settings': settings,
+        'done': sorted(done),
+        'tiles': ntiles,
+        'complete': len(done) == ntiles
+    }
+    with open(path + '.tmp', 'w') as f:
+        json.dump(checkpoint, f)
+    os.replace(path + '.tmp', path)
+
+
+def _unmix_job(path, output, options):
+    """Unmixes one file in a pool process, returning its path, tile count, time and error"""
+    start = time.perf_counter()
+    try:
+        unmixed = unmix_file(path, output=output, **options)
+        return path, unmixed, time.perf_counter() - start, None
+    except Exception as e:
+        return path, 0, time.perf_counter() - start, '%s: %s' % (type(e).__name__, e)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='rainbow-unmix',
+        description=__doc__.splitlines()[0],
+        epilog='Interrupted runs resume from their checkpoints when run again with the same '
+               'settings. With many jobs, consider OMP_NUM_THREADS=1 to avoid oversubscribing cores.'
+    )
+    parser.add_argument('images', nargs='*', help='image paths or glob patterns (quote them)')
+    parser.add_argument('-m', '--manifest', help='text file with one image path or pattern per line')
+    parser.add_argument('-e', '--endmembers', required=True, help='endmember CSV or .ref file')
+    parser.add_argument('-o', '--output-dir', required=True, help='folder for abundance files')
+    parser.add_argument('--format', choices=list(FORMATS), default='zarr')
+    parser.add_argument('--dtype', choices=_writer.OUTPUT_DTYPES, default='float32',
+                        help='float16 holds values up to 65504, best with fully constrained fractions')
+    parser.add_argument('--solver', choices=list(_solvers.SOLVERS), default='nnls')
+    parser.add_argument('--dedup', action='store_true', help='solve each distinct spectrum once')
+    parser.add_argument('--channel-axis', type=int, help='spectral axis, read from the file by default')
+    parser.add_argument('--tile-size', type=int, default=_pipeline.DEFAULT_TILE_SIZE)
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+                        help='files unmixed in parallel')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='tile threads per file')
+    parser.add_argument('--restart', action='store_true', help='ignore checkpoints and start over')
+    args = parser.parse_args(argv)
+
+    paths = find_images(args.images, args.manifest)
+    if not paths:
+        parser.error('no images found')
+    outputs = output_paths(paths, args.output_dir, args.format)
+    options = {
+        'endmembers': args.endmembers,
+        'mode': args.solver,
+        'dedup': args.dedup,
+        'dtype': args.dtype,
+        'tile_size': args.tile_size,
+        'workers': args.workers,
+        'channel_axis': args.channel_axis,
+        'resume': not args.restart
+    }
+
+    failed = 0
+    jobs = max(1, min(args.jobs, len(paths)))
+    with ProcessPoolExecutor(jobs) as pool:
+        futures = [pool.submit(_unmix_job, path, outputs[path], options) for path in paths]
+        for i, future in enumerate(as_completed(futures)):
+            path, unmixed, seconds, error = future.result()
+            if error is not None:
+                failed += 1
+                status = 'failed, %s' % error
+            elif unmixed:
+                status = '%i tiles in %.1f s' % (unmixed, seconds)
+            else:
+                status = 'already done'
+            print('[%i/%i] %s: %s' % (i + 1, len(paths), path, status), flush=True)
+
+    if failed:
+        print('%i of %i images failed' % (failed, len(paths)), file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
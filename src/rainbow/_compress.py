@@ -0,0 +1,141 @@
+import numpy as np
+
+from ._extract import DEFAULT_SAMPLE_SIZE, sample_pixels
+from ._lazy import _normalize_key
+from ._pipeline import allocate_output, default_tile_shape, iter_tiles, output_shape
+
+# largest relative RMS reconstruction error accepted when the rank is chosen automatically
+DEFAULT_MAX_ERROR = 0.03
+
+
+def spectral_basis(B):
+    """Returns the orthonormal channel basis of (channels, pixels) spectra B and rank errors
+
+    The basis holds the eigenvectors of B B^T (the left singular vectors of
+    B) by decreasing energy. errors[k - 1] is the relative RMS error of
+    reconstructing B from its first k basis vectors.
+    """
+    B = np.asarray(B, dtype=np.float64)
+    energy, V = np.linalg.eigh(B @ B.T)
+    energy, V = np.clip(energy[::-1], 0, None), V[:, ::-1]
+
+    # fix the sign of every vector so the same data always gives the same basis
+    V = V * np.where(V[np.argmax(np.abs(V), axis=0), np.arange(V.shape[1])] < 0, -1, 1)
+
+    total = energy.sum()
+    tail = np.clip(total - np.cumsum(energy), 0, None)
+    errors = np.sqrt(tail / total) if total > 0 else np.zeros(len(energy))
+    return V, errors
+
+
+def choose_rank(errors, max_error=DEFAULT_MAX_ERROR):
+    """Returns the smallest rank whose error is at most max_error"""
+    below = np.flatnonzero(np.asarray(errors) <= max_error)
+    return int(below[0]) + 1 if below.size else len(errors)
+
+
+class CompressedCube():
+    """Spectral image stored as a channel basis and low-rank per-pixel coefficients
+
+    coefficients has the shape of the image with the channel axis holding
+    rank coefficients, so B = basis @ C along that axis. The cube behaves
+    like a read-only array of the image: indexing reconstructs only the
+    requested pixels, so layers and the inspector can use it directly,
+    while unmixing solves on the coefficients (see _solvers.ReducedSolver).
+    """
+
+    def __init__(self, basis, coefficients, channel_axis=0, errors=None, error=None):
+        self.basis = np.asarray(basis, dtype=np.float64)
+        self.coefficients = coefficients
+        self.channel_axis = channel_axis % len(coefficients.shape)
+        self.rank = self.basis.shape[1]
+        self.errors = errors
+        self.error = error
+
+        shape = list(coefficients.shape)
+        shape[self.channel_axis] = self.basis.shape[0]
+        self.shape = tuple(shape)
+        self.ndim = len(shape)
+        self.dtype = np.dtype(coefficients.dtype)
+        self.size = int(np.prod(shape))
+        self._basis = self.basis.astype(self.dtype)
+
+
+    @property
+    def nbytes(self):
+        """Bytes of the coefficients, the basis is negligible"""
+        return int(np.prod(self.coefficients.shape)) * self.dtype.itemsize
+
+
+    def __len__(self):
+        return self.shape[0]
+
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self[...], dtype=dtype)
+
+
+    def __getitem__(self, key):
+        key = list(_normalize_key(key, self.shape))
+        channels = key[self.channel_axis]
+        key[self.channel_axis] = slice(None)
+        C = np.asarray(self.coefficients[tuple(key)])
+
+        # axis of the coefficients in C once integer indices have dropped axes
+        cidx = sum(not isinstance(k, int) for k in key[:self.channel_axis])
+        B = np.tensordot(self._basis[channels], C, axes=([-1], [cidx]))
+        return B if isinstance(channels, int) else np.moveaxis(B, 0, cidx)
+
+
+def iter_compress(data, channel_axis=0, rank=None, max_error=DEFAULT_MAX_ERROR, tile_shape=None,
+                  sample_size=DEFAULT_SAMPLE_SIZE, out=None, seed=0):
+    """Compresses data tile by tile, yielding the number of tiles done and in total
+
+    The basis is estimated from a stratified sample of pixel spectra (see
+    _extract.sample_pixels), then every tile is read once and projected onto
+    it. Without a rank, the smallest rank whose estimated error is at most
+    max_error is used. Coefficients are written into out, float32 by
+    default and on disk for lazy data. The measured error over all pixels
+    is accumulated in the same pass. Returns the CompressedCube.
+    """
+    ndim = len(data.shape)
+    channel_axis = channel_axis % ndim
+    if tile_shape is None:
+        tile_shape = default_tile_shape(data, channel_axis)
+
+    V, errors = spectral_basis(sample_pixels(data, channel_axis, sample_size, seed=seed))
+    if rank is None:
+        rank = choose_rank(errors, max_error)
+    V = V[:, :min(rank, V.shape[1])]
+    if out is None:
+        out = allocate_output(output_shape(data.shape, channel_axis, V.shape[1]), np.float32,
+                              on_disk=not isinstance(data, np.ndarray))
+
+    tiles = list(iter_tiles(data.shape, tile_shape, channel_axis))
+    total = residual = 0.0
+    for i, index in enumerate(tiles):
+        B = np.moveaxis(np.asarray(data[index], dtype=np.float64), channel_axis, 0)
+        spatial_shape = B.shape[1:]
+        B = B.reshape(B.shape[0], -1)
+        C = V.T @ B
+
+        # the basis is orthonormal, so the residual energy is what C misses of B
+        energy = np.einsum('ij,ij->', B, B)
+        total += energy
+        residual += max(energy - np.einsum('ij,ij->', C, C), 0)
+        out[index] = np.moveaxis(C.reshape((-1,) + spatial_shape), 0, channel_axis)
+        yield i + 1, len(tiles)
+
+    error = float(np.sqrt(residual / total)) if total > 0 else 0.0
+    return CompressedCube(V, out, channel_axis, errors, error)
+
+
+def compress(data, channel_axis=0, rank=None, max_error=DEFAULT_MAX_ERROR, tile_shape=None,
+             sample_size=DEFAULT_SAMPLE_SIZE, out=None, seed=0):
+    """Compresses a spectral image into a CompressedCube, see iter_compress"""
+    progress = iter_compress(data, channel_axis, rank, max_error, tile_shape, sample_size, out, seed)
+    while True:
+        try:
+            next(progress)
+        except StopIteration as stop:
+            return stop.value
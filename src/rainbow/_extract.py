@@ -0,0 +1,158 @@
+import numpy as np
+
+from ._pipeline import default_tile_shape, iter_tiles
+from ._spectrum import Spectrum
+
+# number of pixel spectra sampled for endmember extraction
+DEFAULT_SAMPLE_SIZE = 100000
+
+# maximum number of k-means iterations
+KMEANS_ITERATIONS = 100
+
+
+def sample_pixels(data, channel_axis=0, size=DEFAULT_SAMPLE_SIZE, threshold=0,
+                  tile_shape=None, seed=None):
+    """Draws a stratified random sample of pixel spectra in one pass over data
+
+    Every tile contributes a share of the sample proportional to its number
+    of pixels, so the sample covers the whole image evenly, and only one tile
+    is in memory at a time. In-memory arrays are indexed at the sampled
+    pixels directly instead of reading whole tiles. Spectra with a total
+    intensity at or below threshold (background) are dropped.
+
+    Returns a (channels, samples) matrix.
+    """
+    rng = np.random.default_rng(seed)
+    ndim = len(data.shape)
+    channel_axis = channel_axis % ndim
+    nchannels = data.shape[channel_axis]
+    npixels = int(np.prod(data.shape)) // max(nchannels, 1)
+    fraction = min(1.0, size / max(npixels, 1))
+    if tile_shape is None:
+        tile_shape = default_tile_shape(data, channel_axis)
+
+    samples = []
+    for index in iter_tiles(data.shape, tile_shape, channel_axis):
+        extent = [len(range(*s.indices(n))) for s, n in zip(index, data.shape)]
+        extent[channel_axis] = 1
+        ntile = int(np.prod(extent))
+
+        # round the tile's share up or down at random to keep the expected size exact
+        count = rng.binomial(ntile, fraction) if fraction < 1 else ntile
+        if count == 0:
+            continue
+        picked = rng.choice(ntile, count, replace=False)
+        coordinates = list(np.unravel_index(picked, extent))
+
+        if isinstance(data, np.ndarray):
+            key = [c + s.indices(n)[0] for c, s, n in zip(coordinates, index, data.shape)]
+            key[channel_axis] = slice(None)
+            B = data[tuple(key)]
+        else:
+            coordinates[channel_axis] = slice(None)
+            B = np.asarray(data[index])[tuple(coordinates)]
+
+        # the sampled pixels come first unless the channel axis leads
+        B = B.T if channel_axis == 0 else B
+        samples.append(np.asarray(B, dtype=np.float64).reshape(count, nchannels))
+
+    B = np.concatenate(samples + [np.empty((0, nchannels))]).T
+    return B[:, B.sum(axis=0) > threshold]
+
+
+def vca(B, n, seed=None):
+    """Finds n endmembers among the columns of B by vertex component analysis
+
+    Follows Nascimento and Dias (2005): pixels are projected onto the n
+    leading singular vectors and scaled onto a hyperplane, then the extreme
+    pixel along a direction orthogonal to the endmembers found so far is
+    picked, n times. Returns the picked columns of B as a (channels, n) matrix.
+    """
+    rng = np.random.default_rng(seed)
+    U = np.linalg.svd(B @ B.T / B.shape[1])[0][:, :n]
+    Y = U.T @ B
+    u = Y.mean(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        Y = Y / (u @ Y)
+    Y = np.nan_to_num(Y)
+
+    E = np.zeros((n, n))
+    E[-1, 0] = 1
+    picked = []
+    for i in range(n):
+        w = rng.standard_normal(n)
+        f = w - E @ np.linalg.pinv(E) @ w
+        f /= np.linalg.norm(f)
+        picked.append(int(np.argmax(np.abs(f @ Y))))
+        E[:, i] = Y[:, picked[-1]]
+    return B[:, picked]
+
+
+def kmeans(B, n, iterations=KMEANS_ITERATIONS, seed=None):
+    """Clusters the spectral shapes of the columns of B into n mean spectra
+
+    Spectra are sum-normalized so clusters follow shape rather than
+    brightness. Centers start from k-means++ seeding. Returns the cluster
+    means as a (channels, n) matrix.
+    """
+    rng = np.random.default_rng(seed)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        X = np.nan_to_num(B / B.sum(axis=0)).T
+    norms = (X**2).sum(axis=1)
+
+    # k-means++ seeding
+    centers = [X[rng.integers(len(X))]]
+    distance = ((X - centers[0])**2).sum(axis=1)
+    for _ in range(1, n):
+        p = distance / distance.sum() if distance.sum() > 0 else None
+        centers.append(X[rng.choice(len(X), p=p)])
+        distance = np.minimum(distance, ((X - centers[-1])**2).sum(axis=1))
+    C = np.array(centers)
+
+    labels = None
+    for _ in range(iterations):
+        # squared distances to every center as one matrix product
+        nearest = np.argmin(norms[:, np.newaxis] - 2 * X @ C.T + (C**2).sum(axis=1), axis=1)
+        if labels is not None and np.array_equal(nearest, labels):
+            break
+        labels = nearest
+        counts = np.bincount(labels, minlength=n)
+        sums = np.stack([np.bincount(labels, weights=x, minlength=n) for x in X.T], axis=1)
+        C = np.where(counts[:, np.newaxis] > 0, sums / np.maximum(counts, 1)[:, np.newaxis], C)
+    return C.T
+
+
+# extraction methods by name, each mapping (B, n, seed) to a (channels, n) matrix
+METHODS = {
+    'vca': vca,
+    'k-means': kmeans
+}
+
+
+def extract_endmembers(data, n, channel_axis=0, method='vca', wavelengths=None,
+                       size=DEFAULT_SAMPLE_SIZE, threshold=0, seed=None):
+    """Extracts n endmember spectra from a spectral image
+
+    Runs method (see METHODS) on a stratified sample of pixel spectra, so the
+    cost of the extraction itself does not grow with the image. Returns
+    max-normalized Spectrum objects sampled at wavelengths (channel indices
+    by default).
+    """
+    if method not in METHODS:
+        raise ValueError('unknown extraction method %r, expected one of %s'
+                         % (method, ', '.join(METHODS)))
+    B = sample_pixels(data, channel_axis, size, threshold, seed=seed)
+    if B.shape[1] < n:
+        raise ValueError('found %i pixel spectra above the threshold, need at least %i'
+                         % (B.shape[1], n))
+
+    A = METHODS[method](B, n, seed=seed)
+    if wavelengths is None:
+        wavelengths = np.arange(A.shape[0])
+
+    endmembers = []
+    for i in range(n):
+        endmember = Spectrum('endmember %d' % (i + 1), np.asarray(wavelengths), A[:, i])
+        endmember.normalize()
+        endmembers.append(endmember)
+    return endmembers
@@ -0,0 +1,85 @@
+import numpy as np
+
+from . import _profiling
+from ._lazy import PlaneCache
+
+# extent of the neighborhood read around the cursor along each plane axis
+DEFAULT_BLOCK_SIZE = 128
+
+# memory budget for cached neighborhoods in bytes
+DEFAULT_FETCH_CACHE_BYTES = 256 * 1024**2
+
+
+class SpectrumFetcher():
+    """Reads pixel spectra from N-D, lazy and multiscale spectral images
+
+    Spectra are read along channel_axis at a full N-D data coordinate, so the
+    current Z/T slice is respected. For multiscale data, a pyramid level can
+    be chosen and coordinates are scaled to it. NumPy arrays are indexed
+    directly; for lazy arrays (dask, zarr) the block around the cursor is read
+    once, aligned to the storage chunks where possible, and kept in a bounded
+    cache, so hovering nearby pixels does not go back to disk.
+    """
+
+    def __init__(self, data, channel_axis, plane_axes, multiscale=False,
+                 block_size=DEFAULT_BLOCK_SIZE, cache=None):
+        self.levels = list(data) if multiscale else [data]
+        self.ndim = len(self.levels[0].shape)
+        self.channel_axis = channel_axis % self.ndim
+        self.plane_axes = [a % self.ndim for a in plane_axes]
+        self.block_size = block_size
+        self.cache = PlaneCache(DEFAULT_FETCH_CACHE_BYTES) if cache is None else cache
+
+        # downsampling factor of every level relative to the full resolution data
+        full = np.array(self.levels[0].shape, dtype=float)
+        self._factors = [full / np.array(level.shape) for level in self.levels]
+
+
+    def fetch(self, point, level=0):
+        """Returns the spectrum at a full resolution data coordinate, or None if out of bounds"""
+        data = self.levels[level]
+        shape = np.array(data.shape)
+        index = np.floor(np.asarray(point, dtype=float) / self._factors[level]).astype(int)
+        index[self.channel_axis] = 0
+        if np.any(index < 0) or np.any(index >= shape):
+            return None
+
+        if isinstance(data, np.ndarray):
+            key = list(index)
+            key[self.channel_axis] = slice(None)
+            return data[tuple(key)]
+
+        # read (or reuse) the block containing the point
+        block = self._block_bounds(data, index)
+        cache_key = (level, tuple(start for start, _ in block))
+        values = self.cache.get(cache_key)
+        if values is None:
+            read = [slice(start, stop) for start, stop in block]
+            read[self.channel_axis] = slice(None)
+            with _profiling.stage('inspect.fetch') as stage:
+                values = np.asarray(data[tuple(read)])
+                stage.add(values.size // max(values.shape[self.channel_axis], 1), values.nbytes)
+            self.cache.put(cache_key, values)
+
+        local = [i - start for i, (start, _) in zip(index, block)]
+        local[self.channel_axis] = slice(None)
+        return values[tuple(local)]
+
+
+    def _block_bounds(self, data, index):
+        """Returns the (start, stop) of the block around index along every axis"""
+        chunks = getattr(data, 'chunksize', None) or getattr(data, 'chunks', None)
+        bounds = []
+        for a, (i, n) in enumerate(zip(index, data.shape)):
+            if a == self.channel_axis:
+                bounds.append((0, n))
+            elif a in self.plane_axes:
+                size = self.block_size
+                if chunks is not None and isinstance(chunks[a], (int, np.integer)):
+                    # stay within one storage chunk
+                    size = min(size, int(chunks[a]))
+                start = (i // size) * size
+                bounds.append((start, min(start + size, n)))
+            else:
+                bounds.append((i, i + 1))
+        return bounds
@@ -1,27 +1,48 @@
-import _utils
+from . import _fetch, _metadata, _profiling, _roi, _spectrum, _utils
+import time
+from collections import deque
+from functools import partial
 import numpy as np
-from napari.layers import Image
+from napari.layers import Image, Labels, Shapes
+from napari.qt.threading import thread_worker
+from napari.utils.notifications import show_error
 from napari.utils.theme import get_theme
+from matplotlib.collections import LineCollection
 from matplotlib.figure import Figure
 from matplotlib.backends.backend_qtagg import FigureCanvas
 from matplotlib.backends.backend_qtagg import (
     NavigationToolbar2QT as NavigationToolbar,
 )
+from qtpy.QtCore import QTimer
 from qtpy.QtWidgets import (
     QWidget,
     QHBoxLayout,
     QVBoxLayout,
     QLabel,
     QPushButton,
-    QComboBox
+    QComboBox,
+    QFileDialog
 )
 
 # TODO:
-# - Add a method to store spectra
-# - Add an export method to save stored spectra as a .ref file
-# - Add drag-and-drop function that plots spectra from a .ref file
 # - Fix xmin/xmax to work with wavelengths or indices
 
+# maximum rate of live spectrum redraws per second, mouse events in between are merged
+MAX_FPS = 60
+
+# number of recent redraw latencies kept for measurement
+LATENCY_HISTORY = 256
+
+@thread_worker
+def _exact_bit_depth(data):
+    """Computes the exact effective bit depth in a background thread"""
+    return _utils.bit_depth_of(float(np.max(data, initial=0)))
+
+@thread_worker
+def _region_spectra(data, labels, channel_axis):
+    """Computes region spectra in a background thread"""
+    return _roi.region_spectra(data, labels, channel_axis)
+
 class InspectionWidget(QWidget):
     def __init__(self, napari_viewer):
         super().__init__()
@@ -43,9 +64,31 @@ class InspectionWidget(QWidget):
             'axis_limits_stale': False,
             'effective_bit_depth': 0,
             'nchannels': 42,
-            'live_spectrum': np.full(42, np.NaN)
+            'live_spectrum': np.full(42, np.NaN),
+            'live_coordinates': None,
+            'wavelengths': list(range(42)),
+            'units': 'ch',
+            'cursor_position': None,
+            'redraw_pending': False
         }
 
+        # reads spectra of the active layer, see _layer_selection_changed
+        self._fetcher = None
+
+        # stored spectra, one store per channel count and dimensionality
+        self._stores = {}
+        self._store = None
+
+        # spectra and wavelengths of the last measured regions, see _measure_regions
+        self._regions = None
+
+        # redraw timing, see _schedule_redraw and _plot_spectrum
+        self._background = None
+        self._redraw_latency = deque(maxlen=LATENCY_HISTORY)
+        self._redraw_timer = QTimer(self)
+        self._redraw_timer.setSingleShot(True)
+        self._redraw_timer.timeout.connect(self._redraw_timeout)
+
         # set up callbacks and plot for active selection
         self._layer_selection_changed()
         self.viewer.layers.selection.events.changed.connect(self._layer_selection_changed)
@@ -53,8 +96,10 @@ class InspectionWidget(QWidget):
         # initialize plot
         (self._line,) = self._axes.plot(
             range(self._properties['nchannels']), 
-            self._properties['live_spectrum']
+            self._properties['live_spectrum'],
+            animated=True
         )
+        self._canvas.mpl_connect('draw_event', self._canvas_drawn)
         self._axes.set_ybound(
             lower=self._properties['ymin'],
             upper=self._properties['ymax']
@@ -80,6 +125,10 @@ class InspectionWidget(QWidget):
             Figure(figsize=(5, 3), facecolor='none', edgecolor='none')
         )
         self._axes = self._canvas.figure.subplots()
+
+        # stored spectra are drawn as a single artist in the cached background
+        self._stored = LineCollection([], linewidths=1, alpha=0.5)
+        self._axes.add_collection(self._stored, autolim=False)
         self._toolbar = NavigationToolbar(self._canvas, self)
 
         # controls
@@ -91,27 +140,62 @@ class InspectionWidget(QWidget):
         self._button_hide = QPushButton('hide')
         self._button_hide.setCheckable(True)
         self._button_hide.clicked.connect(self._hide_toggled)
+        self._button_store = QPushButton('store')
+        self._button_store.clicked.connect(self._store_spectrum)
+        self.viewer.bind_key('s', self._store_spectrum)
+        self._button_clear = QPushButton('clear')
+        self._button_clear.clicked.connect(self._clear_spectra)
+        self._button_export = QPushButton('export')
+        self._button_export.clicked.connect(self._export_spectra)
         cbox_normalization = QComboBox()
         cbox_normalization.addItems(['none', 'max', 'sum'])
         cbox_normalization.activated.connect(self._normalization_changed)
 
+        # region controls
+        self._cbox_regions = QComboBox()
+        self._cbox_statistic = QComboBox()
+        self._cbox_statistic.addItems(_roi.STATISTICS)
+        self._button_measure = QPushButton('measure')
+        self._button_measure.clicked.connect(self._measure_regions)
+        self._button_export_regions = QPushButton('export table')
+        self._button_export_regions.setDisabled(True)
+        self._button_export_regions.clicked.connect(self._export_regions)
+        self._update_region_layers()
+        self.viewer.layers.events.inserted.connect(self._update_region_layers)
+        self.viewer.layers.events.removed.connect(self._update_region_layers)
+
         # layout
         layout_settings = QHBoxLayout()
         layout_settings.addWidget(QLabel('inspector:'))
         layout_settings.addWidget(self._button_live)
         layout_settings.addWidget(self._button_hide)
+        layout_settings.addWidget(self._button_store)
+        layout_settings.addWidget(self._button_clear)
+        layout_settings.addWidget(self._button_export)
         layout_settings.addStretch(1)
         layout_settings.addWidget(QLabel('normalization:'))
         layout_settings.addWidget(cbox_normalization)
         layout_settings.addStretch(0)
 
+        layout_regions = QHBoxLayout()
+        layout_regions.addWidget(QLabel('regions:'))
+        layout_regions.addWidget(self._cbox_regions)
+        layout_regions.addWidget(self._cbox_statistic)
+        layout_regions.addWidget(self._button_measure)
+        layout_regions.addWidget(self._button_export_regions)
+        layout_regions.addStretch(1)
+
         layout_main = QVBoxLayout()
         layout_main.addWidget(self._canvas)
         layout_main.addWidget(self._toolbar)
         layout_main.addLayout(layout_settings)
+        layout_main.addLayout(layout_regions)
 
         self.setLayout(layout_main)
 
+        # stored spectra can be reloaded by dropping .ref or CSV files
+        self.setAcceptDrops(True)
+
 
     def _set_mouse_move_callback(self):
         """Adds the mouse move callback only if settings allow"""
@@ -134,12 +218,19 @@ class InspectionWidget(QWidget):
         """Modifies state for new active layer"""
         layer = self.viewer.layers.selection.active
         if layer and isinstance(layer, Image) and (layer.ndim > self.viewer.dims.ndisplay):
-            # determine effective bit depth
-            effective_bit_depth = _utils.effective_bit_depth(layer.data)
-
-            # determine number of spectral channels
-            # TODO: dynamically determine correct spectral dimension
-            nchannels = layer.data.shape[0]
+            # determine number of spectral channels from the spectral axis
+            metadata = _metadata.init_metadata(layer, self.viewer.dims.ndisplay)
+            axes = metadata['axes']
+
+            # determine effective bit depth from cached or estimated statistics
+            effective_bit_depth = self._layer_statistics(layer)['effective_bit_depth']
+            nchannels = axes['c']['extent']
+            self._fetcher = _fetch.SpectrumFetcher(
+                layer.data,
+                axes['c']['index'],
+                [axes['y']['index'], axes['x']['index']],
+                multiscale=layer.multiscale
+            )
 
             # set null spectrum
             spectrum = np.full(nchannels, np.NaN)
@@ -153,11 +244,22 @@ class InspectionWidget(QWidget):
                 'axis_limits_stale': True,
                 'effective_bit_depth': effective_bit_depth,   
                 'nchannels': nchannels,
-                'live_spectrum': spectrum
+                'live_spectrum': spectrum,
+                'live_coordinates': None,
+                'wavelengths': metadata['wavelengths'],
+                'units': metadata.get('units', 'ch')
             })
 
-            # correct y-axis limits
+            # show spectra stored for images with the same channels
+            key = (nchannels, layer.ndim)
+            if key not in self._stores:
+                self._stores[key] = _spectrum.SpectrumStore(nchannels, layer.ndim)
+            self._store = self._stores[key]
+            self._update_stored_spectra()
+
+            # correct y-axis limits, refining them if exact statistics are needed
             self._calculate_ylimits()
+            self._request_exact_statistics()
 
             # re-enable live button
             self._button_live.setDisabled(False)
@@ -171,6 +273,81 @@ class InspectionWidget(QWidget):
             self._unset_mouse_move_callback()
 
 
+    def _layer_statistics(self, layer):
+        """Returns cached statistics for a layer, estimating them if needed"""
+        metadata = layer.metadata.setdefault('rainbow', {})
+        if 'stats' not in metadata:
+            # the smallest pyramid level bounds what multiscale layers read
+            data = layer.data[-1] if layer.multiscale else layer.data
+            effective_bit_depth, sampled = _utils.estimate_bit_depth(
+                data,
+                getattr(layer, 'contrast_limits_range', None),
+                metadata.get('axes', {}).get('c', {}).get('index')
+            )
+            metadata['stats'] = {
+                'effective_bit_depth': effective_bit_depth,
+                'exact': not sampled,
+                'pending': False
+            }
+            layer.events.data.connect(self._layer_data_changed)
+        return metadata['stats']
+
+
+    def _layer_data_changed(self, event):
+        """Invalidates cached statistics when a layer's data changes"""
+        layer = event.source
+        layer.metadata.get('rainbow', {}).pop('stats', None)
+        if layer is self.viewer.layers.selection.active:
+            self._layer_selection_changed()
+
+
+    def _request_exact_statistics(self):
+        """Computes exact statistics of the active layer in the background if needed"""
+        layer = self._properties['layer']
+        stats = self._layer_statistics(layer)
+
+        # only unnormalized plots depend on the bit depth
+        if stats['exact'] or stats['pending'] or self._properties['normalization'] != 0:
+            return
+
+        # lazy data keeps its sampled estimate rather than being read in full
+        data = layer.data[-1] if layer.multiscale else layer.data
+        if not isinstance(data, np.ndarray) and not layer.multiscale:
+            return
+
+        stats['pending'] = True
+        worker = _exact_bit_depth(data)
+        worker.returned.connect(partial(self._exact_statistics_ready, layer, stats))
+        worker.errored.connect(partial(self._exact_statistics_failed, stats))
+        worker.start()
+
+
+    def _exact_statistics_ready(self, layer, stats, effective_bit_depth):
+        """Stores exact statistics and updates the plot if their layer is active"""
+        stats.update({
+            'effective_bit_depth': effective_bit_depth,
+            'exact': True,
+            'pending': False
+        })
+
+        # ignore results for data that has since changed
+        if layer.metadata.get('rainbow', {}).get('stats') is not stats:
+            return
+
+        if self._properties['active_selection'] and self._properties['layer'] is layer:
+            self._properties['effective_bit_depth'] = effective_bit_depth
+            self._calculate_ylimits()
+            self._plot_spectrum()
+
+
+    def _exact_statistics_failed(self, stats, error):
+        """Keeps the estimated statistics when the exact pass fails"""
+        stats.update({
+            'exact': True,
+            'pending': False
+        })
+
+
     def _live_toggled(self, viewer):
         """Live/paused live spectrum plotting"""
         if self._properties['live']:
@@ -211,6 +388,7 @@ class InspectionWidget(QWidget):
         self._axes.spines['left'].set_color(theme.text.as_hex())
         self._axes.spines['bottom'].set_color(theme.text.as_hex())
         self._line.set_color(theme.icon.as_hex())
+        self._stored.set_color(theme.text.as_hex())
         self._canvas.draw()        
 
 
@@ -236,21 +414,217 @@ class InspectionWidget(QWidget):
     def _normalization_changed(self, idx):
         self._properties['normalization'] = idx
         self._calculate_ylimits()
+        self._update_stored_spectra()
+        if self._properties['active_selection']:
+            self._request_exact_statistics()
         self._plot_spectrum()
 
 
     def _mouse_moved(self, viewer, event):
+        """Schedules a spectrum update for the new cursor position"""
+        self._properties['cursor_position'] = self.viewer.cursor.position
+        self._schedule_redraw()
+
+
+    def _schedule_redraw(self):
+        """Redraws now or at the end of the current frame, at most MAX_FPS times per second"""
+        if self._redraw_timer.isActive():
+            self._properties['redraw_pending'] = True
+        else:
+            self._update_live_spectrum()
+            self._redraw_timer.start(int(1000 / MAX_FPS))
+
+
+    def _redraw_timeout(self):
+        if self._properties['redraw_pending']:
+            self._properties['redraw_pending'] = False
+            self._update_live_spectrum()
+            self._redraw_timer.start(int(1000 / MAX_FPS))
+
+
+    def _update_live_spectrum(self):
         """Plots spectrum if coordinates are inbounds for active layer"""
+        if not self._properties['active_selection'] or self._properties['cursor_position'] is None:
+            return
+
+        # read at the current slice, from the displayed pyramid level
         layer = self._properties['layer']
-        coordinates = layer.world_to_data(self.viewer.cursor.position)
-        xy_coordinates = [int(x) for x in coordinates[-2:]]
-        if all(xy_coordinates >= layer.corner_pixels[0,-2:]) and all(xy_coordinates < layer.corner_pixels[1,-2:]):
-            self._properties['live_spectrum'] = layer.data[:,xy_coordinates[0], xy_coordinates[1]]
+        coordinates = layer.world_to_data(self._properties['cursor_position'])
+        level = layer.data_level if layer.multiscale else 0
+        spectrum = self._fetcher.fetch(coordinates, level)
+        if spectrum is not None:
+            self._properties['live_spectrum'] = spectrum
+            self._properties['live_coordinates'] = coordinates
             self._plot_spectrum()
 
 
+    def _store_spectrum(self, viewer=None):
+        """Stores the live spectrum at its data coordinates"""
+        if self._store is None or self._properties['live_coordinates'] is None:
+            return
+        self._store.append(
+            self._properties['live_spectrum'],
+            self._properties['live_coordinates']
+        )
+        self._update_stored_spectra()
+        self._canvas.draw()
+
+
+    def _clear_spectra(self):
+        if self._store is not None:
+            self._store.clear()
+            self._update_stored_spectra()
+            self._canvas.draw()
+
+
+    def _export_spectra(self):
+        """Prompts user for a file and writes the stored spectra to it"""
+        if self._store is None or not len(self._store):
+            return
+        fname, ftype = QFileDialog.getSaveFileName(self,
+            caption='Export spectra',
+            filter='Reference files (*.ref);;CSV files (*.csv)'
+        )
+        if not fname:
+            return
+        _spectrum.write_spectra(
+            fname,
+            self._store.labels,
+            self._properties['wavelengths'],
+            self._store.data.T
+        )
+
+
+    def _load_spectra(self, path):
+        """Adds spectra from a .ref or CSV file to the stored spectra"""
+        if self._store is None:
+            return
+        names, wavelengths, data = _spectrum.read_spectra(path)
+
+        # resample onto the image's wavelengths unless they are plain channel indices
+        if self._properties['units'] != 'ch':
+            data = _spectrum.interp_spectra(wavelengths, data, self._properties['wavelengths'])
+        if data.shape[0] != self._store.nchannels:
+            raise ValueError(
+                'spectra have %i wavelengths but the image has %i channels'
+                % (data.shape[0], self._store.nchannels)
+            )
+
+        self._store.extend(data.T, labels=names)
+        self._update_stored_spectra()
+        self._canvas.draw()
+
+
+    def _update_region_layers(self, event=None):
+        """Lists Labels and Shapes layers that can define regions"""
+        current = self._cbox_regions.currentText()
+        names = [layer.name for layer in self.viewer.layers if isinstance(layer, (Labels, Shapes))]
+        self._cbox_regions.clear()
+        self._cbox_regions.addItems(names)
+        if current in names:
+            self._cbox_regions.setCurrentText(current)
+        self._button_measure.setEnabled(bool(names))
+
+
+    def _measure_regions(self):
+        """Computes spectra of every label or shape over the active image in the background"""
+        name = self._cbox_regions.currentText()
+        if not self._properties['active_selection'] or name not in self.viewer.layers:
+            return
+        image = self._properties['layer']
+        regions = self.viewer.layers[name]
+        channel_axis = image.metadata['rainbow']['axes']['c']['index']
+        data = image.data[0] if image.multiscale else image.data
+
+        # regions span the image without its channel axis, or trailing axes of it
+        spatial_shape = tuple(n for a, n in enumerate(data.shape) if a != channel_axis)
+        if isinstance(regions, Shapes):
+            labels = regions.to_labels(labels_shape=spatial_shape[-regions.ndim:])
+        else:
+            labels = regions.data[0] if regions.multiscale else regions.data
+
+        self._button_measure.setDisabled(True)
+        worker = _region_spectra(data, labels, channel_axis)
+        wavelengths = image.metadata['rainbow']['wavelengths']
+        worker.returned.connect(partial(self._regions_measured, wavelengths))
+        worker.finished.connect(partial(self._button_measure.setEnabled, True))
+        worker.start()
+
+
+    def _regions_measured(self, wavelengths, regions):
+        """Plots the chosen statistic of every region with the stored spectra"""
+        self._regions = (regions, wavelengths)
+        self._button_export_regions.setEnabled(len(regions.labels) > 0)
+        if self._store is None or self._store.nchannels != regions.mean.shape[1]:
+            return
+
+        statistic = self._cbox_statistic.currentText()
+        self._store.extend(
+            getattr(regions, statistic),
+            labels=['label %d %s' % (label, statistic) for label in regions.labels]
+        )
+        self._update_stored_spectra()
+        self._canvas.draw()
+
+
+    def _export_regions(self):
+        """Prompts user for a file and writes the region spectra table to it"""
+        if self._regions is None:
+            return
+        fname, ftype = QFileDialog.getSaveFileName(self,
+            caption='Export region spectra',
+            filter='CSV files (*.csv);;Tab-delimited files (*.tsv)'
+        )
+        if not fname:
+            return
+        _roi.write_region_table(fname, *self._regions)
+
+
+    def _update_stored_spectra(self):
+        """Sets the stored spectra line segments, normalized like the live spectrum"""
+        if self._store is None or not len(self._store):
+            self._stored.set_segments([])
+            return
+
+        spectra = self._store.data
+        if self._properties['normalization'] == 1:
+            spectra = _utils.safe_normalize_max(spectra, axis=1)
+        elif self._properties['normalization'] == 2:
+            spectra = _utils.safe_normalize_sum(spectra, axis=1)
+
+        x = np.broadcast_to(np.arange(self._store.nchannels), spectra.shape)
+        self._stored.set_segments(np.stack([x, spectra], axis=-1))
+
+
+    def dragEnterEvent(self, event):
+        if event.mimeData().hasUrls() and any(
+            url.toLocalFile().lower().endswith(('.ref', '.csv'))
+            for url in event.mimeData().urls()
+        ):
+            event.acceptProposedAction()
+
+
+    def dropEvent(self, event):
+        for url in event.mimeData().urls():
+            path = url.toLocalFile()
+            if path.lower().endswith(('.ref', '.csv')):
+                # errors of unreadable or malformed files must not escape the Qt event handler
+                try:
+                    self._load_spectra(path)
+                except (OSError, ValueError) as error:
+                    show_error('Could not load spectra from %s: %s' % (path, error))
+        event.acceptProposedAction()
+
+
+    def _canvas_drawn(self, event):
+        """Caches the plot background after a full draw and draws the live line on top"""
+        self._background = self._canvas.copy_from_bbox(self._axes.bbox)
+        self._axes.draw_artist(self._line)
+
+
     def _plot_spectrum(self):
         """Plots the current spectrum with/without normalization"""
+        start = time.perf_counter()
         spectrum = self._properties['live_spectrum']
 
         if self._properties['normalization'] == 1:
@@ -261,7 +635,7 @@ class InspectionWidget(QWidget):
         channels = self._properties['nchannels']
         self._line.set_data(range(channels), spectrum)
 
-        if self._properties['axis_limits_stale']:
+        if self._properties['axis_limits_stale'] or self._background is None:
             self._axes.set_xbound(
                 lower=self._properties['xmin'], 
                 upper=self._properties['xmax']
@@ -272,7 +646,18 @@ class InspectionWidget(QWidget):
             )
             self._properties['axis_limits_stale'] = False
 
-        self._canvas.draw()
+            # full redraw, which recaches the background through _canvas_drawn
+            self._canvas.draw()
+        else:
+            # blit only the live line over the cached background
+            self._canvas.restore_region(self._background)
+            self._axes.draw_artist(self._line)
+            self._canvas.blit(self._axes.bbox)
+
+        self._redraw_latency.append(time.perf_counter() - start)
+        profiler = _profiling.active()
+        if profiler is not None:
+            profiler.record('inspect.plot', self._redraw_latency[-1], 1)
 
 
 if __name__ == "__main__":
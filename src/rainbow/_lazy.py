@@ -0,0 +1,216 @@
+import itertools
+import threading
+from collections import OrderedDict
+import numpy as np
+
+from ._pipeline import DEFAULT_BLOCK_SIZE, unmix_block
+
+# default memory budget of a plane cache in bytes
+DEFAULT_CACHE_BYTES = 1024**3
+
+# distinguishes the planes of unmixers sharing a cache
+_unmixer_ids = itertools.count()
+
+
+class PlaneCache():
+    """Least recently used cache of arrays bounded by their total size in bytes"""
+
+    def __init__(self, max_bytes=DEFAULT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._arrays = OrderedDict()
+        self._lock = threading.Lock()
+
+
+    def __len__(self):
+        return len(self._arrays)
+
+
+    def get(self, key):
+        with self._lock:
+            array = self._arrays.get(key)
+            if array is not None:
+                self._arrays.move_to_end(key)
+            return array
+
+
+    def put(self, key, array):
+        with self._lock:
+            if key in self._arrays:
+                self.nbytes -= self._arrays.pop(key).nbytes
+            self._arrays[key] = array
+            self.nbytes += array.nbytes
+
+            # evict least recently used arrays, always keeping the newest one
+            while self.nbytes > self.max_bytes and len(self._arrays) > 1:
+                _, evicted = self._arrays.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+
+
+    def resize(self, max_bytes):
+        """Changes the memory budget, evicting arrays if needed"""
+        self.max_bytes = max_bytes
+        with self._lock:
+            while self.nbytes > self.max_bytes and len(self._arrays) > 1:
+                _, evicted = self._arrays.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+
+
+    def clear(self):
+        with self._lock:
+            self._arrays.clear()
+            self.nbytes = 0
+
+
+class LazyUnmixer():
+    """Unmixes a spectral image one plane at a time, on demand
+
+    A plane spans plane_axes (e.g. the displayed Y and X axes) and the whole
+    channel axis at a single position along every other axis. Planes are
+    unmixed for all endmembers at once and kept in a PlaneCache.
+    """
+
+    def __init__(self, data, solver, channel_axis, plane_axes, cache=None,
+                 block_size=DEFAULT_BLOCK_SIZE):
+        self.data = data
+        self.solver = solver
+        self.ndim = len(data.shape)
+        self.channel_axis = channel_axis % self.ndim
+        self.plane_axes = sorted(a % self.ndim for a in plane_axes)
+        self.slice_axes = [a for a in range(self.ndim)
+                           if a != self.channel_axis and a not in self.plane_axes]
+        self.cache = PlaneCache() if cache is None else cache
+        self.block_size = block_size
+        self._id = next(_unmixer_ids)
+
+
+    def plane(self, position):
+        """Returns abundances with shape (endmembers, *plane) at a slice position"""
+        key = (self._id, tuple(position))
+        X = self.cache.get(key)
+        if X is None:
+            index = [slice(None)] * self.ndim
+            for a, p in zip(self.slice_axes, position):
+                index[a] = p
+            B = np.asarray(self.data[tuple(index)])
+
+            # the channel axis keeps its place relative to the plane axes
+            cidx = sum(a < self.channel_axis for a in self.plane_axes)
+            X = np.moveaxis(unmix_block(B, self.solver, cidx, self.block_size), cidx, 0)
+            self.cache.put(key, X)
+        return X
+
+
+    def abundance(self, endmember):
+        """Returns a lazy array of the abundance of one endmember"""
+        return LazyAbundance(self, endmember)
+
+
+class LazyAbundance():
+    """Array-like view of one endmember's abundance, unmixed plane by plane on access
+
+    The shape is the spectral image shape without the channel axis. Indexing
+    supports integers and slices, which is all napari needs to display it.
+    """
+
+    def __init__(self, unmixer, endmember):
+        self.unmixer = unmixer
+        self.endmember = endmember
+        shape = list(unmixer.data.shape)
+        del shape[unmixer.channel_axis]
+        self.shape = tuple(shape)
+        self.ndim = len(shape)
+        self.dtype = np.dtype(np.float64)
+        self.size = int(np.prod(shape))
+
+        # axes of this view in terms of the spectral image axes
+        cidx = unmixer.channel_axis
+        self._data_axes = [a if a < cidx else a + 1 for a in range(self.ndim)]
+
+
+    def __len__(self):
+        return self.shape[0]
+
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self[...], dtype=dtype)
+
+
+    def __getitem__(self, key):
+        key = _normalize_key(key, self.shape)
+        unmixer = self.unmixer
+        slice_axes = [v for v, a in enumerate(self._data_axes) if a in unmixer.slice_axes]
+        plane_axes = [v for v, a in enumerate(self._data_axes) if a in unmixer.plane_axes]
+
+        # unmix (or fetch) every plane touched by the key
+        positions = [[key[v]] if isinstance(key[v], int) else range(*key[v].indices(self.shape[v]))
+                     for v in slice_axes]
+        plane_key = tuple(key[v] for v in plane_axes)
+        planes = [unmixer.plane(p)[self.endmember][plane_key] for p in itertools.product(*positions)]
+
+        # arrange as (slice axes..., remaining plane axes...) then restore axis order
+        kept = [v for v in plane_axes if not isinstance(key[v], int)]
+        counts = [len(p) for p in positions]
+        if planes:
+            result = np.stack(planes).reshape(counts + list(planes[0].shape))
+        else:
+            result = np.empty(counts + [len(range(*key[v].indices(self.shape[v]))) for v in kept])
+        current = slice_axes + kept
+        result = result.transpose(np.argsort(current))
+        ordered = sorted(current)
+        dropped = tuple(ordered.index(v) for v in slice_axes if isinstance(key[v], int))
+        return result.squeeze(axis=dropped) if dropped else result
+
+
+class AxisView():
+    """Array-like view of one position along an axis of another array, read on access
+
+    Lets layers show a single endmember of an abundance array that slicing
+    would read into memory, such as a zarr array being written to.
+    """
+
+    def __init__(self, array, axis, position):
+        self.array = array
+        self.axis = axis % len(array.shape)
+        self.position = position
+        shape = list(array.shape)
+        del shape[self.axis]
+        self.shape = tuple(shape)
+        self.ndim = len(shape)
+        self.dtype = np.dtype(array.dtype)
+        self.size = int(np.prod(shape))
+
+
+    def __len__(self):
+        return self.shape[0]
+
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self[...], dtype=dtype)
+
+
+    def __getitem__(self, key):
+        key = list(_normalize_key(key, self.shape))
+        key.insert(self.axis, self.position)
+        return np.asarray(self.array[tuple(key)])
+
+
+def _normalize_key(key, shape):
+    """Expands an index into one integer or slice per axis"""
+    if not isinstance(key, tuple):
+        key = (key,)
+    if any(k is Ellipsis for k in key):
+        i = key.index(Ellipsis)
+        key = key[:i] + (slice(None),) * (len(shape) - len(key) + 1) + key[i + 1:]
+    key = key + (slice(None),) * (len(shape) - len(key))
+
+    normalized = []
+    for k, n in zip(key, shape):
+        if isinstance(k, (int, np.integer)):
+            k = int(k)
+            normalized.append(k + n if k < 0 else k)
+        elif isinstance(k, slice):
+            normalized.append(k)
+        else:
+            raise TypeError('lazy abundances only support integer and slice indices')
+    return tuple(normalized)
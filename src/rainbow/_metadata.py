@@ -1,5 +1,3 @@
-from re import L
-import _utils
 import numpy as np
 from napari.layers import Image
 from qtpy.QtWidgets import (
@@ -15,6 +13,51 @@ from qtpy.QtWidgets import (
 # TODO:
 # - Dyanmically display dimensions
 
+def init_metadata(layer, ndisplay):
+    """Initializes rainbow metadata for a layer that does not have it yet"""
+    if 'rainbow' not in layer.metadata:
+        layer.metadata['rainbow'] = {}
+
+    if 'axes' not in layer.metadata['rainbow']:
+        layer.metadata['rainbow']['axes'] = {'x': {}, 'y': {}, 'z': {}, 'c': {}}
+        infer_axis_indices(layer, ndisplay)
+
+    if 'wavelengths' not in layer.metadata['rainbow']:
+        layer.metadata['rainbow']['wavelengths'] = list(range(layer.metadata['rainbow']['axes']['c']['extent']))
+        layer.metadata['rainbow']['units'] = 'ch'
+
+    return layer.metadata['rainbow']
+
+
+def infer_axis_indices(layer, ndisplay):
+    """Infers the label for each axis based on the user's current data orientation"""
+    axes = layer.metadata['rainbow']['axes']
+
+    # identify X and Y (assume last two)
+    axes['x']['index'] = layer._dims_displayed[-1]
+    axes['y']['index'] = layer._dims_displayed[-2]
+
+    # identify Z if it exists (assume third to last if in 3D mode)
+    if ndisplay == 3 and layer.ndim > 2:
+        axes['z']['index'] = layer._dims_displayed[-3]
+    else:
+        axes['z']['index'] = None
+
+    # identify C (assume first non-displayed dimension)
+    if 'index' not in axes['c'] or axes['c']['index'] is None or axes['c']['index'] not in layer._dims_not_displayed:
+        if ndisplay < layer.ndim:
+            axes['c']['index'] = layer._dims_not_displayed[-1]
+        else:
+            axes['c']['index'] = None
+
+    # determine extent for each axis
+    for a in axes:
+        if axes[a]['index'] is None:
+            axes[a]['extent'] = 1
+        else:
+            axes[a]['extent'] = layer.data.shape[axes[a]['index']]
+
+
 class MetadataWidget(QWidget):
     def __init__(self, napari_viewer):
         super().__init__()
@@ -88,17 +131,7 @@ class MetadataWidget(QWidget):
         # only proceed if there is an active image layer
         layer = self.viewer.layers.selection.active
         if layer and isinstance(layer, Image):
-            if 'rainbow' not in layer.metadata:
-                layer.metadata['rainbow'] = {} 
-            
-            if 'axes' not in layer.metadata['rainbow']:
-                layer.metadata['rainbow']['axes'] = {'x': {}, 'y': {}, 'z': {}, 'c': {}} 
-                self._infer_axis_indices(layer)
-
-            if 'wavelengths' not in layer.metadata['rainbow']:
-                layer.metadata['rainbow']['wavelengths'] = list(range(layer.metadata['rainbow']['axes']['c']['extent']))
-                layer.metadata['rainbow']['units'] = 'ch'
-
+            init_metadata(layer, self.viewer.dims.ndisplay)
             self._update_display(layer)
 
 
@@ -115,31 +148,7 @@ class MetadataWidget(QWidget):
 
     def _infer_axis_indices(self, layer):
         """Infers the label for each axis based on the user's current data orientation"""
-        axes = layer.metadata['rainbow']['axes']
-
-        # identify X and Y (assume last two)
-        axes['x']['index'] = layer._dims_displayed[-1]
-        axes['y']['index'] = layer._dims_displayed[-2]
-
-        # identify Z if it exists (assume third to last if in 3D mode)
-        if self.viewer.dims.ndisplay == 3 and layer.ndim > 2:
-            axes['z']['index'] = layer._dims_displayed[-3]
-        else:
-            axes['z']['index'] = None
-
-        # identify C (assume first non-displayed dimension)
-        if 'index' not in axes['c'] or axes['c']['index'] is None or axes['c']['index'] not in layer._dims_not_displayed:
-            if self.viewer.dims.ndisplay < layer.ndim:
-                axes['c']['index'] = layer._dims_not_displayed[-1]
-            else:
-                axes['c']['index'] = None
-
-        # determine extent for each axis
-        for a in axes:
-            if axes[a]['index'] is None:
-                axes[a]['extent'] = 1
-            else:
-                axes[a]['extent'] = layer.data.shape[axes[a]['index']]
+        infer_axis_indices(layer, self.viewer.dims.ndisplay)
 
 
     def _update_display(self, layer):
@@ -0,0 +1,106 @@
+import numpy as np
+
+from ._pipeline import allocate_output, default_tile_shape, iter_tiles
+
+# number of histogram bins along G and S
+DEFAULT_BINS = 256
+
+# phasor coordinates of nonnegative spectra lie within the unit circle
+PHASOR_RANGE = (-1.0, 1.0)
+
+
+def phasor_coefficients(nchannels, harmonic=1):
+    """Returns the cosine and sine weights of a harmonic over nchannels channels"""
+    angle = 2 * np.pi * harmonic * np.arange(nchannels) / nchannels
+    return np.stack([np.cos(angle), np.sin(angle)])
+
+
+def phasor_coordinates(B, coefficients):
+    """Projects (channels, pixels) spectra onto G and S, with NaN for zero spectra
+
+    Returns a (2, pixels) array of G and S, computed as one matrix product.
+    """
+    B = np.asarray(B, dtype=np.float64)
+    total = B.sum(axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(total > 0, (coefficients @ B) / total, np.nan)
+
+
+class PhasorHistogram():
+    """Density histogram of the spectral phasors of every pixel, with a pixel-to-bin index
+
+    G/S coordinates are computed and binned one tile at a time, so data may
+    be lazy or larger than memory. Alongside the histogram, every pixel keeps
+    the index of its bin (-1 for background), so a selection of bins maps
+    back to a pixel mask with a single lookup instead of another pass.
+    """
+
+    def __init__(self, data, channel_axis=0, bins=DEFAULT_BINS, harmonic=1, threshold=0,
+                 tile_shape=None):
+        self.data = data
+        self.ndim = len(data.shape)
+        self.channel_axis = channel_axis % self.ndim
+        self.bins = bins
+        self.threshold = threshold
+        self.tile_shape = default_tile_shape(data, channel_axis) if tile_shape is None else tile_shape
+        self.coefficients = phasor_coefficients(data.shape[self.channel_axis], harmonic)
+        self.edges = np.linspace(*PHASOR_RANGE, bins + 1)
+
+        self.shape = tuple(n for a, n in enumerate(data.shape) if a != self.channel_axis)
+        self.counts = np.zeros((bins, bins), dtype=np.int64)
+        self.bin_index = allocate_output(self.shape, dtype=np.int32,
+                                         on_disk=not isinstance(data, np.ndarray))
+
+
+    def compute(self):
+        """Bins every pixel, see iter_compute"""
+        for _ in self.iter_compute():
+            pass
+        return self
+
+
+    def iter_compute(self):
+        """Bins the phasors of every tile, yielding the number of tiles done and in total"""
+        tiles = list(iter_tiles(self.data.shape, self.tile_shape, self.channel_axis))
+        self.counts[...] = 0
+        for i, index in enumerate(tiles):
+            self.bin_tile(index)
+            yield i + 1, len(tiles)
+
+
+    def bin_tile(self, index):
+        """Computes and bins the phasors of one tile of data"""
+        B = np.moveaxis(np.asarray(self.data[index]), self.channel_axis, 0)
+        tile_shape = B.shape[1:]
+        B = B.reshape(B.shape[0], -1)
+        g, s = phasor_coordinates(B, self.coefficients)
+
+        # bins along S are rows and bins along G columns, as displayed, the last bins
+        # include their upper edge so phasors at G or S = 1 are kept
+        column = np.minimum(np.searchsorted(self.edges, g, side='right') - 1, self.bins - 1)
+        row = np.minimum(np.searchsorted(self.edges, s, side='right') - 1, self.bins - 1)
+        lo, hi = self.edges[0], self.edges[-1]
+        valid = (np.isfinite(g) & (B.sum(axis=0) > self.threshold)
+                 & (g >= lo) & (g <= hi) & (s >= lo) & (s <= hi))
+        bins = np.where(valid, row * self.bins + column, -1).astype(np.int32)
+
+        self.counts += np.bincount(bins[valid], minlength=self.bins**2).reshape(self.bins, self.bins)
+        self.bin_index[index[:self.channel_axis] + index[self.channel_axis + 1:]] = bins.reshape(tile_shape)
+
+
+    def bin_centers(self):
+        """Returns the G and S coordinates of every bin center as (bins, bins) arrays"""
+        centers = (self.edges[:-1] + self.edges[1:]) / 2
+        return np.meshgrid(centers, centers)
+
+
+    def circle(self, center, radius):
+        """Returns the bins whose centers lie within a circle on the phasor plot"""
+        g, s = self.bin_centers()
+        return (g - center[0])**2 + (s - center[1])**2 <= radius**2
+
+
+    def select(self, selected):
+        """Returns the pixel mask of a (bins, bins) boolean selection of bins"""
+        lookup = np.append(np.asarray(selected, dtype=bool).ravel(), False)
+        return lookup[self.bin_index]
@@ -0,0 +1,191 @@
+import numpy as np
+from . import _metadata, _phasor
+from napari.layers import Image
+from napari.qt.threading import thread_worker
+from napari.utils.theme import get_theme
+from matplotlib.figure import Figure
+from matplotlib.path import Path
+from matplotlib.patches import Circle
+from matplotlib.widgets import LassoSelector
+from matplotlib.backends.backend_qtagg import FigureCanvas
+from qtpy.QtWidgets import (
+    QWidget,
+    QHBoxLayout,
+    QVBoxLayout,
+    QLabel,
+    QPushButton,
+    QSpinBox,
+    QDoubleSpinBox,
+    QProgressBar
+)
+
+
+@thread_worker
+def _bin_phasors(histogram):
+    """Bins phasors in a background thread, yielding (done, total) tiles"""
+    yield from histogram.iter_compute()
+    return histogram
+
+
+class PhasorWidget(QWidget):
+    def __init__(self, napari_viewer):
+        super().__init__()
+        self.viewer = napari_viewer
+
+        # initialize canvas
+        self._canvas = FigureCanvas(
+            Figure(figsize=(4, 4), facecolor='none', edgecolor='none')
+        )
+        self._axes = self._canvas.figure.subplots()
+        self._lasso = LassoSelector(self._axes, self._phasors_selected)
+
+        # controls
+        self._sbox_harmonic = QSpinBox()
+        self._sbox_harmonic.setRange(1, 16)
+        self._sbox_bins = QSpinBox()
+        self._sbox_bins.setRange(16, 4096)
+        self._sbox_bins.setValue(_phasor.DEFAULT_BINS)
+        self._sbox_threshold = QDoubleSpinBox()
+        self._sbox_threshold.setRange(0, 1e12)
+        self._button_compute = QPushButton('compute')
+        self._button_compute.clicked.connect(self._compute)
+        self._progress = QProgressBar()
+        self._progress.setValue(0)
+
+        # layout
+        layout_settings = QHBoxLayout()
+        layout_settings.addWidget(QLabel('harmonic:'))
+        layout_settings.addWidget(self._sbox_harmonic)
+        layout_settings.addWidget(QLabel('bins:'))
+        layout_settings.addWidget(self._sbox_bins)
+        layout_settings.addWidget(QLabel('threshold:'))
+        layout_settings.addWidget(self._sbox_threshold)
+
+        layout_main = QVBoxLayout()
+        layout_main.addWidget(self._canvas)
+        layout_main.addLayout(layout_settings)
+        layout_main.addWidget(self._button_compute)
+        layout_main.addWidget(self._progress)
+        self.setLayout(layout_main)
+
+        # state of the last computed histogram
+        self._histogram = None
+        self._layer = None
+        self._worker = None
+
+        # set up callbacks for active selection
+        self._set_compute_button()
+        self.viewer.layers.selection.events.changed.connect(self._set_compute_button)
+
+        # set plot style
+        self._axes.set_aspect('equal')
+        self._axes.set_xlim(*_phasor.PHASOR_RANGE)
+        self._axes.set_ylim(*_phasor.PHASOR_RANGE)
+        self._axes.set_xlabel('G')
+        self._axes.set_ylabel('S')
+        self._axes.patch.set_color('none')
+        self._axes.spines['right'].set_color('none')
+        self._axes.spines['top'].set_color('none')
+        self._circle = Circle((0, 0), 1, fill=False, linestyle='--', linewidth=0.5)
+        self._axes.add_patch(self._circle)
+        self._image = None
+
+        # set up callbacks and plot theme settings
+        self._theme_changed()
+        self.viewer.events.theme.connect(self._theme_changed)
+
+
+    def _set_compute_button(self):
+        layer = self.viewer.layers.selection.active
+        running = self._worker is not None
+        if layer and isinstance(layer, Image) and (layer.ndim > self.viewer.dims.ndisplay) and not running:
+            self._button_compute.setEnabled(True)
+        else:
+            self._button_compute.setDisabled(True)
+
+
+    def _compute(self):
+        """Computes the phasor histogram of the active layer in the background"""
+        layer = self.viewer.layers.selection.active
+        metadata = _metadata.init_metadata(layer, self.viewer.dims.ndisplay)
+        data = layer.data[0] if layer.multiscale else layer.data
+
+        histogram = _phasor.PhasorHistogram(
+            data,
+            metadata['axes']['c']['index'],
+            bins=self._sbox_bins.value(),
+            harmonic=self._sbox_harmonic.value(),
+            threshold=self._sbox_threshold.value()
+        )
+
+        self._progress.setValue(0)
+        self._worker = _bin_phasors(histogram)
+        self._worker.yielded.connect(self._tiles_binned)
+        self._worker.returned.connect(lambda histogram: self._phasors_binned(layer, histogram))
+        self._worker.finished.connect(self._compute_finished)
+        self._worker.start()
+        self._set_compute_button()
+
+
+    def _tiles_binned(self, progress):
+        done, total = progress
+        self._progress.setValue(int(100 * done / total))
+
+
+    def _phasors_binned(self, layer, histogram):
+        """Shows the log density of the new histogram"""
+        self._histogram = histogram
+        self._layer = layer
+        density = np.log1p(histogram.counts).astype(np.float32)
+        density[histogram.counts == 0] = np.nan
+        if self._image is None:
+            self._image = self._axes.imshow(
+                density,
+                origin='lower',
+                extent=_phasor.PHASOR_RANGE * 2,
+                interpolation='nearest'
+            )
+        else:
+            self._image.set_data(density)
+            self._image.set_clim(0, np.nanmax(density) if histogram.counts.any() else 1)
+        self._canvas.draw()
+
+
+    def _compute_finished(self):
+        self._worker = None
+        self._set_compute_button()
+
+
+    def _phasors_selected(self, vertices):
+        """Adds or updates a Labels layer of the pixels whose phasors lie in the lasso"""
+        if self._histogram is None or len(vertices) < 3:
+            return
+        g, s = self._histogram.bin_centers()
+        inside = Path(vertices).contains_points(np.column_stack([g.ravel(), s.ravel()]))
+        mask = self._histogram.select(inside.reshape(g.shape)).astype(np.uint8)
+
+        # place the mask like the image, without its channel axis
+        layer = self._layer
+        channel_axis = self._histogram.channel_axis
+        name = '%s phasor selection' % layer.name
+        if name in self.viewer.layers:
+            self.viewer.layers[name].data = mask
+        else:
+            self.viewer.add_labels(
+                mask,
+                name=name,
+                scale=np.delete(layer.scale, channel_axis),
+                translate=np.delete(layer.translate, channel_axis)
+            )
+
+
+    def _theme_changed(self):
+        """Updates plot for new color theme"""
+        theme = get_theme(self.viewer.theme, False)
+        self._axes.tick_params(axis='both', colors=theme.text.as_hex())
+        self._axes.xaxis.label.set_color(theme.text.as_hex())
+        self._axes.yaxis.label.set_color(theme.text.as_hex())
+        self._axes.spines['left'].set_color(theme.text.as_hex())
+        self._axes.spines['bottom'].set_color(theme.text.as_hex())
+        self._circle.set_edgecolor(theme.text.as_hex())
+        self._canvas.draw()
@@ -0,0 +1,490 @@
+import itertools
+import mmap
+import tempfile
+import threading
+import warnings
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from multiprocessing import shared_memory
+import numpy as np
+
+from . import _profiling
+from ._solvers import make_solver
+
+# number of pixel spectra solved together in a single block
+DEFAULT_BLOCK_SIZE = 16384
+
+# extent of a tile along each of the two innermost spatial axes
+DEFAULT_TILE_SIZE = 512
+
+# per-pixel summary images that unmixing can fill in the same pass, see summarize_block
+SUMMARIES = ('intensity', 'lambda max', 'rmse')
+
+# largest finite float16, larger abundances written to float16 outputs become inf
+FLOAT16_MAX = float(np.finfo(np.float16).max)
+
+
+def default_tile_shape(data, channel_axis, tile_size=DEFAULT_TILE_SIZE):
+    """Picks a tile shape that follows the storage chunks of data if it has any
+
+    Tiles always span the whole channel axis. Without storage chunks, leading
+    spatial axes (e.g. Z or T) are tiled one plane at a time and the two
+    innermost spatial axes in tile_size squares.
+    """
+    ndim = len(data.shape)
+    channel_axis = channel_axis % ndim
+    chunks = getattr(data, 'chunks', None)
+    spatial = [a for a in range(ndim) if a != channel_axis]
+
+    tile_shape = []
+    for a in range(ndim):
+        if a == channel_axis:
+            tile_shape.append(data.shape[a])
+        elif chunks is not None:
+            # dask stores a tuple of chunk sizes per axis, zarr a single size
+            c = chunks[a]
+            tile_shape.append(max(c) if isinstance(c, tuple) else c)
+        elif a in spatial[-2:]:
+            tile_shape.append(tile_size)
+        else:
+            tile_shape.append(1)
+
+    return tuple(tile_shape)
+
+
+def iter_tiles(shape, tile_shape, channel_axis):
+    """Yields index tuples that cover shape tile by tile, keeping channels whole"""
+    ndim = len(shape)
+    channel_axis = channel_axis % ndim
+    ranges = []
+    for a in range(ndim):
+        if a == channel_axis:
+            ranges.append([slice(None)])
+        else:
+            step = max(1, tile_shape[a])
+            ranges.append([slice(i, min(i + step, shape[a])) for i in range(0, shape[a], step)])
+
+    yield from itertools.product(*ranges)
+
+
+class TileScheduler():
+    """Hands out tiles closest to a focus region first
+
+    Tiles are ordered by their distance from the focus along slice axes (e.g.
+    Z or T) first, then along the remaining spatial axes. The focus can be
+    moved while tiles are being handed out, for example to follow the viewer,
+    without restarting the run. Iteration is thread safe.
+    """
+
+    def __init__(self, tiles, shape, channel_axis):
+        self._tiles = list(tiles)
+        self._channel_axis = channel_axis % len(shape)
+
+        # bounds of every tile along every axis
+        ndim = len(shape)
+        self._starts = np.array([[s.start or 0 for s in t] for t in self._tiles]).reshape(-1, ndim)
+        self._stops = np.array([[n if s.stop is None else s.stop for s, n in zip(t, shape)]
+                                for t in self._tiles]).reshape(-1, ndim)
+
+        self._pending = np.ones(len(self._tiles), dtype=bool)
+        self._order = np.arange(len(self._tiles))
+        self._next = 0
+        self._lock = threading.Lock()
+
+
+    def __len__(self):
+        return len(self._tiles)
+
+
+    def __iter__(self):
+        while True:
+            with self._lock:
+                while self._next < len(self._order) and not self._pending[self._order[self._next]]:
+                    self._next += 1
+                if self._next == len(self._order):
+                    return
+                i = self._order[self._next]
+                self._pending[i] = False
+            yield self._tiles[i]
+
+
+    def focus(self, region, slice_axes=()):
+        """Prioritizes tiles near region, a (start, stop) pair for every axis"""
+        region = np.asarray(region, dtype=float).reshape(-1, 2)
+        gap = np.maximum(0, np.maximum(
+            region[:, 0] - self._stops + 1,
+            self._starts - region[:, 1] + 1
+        ))
+        gap[:, self._channel_axis] = 0
+        off_slice = gap[:, list(slice_axes)].sum(axis=1)
+        spatial = np.delete(gap, list(slice_axes) + [self._channel_axis], axis=1)
+        distance = np.sqrt((spatial ** 2).sum(axis=1))
+
+        order = np.lexsort((distance, off_slice))
+        with self._lock:
+            self._order = order
+            self._next = 0
+
+
+def output_shape(shape, channel_axis, nendmembers):
+    """Returns the abundance image shape for a spectral image shape"""
+    shape = list(shape)
+    shape[channel_axis] = nendmembers
+    return tuple(shape)
+
+
+def allocate_output(shape, dtype=np.float64, on_disk=False):
+    """Allocates an abundance image in memory or in an anonymous temporary file"""
+    if on_disk:
+        return np.memmap(tempfile.TemporaryFile(), dtype=dtype, mode='w+', shape=shape)
+    return np.zeros(shape, dtype=dtype)
+
+
+def allocate_summaries(shape, channel_axis, names=SUMMARIES, on_disk=False):
+    """Allocates one summary image per name for a spectral image shape"""
+    shape = tuple(n for a, n in enumerate(shape) if a != channel_axis % len(shape))
+    return {name: allocate_output(shape, on_disk=on_disk) for name in names}
+
+
+def unmix(data, endmembers, channel_axis=0, solver=None, block_size=DEFAULT_BLOCK_SIZE,
+          tile_shape=None, out=None, workers=1, executor='thread', mode='nnls',
+          summaries=None, wavelengths=None, dtype=np.float64):
+    """Unmixes a spectral image into endmember abundances
+
+    endmembers is a (channels, endmembers) matrix. The abundance image has the
+    same shape as data, with the channel axis replaced by the endmember axis.
+    data is read one tile at a time, so it may be any sliceable array (NumPy,
+    dask, zarr, memmap). Tiles are written into out, which may be any array
+    supporting slice assignment, e.g. a memmap or zarr array (see _writer).
+    Without out, abundances are stored as dtype. Peak memory depends on the
+    tile shape rather than the image size.
+
+    Tiles are distributed over workers threads or processes, see iter_unmix.
+    Without a solver, one is made for mode (see _solvers.SOLVERS). Summary
+    images in summaries (see allocate_summaries) are filled from the same
+    tiles.
+    """
+    channel_axis = channel_axis % data.ndim
+    if solver is None:
+        solver = make_solver(mode, endmembers)
+    if tile_shape is None:
+        tile_shape = default_tile_shape(data, channel_axis)
+    if out is None:
+        shape = output_shape(data.shape, channel_axis, solver.nendmembers)
+        out = allocate_output(shape, dtype, on_disk=not isinstance(data, np.ndarray))
+
+    tiles = iter_tiles(data.shape, tile_shape, channel_axis)
+    for _ in iter_unmix(data, solver, out, channel_axis, tiles, block_size, workers, executor,
+                        summaries, wavelengths):
+        pass
+
+    return out
+
+
+def iter_unmix(data, solver, out, channel_axis=0, tiles=None, block_size=DEFAULT_BLOCK_SIZE,
+               workers=1, executor='thread', summaries=None, wavelengths=None, maxima=False):
+    """Unmixes tiles of data into out, yielding the index of each finished tile
+
+    With more than one worker, tiles are solved by a 'thread' or 'process'
+    pool. Threads share data and out directly. Processes attach to NumPy
+    arrays through shared memory and to file-backed memmaps by file name, so
+    pixel data is never pickled; other arrays (e.g. zarr) are opened once per
+    process. With processes, consider limiting BLAS threads (for example
+    OMP_NUM_THREADS=1) to avoid oversubscribing cores.
+
+    summaries maps names in SUMMARIES to images with the shape of data
+    without its channel axis, which are written like out.
+
+    With maxima, (index, maxima) pairs are yielded instead, where maxima
+    holds the largest abundance of every endmember in the tile followed by
+    the largest value of every summary, computed by the worker that solved
+    the tile so out is never read back.
+    """
+    channel_axis = channel_axis % data.ndim
+    if tiles is None:
+        tiles = iter_tiles(data.shape, default_tile_shape(data, channel_axis), channel_axis)
+    summaries = summaries or {}
+
+    if workers <= 1:
+        for index in tiles:
+            X = unmix_tile(data, index, solver, channel_axis, block_size, summaries, wavelengths)
+            _write_tile(out, index, X, channel_axis)
+            yield (index, tile_maxima(X, index, channel_axis, summaries)) if maxima else index
+    elif executor == 'thread':
+        yield from _iter_unmix_threads(data, solver, out, channel_axis, tiles, block_size, workers,
+                                       summaries, wavelengths, maxima)
+    elif executor == 'process':
+        yield from _iter_unmix_processes(data, solver, out, channel_axis, tiles, block_size, workers,
+                                         summaries, wavelengths, maxima)
+    else:
+        raise ValueError("executor must be 'thread' or 'process', got %r" % executor)
+
+
+def tile_maxima(X, index, channel_axis, summaries=None):
+    """Returns the largest value of every endmember of an unmixed tile, then of every summary"""
+    X = np.moveaxis(np.asarray(X), channel_axis, 0)
+    values = list(X.reshape(X.shape[0], -1).max(axis=1, initial=0))
+    spatial_index = _spatial_index(index, channel_axis)
+    for summary in (summaries or {}).values():
+        values.append(np.max(summary[spatial_index], initial=0))
+    return np.array(values, dtype=np.float64)
+
+
+def _spatial_index(index, channel_axis):
+    """Returns a tile index without its channel axis, which may be negative"""
+    channel_axis = channel_axis % len(index)
+    return index[:channel_axis] + index[channel_axis + 1:]
+
+
+def _write_tile(out, index, X, channel_axis):
+    """Writes an unmixed tile into out as the 'unmix.write' stage"""
+    _check_range(out, X)
+    with _profiling.stage('unmix.write', X.size // max(X.shape[channel_axis], 1), X.nbytes):
+        out[index] = X
+
+
+def _check_range(out, X):
+    """Warns when abundances exceed the range of a float16 output"""
+    if np.dtype(out.dtype) == np.float16:
+        peak = float(np.max(X, initial=0))
+        if peak > FLOAT16_MAX:
+            warnings.warn(
+                'abundances up to %g exceed the float16 range and are stored as inf, '
+                'use float32 or the fully constrained solver' % peak,
+                RuntimeWarning
+            )
+
+
+def _iter_completed(pool, fn, tiles, max_pending):
+    """Submits tiles to pool as earlier ones finish, yielding results as they complete
+
+    Tiles are pulled from the iterable only when a slot frees up, so a
+    TileScheduler can still reorder the tiles that have not been submitted.
+    """
+    tiles = iter(tiles)
+    pending = set()
+    try:
+        while True:
+            for index in itertools.islice(tiles, max_pending - len(pending)):
+                pending.add(pool.submit(fn, index))
+            if not pending:
+                return
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def _iter_unmix_threads(data, solver, out, channel_axis, tiles, block_size, workers,
+                        summaries, wavelengths, maxima=False):
+    """Solves tiles in a thread pool that writes straight into out"""
+    def work(index):
+        X = unmix_tile(data, index, solver, channel_axis, block_size, summaries, wavelengths)
+        _write_tile(out, index, X, channel_axis)
+        return (index, tile_maxima(X, index, channel_axis, summaries)) if maxima else index
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        yield from _iter_completed(pool, work, tiles, 2 * workers)
+
+
+def _iter_unmix_processes(data, solver, out, channel_axis, tiles, block_size, workers,
+                          summaries, wavelengths, maxima=False):
+    """Solves tiles in a process pool attached to shared input and output buffers"""
+    handles = []
+    try:
+        data_spec, _ = _share(data, handles, mode='r')
+        out_spec, shared_out = _share(out, handles, mode='r+')
+        summary_specs, shared_summaries = {}, {}
+        for name, summary in summaries.items():
+            summary_specs[name], shared_summaries[name] = _share(summary, handles, mode='r+')
+        initargs = (data_spec, out_spec, solver, channel_axis, block_size,
+                    summary_specs, wavelengths)
+        with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=initargs) as pool:
+            for index, values in _iter_completed(pool, _unmix_tile_worker, tiles, 2 * workers):
+                # copy back tiles that were written to a temporary shared buffer
+                if shared_out is not out:
+                    _write_tile(out, index, shared_out[index], channel_axis)
+                spatial_index = _spatial_index(index, channel_axis)
+                for name, summary in summaries.items():
+                    if shared_summaries[name] is not summary:
+                        summary[spatial_index] = shared_summaries[name][spatial_index]
+                yield (index, values) if maxima else index
+    finally:
+        shared_out = None
+        shared_summaries = None
+        for shm in handles:
+            shm.close()
+            shm.unlink()
+
+
+def _share(array, handles, mode):
+    """Describes how worker processes can attach to array without pickling its data
+
+    Returns the description and the array that workers will write to, which
+    is a shared copy for in-memory arrays opened with mode 'r+'.
+    """
+    if isinstance(array, np.memmap) and isinstance(array.base, mmap.mmap) \
+            and array.filename and array.flags.c_contiguous:
+        return ('memmap', array.filename, array.offset, array.shape, array.dtype.str, mode), array
+
+    if isinstance(array, np.ndarray):
+        shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        handles.append(shm)
+        view = np.ndarray(array.shape, array.dtype, buffer=shm.buf)
+        if mode == 'r':
+            view[...] = array
+        return ('shm', shm.name, array.shape, array.dtype.str), view
+
+    return ('object', array), array
+
+
+def _attach(spec, handles):
+    """Opens an array described by _share"""
+    if spec[0] == 'memmap':
+        _, filename, offset, shape, dtype, mode = spec
+        return np.memmap(filename, dtype=dtype, mode=mode, shape=shape, offset=offset)
+
+    if spec[0] == 'shm':
+        _, name, shape, dtype = spec
+        shm = shared_memory.SharedMemory(name=name)
+        handles.append(shm)
+        return np.ndarray(shape, dtype, buffer=shm.buf)
+
+    return spec[1]
+
+
+# per-process state of pool workers, set once by _init_worker
+_worker = {}
+
+
+def _init_worker(data_spec, out_spec, solver, channel_axis, block_size, summary_specs, wavelengths):
+    # a profiler copied into a forked process would record into a copy nobody reads
+    _profiling.activate(None)
+    handles = []
+    _worker.update({
+        'data': _attach(data_spec, handles),
+        'out': _attach(out_spec, handles),
+        'solver': solver,
+        'channel_axis': channel_axis,
+        'block_size': block_size,
+        'summaries': {name: _attach(spec, handles) for name, spec in summary_specs.items()},
+        'wavelengths': wavelengths,
+        'handles': handles
+    })
+
+
+def _unmix_tile_worker(index):
+    w = _worker
+    X = unmix_tile(w['data'], index, w['solver'], w['channel_axis'], w['block_size'],
+                   w['summaries'], w['wavelengths'])
+    _check_range(w['out'], X)
+    w['out'][index] = X
+    return index, tile_maxima(X, index, w['channel_axis'], w['summaries'])
+
+
+def unmix_lazy(data, endmembers, channel_axis=0, solver=None, block_size=DEFAULT_BLOCK_SIZE,
+               mode='nnls'):
+    """Returns a lazy dask array of abundances, computed chunk by chunk on access"""
+    import dask.array as da
+
+    if solver is None:
+        solver = make_solver(mode, endmembers)
+
+    # each chunk needs complete spectra
+    data = da.asarray(data).rechunk({channel_axis: -1})
+    chunks = list(data.chunks)
+    chunks[channel_axis] = (solver.nendmembers,)
+
+    return data.map_blocks(
+        unmix_block,
+        solver=solver,
+        channel_axis=channel_axis,
+        block_size=block_size,
+        chunks=tuple(chunks),
+        dtype=np.float64
+    )
+
+
+def unmix_tile(data, index, solver, channel_axis=0, block_size=DEFAULT_BLOCK_SIZE,
+               summaries=None, wavelengths=None):
+    """Reads one tile of data into memory and unmixes it
+
+    The tile's part of every summary image in summaries is written as well.
+    """
+    with _profiling.stage('unmix.read') as stage:
+        B = np.asarray(data[index])
+        stage.add(B.size // max(B.shape[channel_axis], 1), B.nbytes)
+
+    if not summaries:
+        return unmix_block(B, solver, channel_axis, block_size)
+
+    tile = dict.fromkeys(summaries)
+    X = unmix_block(B, solver, channel_axis, block_size, tile, wavelengths)
+    spatial_index = _spatial_index(index, channel_axis)
+    for name, summary in summaries.items():
+        summary[spatial_index] = tile[name]
+    return X
+
+
+def unmix_block(B, solver, channel_axis=0, block_size=DEFAULT_BLOCK_SIZE, summaries=None,
+                wavelengths=None):
+    """Unmixes an in-memory spectral array
+
+    Given a summaries dict, the summary images of B (see summarize_block) are
+    computed from the same pixel blocks and stored in it by name. Names
+    already in the dict select which summaries are kept, all by default.
+    """
+    with _profiling.stage('unmix.copy') as stage:
+        B = np.moveaxis(np.asarray(B), channel_axis, -1)
+        spatial_shape = B.shape[:-1]
+        B = B.reshape(-1, B.shape[-1])
+        stage.add(B.shape[0], B.nbytes)
+    if summaries is not None:
+        names = list(summaries or SUMMARIES)
+        flat = {name: np.empty(B.shape[0]) for name in names}
+
+    # solve blocks of pixels at once, spectra are columns for the solver
+    X = np.empty((B.shape[0], solver.nendmembers))
+    for start in range(0, B.shape[0], block_size):
+        block = slice(start, start + block_size)
+        spectra = B[block].T
+        with _profiling.stage('unmix.solve', spectra.shape[1]):
+            abundances = solver.solve(spectra)
+        X[block] = abundances.T
+        if summaries is not None:
+            with _profiling.stage('unmix.summaries', spectra.shape[1]):
+                summary = summarize_block(spectra, abundances, solver, names, wavelengths)
+            for name, values in summary.items():
+                flat[name][block] = values
+
+    if summaries is not None:
+        summaries.clear()
+        summaries.update({name: values.reshape(spatial_shape) for name, values in flat.items()})
+
+    X = X.reshape(spatial_shape + (solver.nendmembers,))
+    return np.moveaxis(X, -1, channel_axis)
+
+
+def summarize_block(B, X, solver, names=SUMMARIES, wavelengths=None):
+    """Computes per pixel summaries of (channels, pixels) spectra B unmixed into X
+
+    'intensity' is the integrated intensity, 'lambda max' the wavelength (or
+    channel index without wavelengths) of the brightest channel and 'rmse'
+    the root mean square residual of the spectra modeled from X, so the fit
+    quality needs no second pass over the data. Coefficients solved by a
+    ReducedSolver are expanded to spectra first.
+    """
+    if hasattr(solver, 'expand'):
+        B = solver.expand(B)
+    B = np.asarray(B, dtype=np.float64)
+    summary = {}
+    if 'intensity' in names:
+        summary['intensity'] = B.sum(axis=0)
+    if 'lambda max' in names:
+        peak = np.argmax(B, axis=0)
+        summary['lambda max'] = peak if wavelengths is None else np.asarray(wavelengths)[peak]
+    if 'rmse' in names:
+        residual = B - solver.reconstruct(X, B)
+        summary['rmse'] = np.sqrt(np.mean(residual**2, axis=0))
+    return summary
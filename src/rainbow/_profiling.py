@@ -0,0 +1,219 @@
+import json
+import os
+import platform
+import threading
+import time
+import tracemalloc
+from collections import OrderedDict
+import numpy as np
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+# the profiler that instrumented stages record into, see activate
+_active = None
+
+
+class Profiler():
+    """Accumulates wall time, pixels, bytes and peak allocation per named stage
+
+    While a profiler is active (with profiler: ... or activate), the
+    instrumented stages of rainbow record into it from any thread, e.g.
+    'unmix.read', 'unmix.solve' or 'inspect.fetch'. Callbacks added with
+    connect are called with the stage name and the seconds, pixels, bytes
+    (read, copied or written, depending on the stage) and peak bytes of
+    every pass, from the thread that ran it.
+
+    With trace_memory, peak allocations are measured with tracemalloc, which
+    slows down allocation-heavy code. Peaks are per pass and exact with one
+    worker; with several, passes running at the same time share one peak.
+    Process workers do not record; the parent still records 'unmix.write'.
+    """
+
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.stages = OrderedDict()
+        self.callbacks = []
+        self.started = None
+        self.stopped = None
+        self._lock = threading.Lock()
+        self._previous = None
+        self._tracing = False
+
+
+    def __enter__(self):
+        self.start()
+        return self
+
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+    def start(self):
+        """Makes this the active profiler, tracing memory if requested"""
+        global _active
+        self._previous = _active
+        _active = self
+        self.started = time.perf_counter()
+        self.stopped = None
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._tracing = True
+
+
+    def stop(self):
+        """Restores the previously active profiler"""
+        global _active
+        if _active is self:
+            _active = self._previous
+        self.stopped = time.perf_counter()
+        if self._tracing:
+            tracemalloc.stop()
+            self._tracing = False
+
+
+    def connect(self, callback):
+        """Calls callback(name, seconds, pixels, nbytes, peak) after every pass of a stage"""
+        self.callbacks.append(callback)
+
+
+    def record(self, name, seconds, pixels=0, nbytes=0, peak=0):
+        """Adds one pass through a stage"""
+        with self._lock:
+            stage = self.stages.get(name)
+            if stage is None:
+                stage = self.stages[name] = {'calls': 0, 'seconds': 0.0, 'pixels': 0,
+                                             'bytes': 0, 'peak_bytes': 0}
+            stage['calls'] += 1
+            stage['seconds'] += seconds
+            stage['pixels'] += int(pixels)
+            stage['bytes'] += int(nbytes)
+            stage['peak_bytes'] = max(stage['peak_bytes'], int(peak))
+        for callback in self.callbacks:
+            callback(name, seconds, pixels, nbytes, peak)
+
+
+    def reset(self):
+        with self._lock:
+            self.stages.clear()
+
+
+    def report(self):
+        """Returns totals and rates of every stage with run and machine details as a dict"""
+        end = time.perf_counter() if self.stopped is None else self.stopped
+        with self._lock:
+            stages = OrderedDict((name, dict(stage)) for name, stage in self.stages.items())
+        for stage in stages.values():
+            seconds = stage['seconds']
+            stage['pixels_per_second'] = stage['pixels'] / seconds if seconds > 0 else None
+            stage['bytes_per_second'] = stage['bytes'] / seconds if seconds > 0 else None
+
+        return {
+            'wall_seconds': None if self.started is None else end - self.started,
+            'peak_rss_bytes': peak_rss(),
+            'trace_memory': self.trace_memory,
+            'machine': {
+                'node': platform.node(),
+                'platform': platform.platform(),
+                'processor': platform.processor(),
+                'cpu_count': os.cpu_count(),
+                'python': platform.python_version(),
+                'numpy': np.__version__
+            },
+            'stages': stages
+        }
+
+
+    def dump(self, path):
+        """Writes the report as JSON, e.g. to compare runs across machines"""
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+
+
+class Stage():
+    """Times one pass through a stage of the active profiler, if there is one
+
+    Pixels and bytes known only inside the stage can be added with add.
+    """
+
+    def __init__(self, profiler, name, pixels=0, nbytes=0):
+        self.profiler = profiler
+        self.name = name
+        self.pixels = pixels
+        self.nbytes = nbytes
+
+
+    def add(self, pixels=0, nbytes=0):
+        self.pixels += pixels
+        self.nbytes += nbytes
+
+
+    def __enter__(self):
+        if self.profiler is not None:
+            self._memory = None
+            if self.profiler.trace_memory and tracemalloc.is_tracing():
+                self._memory = tracemalloc.get_traced_memory()[0]
+                if hasattr(tracemalloc, 'reset_peak'):
+                    tracemalloc.reset_peak()
+            self._start = time.perf_counter()
+        return self
+
+
+    def __exit__(self, *exc):
+        if self.profiler is not None:
+            seconds = time.perf_counter() - self._start
+            peak = 0
+            if self._memory is not None and tracemalloc.is_tracing():
+                peak = max(tracemalloc.get_traced_memory()[1] - self._memory, 0)
+            self.profiler.record(self.name, seconds, self.pixels, self.nbytes, peak)
+
+
+def active():
+    """Returns the active profiler or None"""
+    return _active
+
+
+def activate(profiler):
+    """Makes profiler (or None) the one that stages record into, returning the previous one"""
+    global _active
+    previous, _active = _active, profiler
+    return previous
+
+
+def stage(name, pixels=0, nbytes=0):
+    """Returns a context manager recording a pass through a stage of the active profiler
+
+    Without an active profiler, entering and leaving it does nothing.
+    """
+    return Stage(_active, name, pixels, nbytes)
+
+
+def peak_rss():
+    """Returns the peak resident memory of this process in bytes, or None if unknown"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if platform.system() == 'Darwin' else peak * 1024
+
+
+def format_report(report):
+    """Formats the stages of a report as a text table"""
+    lines = ['%-18s %7s %10s %12s %14s %10s' % ('stage', 'calls', 'time (s)', 'pixels/s',
+                                               'MB', 'peak MB')]
+    for name, stage in report['stages'].items():
+        rate = stage['pixels_per_second']
+        lines.append('%-18s %7d %10.3f %12s %14.1f %10.1f' % (
+            name, stage['calls'], stage['seconds'],
+            '-' if not rate else '%.0f' % rate,
+            stage['bytes'] / 1024**2, stage['peak_bytes'] / 1024**2
+        ))
+    if report['wall_seconds'] is not None:
+        lines.append('wall time %.3f s' % report['wall_seconds'])
+    if report['peak_rss_bytes'] is not None:
+        lines.append('peak resident memory %.1f MB' % (report['peak_rss_bytes'] / 1024**2))
+    return '\n'.join(lines)
@@ -0,0 +1,176 @@
+import os
+import re
+import xml.etree.ElementTree as ET
+import numpy as np
+
+# file name endings handled by the reader
+TIFF_EXTENSIONS = ('.tif', '.tiff')
+ZARR_EXTENSIONS = ('.zarr',)
+
+# axis letters that may hold spectral channels, in order of preference
+CHANNEL_AXES = 'CSLEQ'
+
+# range of plausible wavelengths in nm, other numbers in channel labels are not wavelengths
+MIN_WAVELENGTH = 200
+MAX_WAVELENGTH = 2000
+
+# emission wavelength units converted to nm
+NM_PER_UNIT = {'nm': 1.0, 'um': 1e3, 'µm': 1e3, 'pm': 1e-3, 'Å': 0.1, 'm': 1e9}
+
+
+def napari_get_reader(path):
+    """Returns a reader for spectral TIFF/OME-TIFF files and OME-Zarr stores, or None"""
+    if isinstance(path, list):
+        if len(path) != 1:
+            return None
+        path = path[0]
+    path = str(path)
+
+    if path.lower().endswith(TIFF_EXTENSIONS):
+        return read_tiff
+    if path.rstrip('/\\').lower().endswith(ZARR_EXTENSIONS) or \
+            os.path.isfile(os.path.join(path, '.zattrs')) or os.path.isfile(os.path.join(path, 'zarr.json')):
+        return read_zarr
+    return None
+
+
+def read_tiff(path):
+    """Opens a TIFF or OME-TIFF file without reading pixel data
+
+    Contiguous images are memory-mapped, others (e.g. compressed or tiled)
+    are opened as lazy zarr arrays, one per pyramid level. Emission
+    wavelengths come from OME channels or Zeiss LSM lambda metadata.
+    """
+    import tifffile
+
+    path = path[0] if isinstance(path, list) else path
+    tif = tifffile.TiffFile(path)
+    series = tif.series[0]
+    axes = _file_axes(series.axes, len(series.shape))
+    c = _channel_axis(axes)
+    wavelengths = _tiff_wavelengths(tif, 0 if c is None else series.shape[c])
+
+    multiscale = len(series.levels) > 1
+    if not multiscale and series.dataoffset is not None:
+        tif.close()
+        data = tifffile.memmap(path, series=0, mode='r')
+    else:
+        # the zarr store keeps the file open for lazy reads
+        import zarr
+        group = zarr.open(series.aszarr(), mode='r')
+        data = [group[str(i)] for i in range(len(series.levels))] if multiscale else group
+
+    name = os.path.basename(str(path)).split('.')[0]
+    return [_layer_data(data, name, axes, c, wavelengths, multiscale)]
+
+
+def read_zarr(path):
+    """Opens an OME-Zarr image as lazy zarr arrays, one per pyramid level
+
+    Channel wavelengths are parsed from omero channel labels such as '520 nm'.
+    """
+    import zarr
+
+    path = path[0] if isinstance(path, list) else path
+    group = zarr.open(str(path), mode='r')
+    attrs = dict(group.attrs)
+    attrs = attrs.get('ome', attrs)
+    multiscales = attrs['multiscales'][0]
+
+    # axes are a list of dicts (v0.4) or of names (v0.3), default TCZYX
+    axes = multiscales.get('axes', ['t', 'c', 'z', 'y', 'x'])
+    axes = ''.join((a['name'] if isinstance(a, dict) else a)[0] for a in axes)
+
+    levels = [group[d['path']] for d in multiscales['datasets']]
+    axes = _file_axes(axes, levels[0].ndim)
+    c = _channel_axis(axes)
+    labels = [ch.get('label', '') for ch in attrs.get('omero', {}).get('channels', [])]
+    wavelengths = _parse_wavelengths(labels, 0 if c is None else levels[0].shape[c])
+
+    name = os.path.basename(str(path).rstrip('/\\')).split('.')[0]
+    multiscale = len(levels) > 1
+    return [_layer_data(levels if multiscale else levels[0], name, axes, c, wavelengths, multiscale)]
+
+
+def _file_axes(axes, ndim):
+    """Returns one upper case letter per dimension, padding unknown leading axes with Q"""
+    return axes.upper()[-ndim:].rjust(ndim, 'Q')
+
+
+def _channel_axis(axes):
+    """Returns the index of the spectral axis among file axes, or None"""
+    return next((axes.find(a) for a in CHANNEL_AXES if a in axes), None)
+
+
+def _layer_data(data, name, axes, c, wavelengths, multiscale):
+    """Builds a napari layer data tuple with rainbow metadata from file axes and the spectral axis c"""
+    shape = data[0].shape if multiscale else data.shape
+
+    def index(letter):
+        i = axes.find(letter)
+        return None if i < 0 else i
+
+    # without spectral or spatial axes, axes are inferred from the view like for other layers
+    rainbow = {'file_axes': axes}
+    if c is None or index('X') is None or index('Y') is None:
+        return (data, {'name': name, 'multiscale': multiscale, 'metadata': {'rainbow': rainbow}}, 'image')
+
+    # z is the third displayed axis in 3D views (see _metadata), not the file's Z axis
+    rainbow.update({
+        'axes': {
+            'x': {'index': index('X')},
+            'y': {'index': index('Y')},
+            'z': {'index': None},
+            'c': {'index': c}
+        }
+    })
+    for a in rainbow['axes'].values():
+        a['extent'] = 1 if a['index'] is None else shape[a['index']]
+
+    nchannels = rainbow['axes']['c']['extent']
+    if wavelengths is not None and len(wavelengths) == nchannels:
+        rainbow['wavelengths'] = [float(w) for w in wavelengths]
+        rainbow['units'] = 'nm'
+    else:
+        rainbow['wavelengths'] = list(range(nchannels))
+        rainbow['units'] = 'ch'
+
+    return (data, {'name': name, 'multiscale': multiscale, 'metadata': {'rainbow': rainbow}}, 'image')
+
+
+def _tiff_wavelengths(tif, nchannels):
+    """Returns emission wavelengths in nm from OME or LSM metadata, or None"""
+    if tif.is_ome:
+        root = ET.fromstring(tif.ome_metadata)
+        channels = [e for e in root.iter() if e.tag.endswith('}Channel')]
+        emission = [c.get('EmissionWavelength') for c in channels]
+        if channels and all(emission):
+            units = [NM_PER_UNIT.get(c.get('EmissionWavelengthUnit', 'nm'), 1.0) for c in channels]
+            return [float(w) * u for w, u in zip(emission, units)][:nchannels]
+        return _parse_wavelengths([c.get('Name', '') for c in channels], nchannels)
+
+    if tif.is_lsm:
+        # lambda mode stores the (start, end) of each detection band, usually in m
+        bands = tif.lsm_metadata.get('ChannelWavelength')
+        if bands is not None and len(bands) == nchannels:
+            centers = np.asarray(bands, dtype=np.float64).reshape(-1, 2).mean(axis=1)
+            return list(centers * 1e9 if centers.max() < 1e-3 else centers)
+
+    if tif.is_imagej:
+        labels = tif.imagej_metadata.get('Labels') or []
+        return _parse_wavelengths(labels, nchannels)
+
+    return None
+
+
+def _parse_wavelengths(labels, nchannels):
+    """Parses wavelengths from channel labels like '520 nm' or '520', or returns None"""
+    if not nchannels or len(labels) < nchannels:
+        return None
+    wavelengths = []
+    for label in labels[:nchannels]:
+        match = re.search(r'\d+(?:\.\d+)?', str(label))
+        if match is None or not MIN_WAVELENGTH <= float(match.group()) <= MAX_WAVELENGTH:
+            return None
+        wavelengths.append(float(match.group()))
+    return wavelengths if len(set(wavelengths)) == nchannels else None
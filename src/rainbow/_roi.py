@@ -0,0 +1,159 @@
+from collections import namedtuple
+import numpy as np
+
+from ._pipeline import default_tile_shape, iter_tiles
+
+# statistics computed for every region, see region_spectra
+STATISTICS = ('mean', 'median', 'std')
+
+RegionSpectra = namedtuple('RegionSpectra', ['labels', 'counts', 'mean', 'median', 'std'])
+
+
+def region_spectra(data, labels, channel_axis=0, tile_shape=None, median=True):
+    """Computes mean, median and standard deviation spectra of every labeled region
+
+    labels is an integer image with the spatial shape of data (data without
+    its channel axis), or trailing axes of it, e.g. a 2-D mask applied to
+    every plane of a Z stack. Pixels labeled zero or less are background.
+
+    Spectra are accumulated with grouped bincount reductions, one tile of
+    data at a time, so data may be lazy and tiles without labeled pixels are
+    never read. For the median, labeled pixel spectra are gathered into one
+    buffer grouped by region, which needs memory for every labeled pixel;
+    pass median=False to skip it.
+
+    Returns a RegionSpectra tuple of label ids, pixel counts and
+    (regions, channels) matrices, with median set to None if not computed.
+    """
+    ndim = len(data.shape)
+    channel_axis = channel_axis % ndim
+    nchannels = data.shape[channel_axis]
+    spatial_shape = tuple(n for a, n in enumerate(data.shape) if a != channel_axis)
+    if tuple(labels.shape) != spatial_shape:
+        labels = np.broadcast_to(np.asarray(labels), spatial_shape)
+
+    if tile_shape is None:
+        tile_shape = default_tile_shape(data, channel_axis)
+    tiles = [(index, index[:channel_axis] + index[channel_axis + 1:])
+             for index in iter_tiles(data.shape, tile_shape, channel_axis)]
+
+    # label ids and pixel counts, from the labels alone
+    found = [np.unique(_tile_labels(labels, lindex), return_counts=True) for _, lindex in tiles]
+    ids, inverse = np.unique(np.concatenate([u for u, _ in found] + [[]]).astype(np.int64),
+                             return_inverse=True)
+    counts = np.bincount(inverse, weights=np.concatenate([c for _, c in found] + [[]]),
+                         minlength=len(ids)).astype(np.int64)
+    nregions = len(ids)
+
+    sums = np.zeros(nchannels * nregions)
+    squares = np.zeros(nchannels * nregions)
+    if median:
+        buffer = np.empty((counts.sum(), nchannels), dtype=data.dtype)
+        offsets = np.cumsum(counts) - counts
+        filled = offsets.copy()
+
+    channel_offsets = np.arange(nchannels)[:, np.newaxis] * nregions
+    for index, lindex in tiles:
+        lab = np.asarray(labels[lindex]).ravel()
+        keep = lab > 0
+        if not keep.any():
+            continue
+
+        B = np.moveaxis(np.asarray(data[index]), channel_axis, 0).reshape(nchannels, -1)[:, keep]
+        k = np.searchsorted(ids, lab[keep])
+
+        # one bincount per statistic covers all channels and regions
+        bins = (channel_offsets + k).ravel()
+        values = B.ravel().astype(np.float64)
+        sums += np.bincount(bins, weights=values, minlength=sums.size)
+        squares += np.bincount(bins, weights=values * values, minlength=squares.size)
+
+        if median:
+            # append each region's pixels after those gathered from earlier tiles
+            order = np.argsort(k, kind='stable')
+            k = k[order]
+            tile_counts = np.bincount(k, minlength=nregions)
+            rank = np.arange(len(k)) - (np.cumsum(tile_counts) - tile_counts)[k]
+            buffer[filled[k] + rank] = B[:, order].T
+            filled += tile_counts
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = (sums.reshape(nchannels, nregions) / counts).T
+        variance = (squares.reshape(nchannels, nregions) / counts).T - mean**2
+    std = np.sqrt(np.maximum(variance, 0))
+
+    return RegionSpectra(ids, counts, mean,
+                         _segment_median(buffer, offsets, counts) if median else None, std)
+
+
+def _tile_labels(labels, lindex):
+    """Returns the positive labels of one tile"""
+    lab = np.asarray(labels[lindex]).ravel()
+    return lab[lab > 0]
+
+
+def _segment_median(buffer, offsets, counts):
+    """Returns the per channel median of contiguous row segments of buffer"""
+    segments = np.repeat(np.arange(len(counts), dtype=np.uint64), counts)
+    segment_bits = max(int(len(counts)).bit_length(), 1)
+    lower = offsets + (counts - 1) // 2
+    upper = offsets + counts // 2
+    median = np.empty((len(counts), buffer.shape[1]))
+    for c in range(buffer.shape[1]):
+        column = np.ascontiguousarray(buffer[:, c])
+        encoded = _order_codes(column)
+        if encoded is not None and encoded[1] + segment_bits <= 64:
+            # sort (segment, value) pairs packed into single integers
+            codes, bits, decode = encoded
+            keys = np.sort((segments << np.uint64(bits)) | codes)
+            values = decode(keys & np.uint64(2**bits - 1))
+        else:
+            # sort values within segments, keeping segments in place
+            values = column[np.lexsort((column, segments))]
+        values = values.astype(np.float64)
+        median[:, c] = (values[lower] + values[upper]) / 2
+    return median
+
+
+def _order_codes(values):
+    """Maps values to unsigned integers of the same order
+
+    Returns the codes, their bit width and a function mapping codes back to
+    values, or None for dtypes wider than 32 bits.
+    """
+    if values.dtype.kind in 'iub' and values.dtype.itemsize <= 4:
+        lowest = int(values.min(initial=0))
+        codes = (values.astype(np.int64) - lowest).astype(np.uint64)
+        bits = max(int(codes.max(initial=0)).bit_length(), 1)
+        return codes, bits, lambda codes: codes.astype(np.int64) + lowest
+
+    if values.dtype.kind == 'f' and values.dtype.itemsize <= 4:
+        # flip negative floats entirely and positive floats' sign bit
+        bits = 8 * values.dtype.itemsize
+        raw = values.view('u%d' % values.dtype.itemsize).astype(np.uint64)
+        sign = np.uint64(1 << (bits - 1))
+        full = np.uint64(2**bits - 1)
+        codes = np.where(raw & sign, raw ^ full, raw | sign)
+
+        def decode(codes):
+            raw = np.where(codes & sign, codes ^ sign, codes ^ full)
+            return raw.astype('u%d' % values.dtype.itemsize).view(values.dtype)
+
+        return codes, bits, decode
+
+    return None
+
+
+def write_region_table(path, spectra, wavelengths):
+    """Writes region spectra as a CSV or tab-delimited table, one row per region and statistic"""
+    delimiter = '\t' if str(path).lower().endswith(('.ref', '.tsv', '.txt')) else ','
+    rows = []
+    for i, (label, count) in enumerate(zip(spectra.labels, spectra.counts)):
+        for statistic in STATISTICS:
+            values = getattr(spectra, statistic)
+            if values is not None:
+                rows.append([str(label), statistic, str(count)] + ['%.10g' % v for v in values[i]])
+
+    header = ['label', 'statistic', 'pixels'] + ['%g' % w for w in wavelengths]
+    with open(path, 'w') as f:
+        f.write('\n'.join(delimiter.join(row) for row in [header] + rows) + '\n')
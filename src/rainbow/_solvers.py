@@ -0,0 +1,580 @@
+import threading
+import warnings
+from collections import OrderedDict
+import numpy as np
+
+# Batched solvers operate on spectra stored as columns, B has shape
+# (channels, pixels), and return abundances with shape (endmembers, pixels).
+
+# number of solvers kept by make_solver for reuse across runs
+SOLVER_CACHE_SIZE = 8
+
+# bytes of passive set factorizations each NNLSSolver keeps
+FACTOR_CACHE_BYTES = 16 * 1024**2
+
+# bytes of spectra and abundances DedupSolver remembers across blocks
+DEDUP_CACHE_BYTES = 64 * 1024**2
+
+# fraction of a block's pixels that must repeat a spectrum of the block for DedupSolver to cache it
+DEDUP_MIN_REPEATS = 0.1
+
+# spacing of the pixels WarmNNLSSolver solves from scratch, a power of two
+WARM_START_STRIDE = 8
+
+
+class LeastSquaresSolver():
+    """Unconstrained least squares through a precomputed pseudo-inverse
+
+    Unmixing reduces to a single matrix multiply per block. Abundances may be
+    negative, so this is best suited to well-separated endmembers.
+    """
+
+    def __init__(self, endmembers):
+        A = np.asarray(endmembers, dtype=np.float64)
+        if A.ndim != 2:
+            raise ValueError('endmembers must be a (channels, endmembers) matrix')
+
+        self.endmembers = A
+        self.nchannels, self.nendmembers = A.shape
+        self._At = np.ascontiguousarray(A.T)
+        self._pinv = np.linalg.pinv(A)
+        self._AtA_inv = np.linalg.pinv(self._At @ A)
+
+
+    def solve(self, B):
+        """Solves min ||Ax - b|| for every column b of B"""
+        return self._pinv @ np.asarray(B, dtype=np.float64)
+
+
+    def solve_normal(self, AtB):
+        """Solves the least squares problem given the projected spectra A^T B"""
+        return self._AtA_inv @ np.asarray(AtB, dtype=np.float64)
+
+
+    def reconstruct(self, X, B):
+        """Returns the spectra modeled by abundances X solved for spectra B"""
+        return self.endmembers @ X
+
+
+class NNLSSolver():
+    """Batched nonnegative least squares for a fixed endmember matrix
+
+    Implements the fast combinatorial NNLS algorithm (Van Benthem & Keenan,
+    2004). The Gram matrix A^T A and A^T are computed once per endmember
+    matrix, and every pixel in a block is solved together. Pixels that share
+    a passive set share a single factorization, which is cached across calls.
+
+    With the default tolerance, abundances agree with scipy.optimize.nnls to
+    within 1e-8 relative to the largest abundance of each pixel for
+    well-conditioned endmember matrices (condition number below ~1e4).
+    Pixels still not optimal after max_iter iterations are returned as they
+    are with a RuntimeWarning, where scipy raises.
+    """
+
+    def __init__(self, endmembers, tol=None, max_iter=None):
+        A = np.asarray(endmembers, dtype=np.float64)
+        if A.ndim != 2:
+            raise ValueError('endmembers must be a (channels, endmembers) matrix')
+
+        self.endmembers = A
+        self.nchannels, self.nendmembers = A.shape
+        self._At = np.ascontiguousarray(A.T)
+        self._AtA = self._At @ A
+
+        # relative tolerance on the dual (gradient) used for the optimality check
+        if tol is None:
+            tol = 10 * np.finfo(np.float64).eps * max(A.shape)
+        self.tol = tol
+
+        # maximum number of active set changes per pixel (scipy's default)
+        if max_iter is None:
+            max_iter = 3 * self.nendmembers
+        self.max_iter = max_iter
+
+        # number of passive systems solved, one per pixel and iteration
+        self.solves = 0
+
+        # passive sets are encoded as integers when they fit in a float mantissa
+        self._factor_cache = OrderedDict()
+        self._factor_bytes = 0
+        self._factor_lock = threading.Lock()
+        self._group_limit = 64
+        if self.nendmembers <= 52:
+            self._weights = 2 ** np.arange(self.nendmembers, dtype=np.float64)
+        else:
+            self._weights = None
+
+
+    def __getstate__(self):
+        # worker processes start with an empty factor cache
+        state = self.__dict__.copy()
+        state['_factor_cache'] = OrderedDict()
+        state['_factor_bytes'] = 0
+        del state['_factor_lock']
+        return state
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._factor_lock = threading.Lock()
+
+
+    def solve(self, B):
+        """Solves min ||Ax - b|| s.t. x >= 0 for every column b of B"""
+        B = np.asarray(B, dtype=np.float64)
+        return self.solve_normal(self._At @ B)
+
+
+    def reconstruct(self, X, B):
+        """Returns the spectra modeled by abundances X solved for spectra B"""
+        return self.endmembers @ X
+
+
+    def solve_normal(self, AtB, scale=None, passive=None):
+        """Solves the NNLS problem given the projected spectra A^T B
+
+        The optimality tolerance is relative to scale, the largest magnitude
+        of each column of A^T B by default. passive optionally holds an
+        initial (endmembers, pixels) guess of the nonzero abundances, all of
+        them by default, i.e. a start from the unconstrained problem.
+        """
+        AtB = np.asarray(AtB, dtype=np.float64)
+        n, k = AtB.shape
+        AtA = self._AtA
+        if scale is None:
+            scale = np.abs(AtB).max(axis=0, initial=0.0)
+        tol = self.tol * np.where(scale > 0, scale, 1.0)
+        if passive is None:
+            passive = np.ones((n, k), dtype=bool)
+
+        # initial feasible solution from the initial passive sets
+        K = self._solve_passive(AtB, passive)
+        P = passive & (K > 0)
+        K[~P] = 0
+        D = K.copy()
+
+        # columns whose passive solution was feasible only need the optimality check
+        exact = np.flatnonzero((P == passive).all(axis=0))
+        W = AtB[:, exact] - AtA @ K[:, exact]
+        W[P[:, exact]] = -np.inf
+        optimal = (W <= tol[exact]).all(axis=0)
+        grow, W = exact[~optimal], W[:, ~optimal]
+        P[np.argmax(W, axis=0), grow] = True
+        done = np.zeros(k, dtype=bool)
+        done[exact[optimal]] = True
+        F = np.flatnonzero(~done)
+
+        # active set main loop, vectorized across non-optimal pixels
+        outer = 0
+        while F.size and outer < self.max_iter:
+            outer += 1
+            K[:, F] = self._solve_passive(AtB[:, F], P[:, F])
+
+            # make infeasible solutions feasible by stepping back toward D
+            H = F[(K[:, F] < 0).any(axis=0)]
+            inner = 0
+            while H.size and inner < self.max_iter:
+                inner += 1
+                KH, DH, PH = K[:, H], D[:, H], P[:, H]
+                neg = PH & (KH < 0)
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    alpha = np.where(neg, DH / (DH - KH), np.inf)
+                imin = np.argmin(alpha, axis=0)
+                amin = alpha[imin, np.arange(H.size)]
+                DH = DH - amin * (DH - KH)
+                DH[imin, np.arange(H.size)] = 0
+                PH[imin, np.arange(H.size)] = False
+                D[:, H] = DH
+                P[:, H] = PH
+                K[:, H] = self._solve_passive(AtB[:, H], PH)
+                H = H[(K[:, H] < 0).any(axis=0)]
+
+            # check the dual for optimality
+            W = AtB[:, F] - AtA @ K[:, F]
+            W[P[:, F]] = -np.inf
+            optimal = (W <= tol[F]).all(axis=0)
+            F, W = F[~optimal], W[:, ~optimal]
+
+            # add the most promising variable to the passive set
+            if F.size:
+                P[np.argmax(W, axis=0), F] = True
+                D[:, F] = K[:, F]
+
+        if F.size:
+            warnings.warn(
+                'NNLS did not converge for %i of %i pixels within %i iterations, '
+                'their abundances are not optimal' % (F.size, k, self.max_iter),
+                RuntimeWarning
+            )
+        K[K < 0] = 0
+        return K
+
+
+    def _solve_passive(self, AtB, P):
+        """Solves the unconstrained problem restricted to each column's passive set"""
+        K = np.zeros(AtB.shape)
+        k = AtB.shape[1]
+        self.solves += k
+        if not k:
+            return K
+
+        # group columns that share a passive set
+        if self._weights is not None:
+            uniq, inverse = np.unique(self._weights @ P, return_inverse=True)
+        else:
+            uniq, inverse = np.unique(P.T, axis=0, return_inverse=True)
+            uniq = [u.tobytes() for u in uniq]
+        inverse = inverse.ravel()
+
+        # many distinct passive sets are cheaper to solve as one batched call
+        if len(uniq) > self._group_limit and len(uniq) * 4 > k:
+            try:
+                return self._solve_masked(AtB, P)
+            except np.linalg.LinAlgError:
+                pass
+
+        order = np.argsort(inverse, kind='stable')
+        bounds = np.cumsum(np.bincount(inverse, minlength=len(uniq)))[:-1]
+        for code, cols in zip(uniq, np.split(order, bounds)):
+            passive = P[:, cols[0]]
+            if not passive.any():
+                continue
+            inv = self._factor(code, passive)
+            K[np.ix_(passive, cols)] = inv @ AtB[np.ix_(passive, cols)]
+
+        return K
+
+
+    def _solve_masked(self, AtB, P):
+        """Solves each column's passive system as a batch of masked Gram matrices"""
+        Pt = P.T
+        G = self._AtA * (Pt[:, :, None] & Pt[:, None, :])
+        diag = np.arange(self.nendmembers)
+        G[:, diag, diag] += ~Pt
+        rhs = np.where(Pt, AtB.T, 0.0)
+        return np.linalg.solve(G, rhs[:, :, None])[:, :, 0].T
+
+
+    def _factor(self, code, passive):
+        """Returns the inverse of the Gram matrix for a passive set from a bounded LRU cache"""
+        with self._factor_lock:
+            inv = self._factor_cache.get(code)
+            if inv is not None:
+                self._factor_cache.move_to_end(code)
+                return inv
+
+        G = self._AtA[np.ix_(passive, passive)]
+        try:
+            inv = np.linalg.inv(G)
+        except np.linalg.LinAlgError:
+            inv = np.linalg.pinv(G)
+
+        with self._factor_lock:
+            if code not in self._factor_cache:
+                self._factor_cache[code] = inv
+                self._factor_bytes += inv.nbytes
+                while self._factor_bytes > FACTOR_CACHE_BYTES:
+                    _, old = self._factor_cache.popitem(last=False)
+                    self._factor_bytes -= old.nbytes
+        return inv
+
+
+class WarmNNLSSolver(NNLSSolver):
+    """NNLS that starts each pixel from the passive set of an already solved neighbor
+
+    Neighboring pixels mostly share their nonzero endmembers. Pixels reach
+    the solver in scanline order, so every stride-th pixel is solved from
+    the unconstrained problem, then the pixels halfway between solved ones
+    are started from the passive set of their left neighbor, halving the
+    spacing until all are solved. Each level is one batched solve. Starting
+    sets that turn out infeasible lose their negative endmembers and
+    non-optimal ones gain the most promising endmember, as in a cold start,
+    so abundances are the same as NNLSSolver's. With many overlapping
+    endmembers (about 15 or more) on spatially smooth images this takes
+    fewer iterations and less time. With few endmembers, a cold start from
+    the unconstrained solution is cheaper.
+    """
+
+    def __init__(self, endmembers, tol=None, max_iter=None, stride=WARM_START_STRIDE):
+        super().__init__(endmembers, tol, max_iter)
+        if stride < 1 or stride & (stride - 1):
+            raise ValueError('stride must be a power of two')
+        self.stride = stride
+
+
+    def solve_normal(self, AtB, scale=None, passive=None):
+        """Solves the NNLS problem given the projected spectra A^T B of pixels in scanline order"""
+        AtB = np.asarray(AtB, dtype=np.float64)
+        if passive is not None:
+            return super().solve_normal(AtB, scale, passive)
+        k = AtB.shape[1]
+        if scale is None:
+            scale = np.abs(AtB).max(axis=0, initial=0.0)
+
+        K = np.empty(AtB.shape)
+        cols = np.arange(0, k, self.stride)
+        K[:, cols] = super().solve_normal(AtB[:, cols], scale[cols])
+        step = self.stride // 2
+        while step:
+            cols = np.arange(step, k, 2 * step)
+            K[:, cols] = super().solve_normal(AtB[:, cols], scale[cols], K[:, cols - step] > 0)
+            step //= 2
+        return K
+
+
+class FCLSSolver(NNLSSolver):
+    """Fully constrained least squares: nonnegative abundances that sum to one
+
+    Endmembers are scaled to unit sum and every pixel spectrum is divided by
+    its total intensity, so abundances are the fractions of each pixel's
+    intensity contributed by each endmember. The sum-to-one constraint is
+    enforced by appending a row of weight delta to the endmember matrix
+    (Heinz & Chang, 2001), which only changes the Gram matrix, so FCLS runs on
+    the same batched NNLS machinery. With the default delta, fractions of
+    pixels above the noise sum to one within ~1e-6 and do not depend on how
+    pixels are batched. Pixels with no positive intensity get zero abundances.
+    """
+
+    def __init__(self, endmembers, delta=None, tol=None, max_iter=None):
+        A = np.asarray(endmembers, dtype=np.float64)
+        if A.ndim != 2:
+            raise ValueError('endmembers must be a (channels, endmembers) matrix')
+        totals = A.sum(axis=0)
+        super().__init__(A / np.where(totals > 0, totals, 1), tol, max_iter)
+
+        if delta is None:
+            delta = 1e2 * np.sqrt(self._AtA.diagonal().max())
+        self.delta = delta
+        self._AtA = self._AtA + delta**2
+
+
+    def solve(self, B):
+        """Solves the fully constrained problem for every column b of B"""
+        B = np.asarray(B, dtype=np.float64)
+        return self.solve_fractions(self._At @ B, B.sum(axis=0))
+
+
+    def solve_fractions(self, AtB, totals):
+        """Solves given the projected spectra A^T B and each pixel's total intensity"""
+        empty = ~(totals > 0)
+        AtB = AtB / np.where(empty, 1, totals)
+
+        # the tolerance follows the data term, which the delta term would swamp
+        scale = np.abs(AtB).max(axis=0, initial=0.0)
+        X = self.solve_normal(AtB + self.delta**2, scale)
+        X[:, empty] = 0
+        return X
+
+
+    def reconstruct(self, X, B):
+        """Returns the spectra modeled by fractions X, scaled by each pixel's intensity"""
+        return (self.endmembers @ X) * np.asarray(B, dtype=np.float64).sum(axis=0)
+
+
+class DedupSolver():
+    """Wraps a solver so that each distinct pixel spectrum is solved only once
+
+    Spectra in a block are deduplicated with np.unique on a byte view of each
+    channel vector; abundances of the distinct spectra are scattered back
+    through the inverse index. With quantum, spectra are first rounded to
+    multiples of quantum, so near-identical spectra (e.g. low-count
+    background) share a solution. Solved spectra are kept in sorted arrays
+    that are searched for a whole block at once, carrying results across
+    blocks, tiles and slices. When they outgrow max_bytes, the least
+    recently used quarter is evicted. Blocks with few repeated spectra
+    (noisy data) are solved without the cache, which would only grow.
+    Integer images without a quantum give exactly the same result as the
+    wrapped solver.
+    """
+
+    def __init__(self, solver, quantum=None, max_bytes=DEDUP_CACHE_BYTES):
+        self.solver = solver
+        self.quantum = quantum
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._clear()
+
+
+    def __getattr__(self, name):
+        # behave like the wrapped solver for everything but solve
+        if name == 'solver':
+            raise AttributeError(name)
+        return getattr(self.solver, name)
+
+
+    def __getstate__(self):
+        # worker processes start with an empty cache
+        state = self.__dict__.copy()
+        for name in ('_keys', '_values', '_used'):
+            state[name] = None
+        state['_clock'] = 0
+        del state['_lock']
+        return state
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+
+    @property
+    def nbytes(self):
+        """Bytes held by the cache of solved spectra"""
+        if self._keys is None:
+            return 0
+        return self._keys.nbytes + self._values.nbytes + self._used.nbytes
+
+
+    def solve(self, B):
+        """Solves each distinct column of B once"""
+        B = np.asarray(B)
+        if self.quantum:
+            B = np.round(B / self.quantum)
+
+        # distinct spectra through a byte view of each channel vector
+        Q = np.ascontiguousarray(B.T)
+        keys = Q.view(np.dtype((np.void, Q.dtype.itemsize * Q.shape[1]))).ravel()
+        uniq, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+
+        # reuse abundances solved for earlier blocks
+        X = np.empty((self.solver.nendmembers, len(uniq)))
+        cached = len(uniq) <= (1 - DEDUP_MIN_REPEATS) * len(keys)
+        found = np.zeros(len(uniq), dtype=bool)
+        if cached:
+            with self._lock:
+                found, index = self._lookup(uniq)
+                if found.any():
+                    X[:, found] = self._values[index[found]].T
+                    self._used[index[found]] = self._clock
+        missing = np.flatnonzero(~found)
+
+        if missing.size:
+            spectra = Q[first[missing]].T.astype(np.float64)
+            if self.quantum:
+                spectra *= self.quantum
+            X[:, missing] = self.solver.solve(spectra)
+            if cached:
+                with self._lock:
+                    self._insert(uniq[missing], X[:, missing].T)
+
+        self.hits += B.shape[1] - missing.size
+        self.misses += missing.size
+        return X[:, inverse.ravel()]
+
+
+    def _clear(self):
+        self._keys = None
+        self._values = None
+        self._used = None
+        self._clock = 0
+
+
+    def _lookup(self, keys):
+        """Returns which sorted keys are cached and where, holding the lock"""
+        if self._keys is None or self._keys.dtype != keys.dtype or not len(self._keys):
+            return np.zeros(len(keys), dtype=bool), np.zeros(len(keys), dtype=np.intp)
+        index = np.searchsorted(self._keys, keys)
+        found = index < len(self._keys)
+        found[found] = self._keys[index[found]] == keys[found]
+        return found, index
+
+
+    def _insert(self, keys, values):
+        """Adds sorted keys and their abundances, evicting old entries, holding the lock"""
+        self._clock += 1
+        if self._keys is None or self._keys.dtype != keys.dtype:
+            self._keys = keys.copy()
+            self._values = np.array(values)
+            self._used = np.full(len(keys), self._clock)
+        else:
+            # other threads may have added some of the keys meanwhile
+            found, index = self._lookup(keys)
+            keys, values, index = keys[~found], values[~found], index[~found]
+            self._keys = np.insert(self._keys, index, keys)
+            self._values = np.insert(self._values, index, values, axis=0)
+            self._used = np.insert(self._used, index, self._clock)
+
+        if self.nbytes > self.max_bytes:
+            entry = self.nbytes / len(self._keys)
+            keep = int(0.75 * self.max_bytes / entry)
+            if keep <= 0:
+                self._clear()
+                return
+            recent = np.sort(np.argpartition(-self._used, keep - 1)[:keep])
+            self._keys = self._keys[recent]
+            self._values = self._values[recent]
+            self._used = self._used[recent]
+
+
+class ReducedSolver():
+    """Wraps a solver to unmix the coefficients of spectra in an orthonormal channel basis
+
+    For spectra B = V C with a (channels, rank) basis V, A^T B = (V^T A)^T C,
+    so abundances are those the wrapped solver finds for the reconstructed
+    spectra V C, while each block costs a product over the rank coefficients
+    instead of all channels. Wraps the solvers in SOLVERS.
+    """
+
+    def __init__(self, solver, basis):
+        self.solver = solver
+        self.basis = np.asarray(basis, dtype=np.float64)
+        self.endmembers = solver.endmembers
+        self.nchannels, self.nendmembers = solver.nchannels, solver.nendmembers
+        self.rank = self.basis.shape[1]
+
+        # endmembers and channel sums projected onto the basis
+        self._AtV = solver._At @ self.basis
+        self._totals = self.basis.sum(axis=0)
+
+
+    def solve(self, C):
+        """Solves for every column c of C as if it were the spectrum V c"""
+        C = np.asarray(C, dtype=np.float64)
+        if isinstance(self.solver, FCLSSolver):
+            return self.solver.solve_fractions(self._AtV @ C, self._totals @ C)
+        return self.solver.solve_normal(self._AtV @ C)
+
+
+    def expand(self, C):
+        """Returns the spectra V C of coefficients C"""
+        return self.basis @ np.asarray(C, dtype=np.float64)
+
+
+    def reconstruct(self, X, B):
+        """Returns the spectra modeled by abundances X solved for expanded spectra B"""
+        return self.solver.reconstruct(X, B)
+
+
+# selectable unmixing modes
+SOLVERS = {
+    'nnls': NNLSSolver,
+    'warm-started nnls': WarmNNLSSolver,
+    'unconstrained': LeastSquaresSolver,
+    'fully constrained': FCLSSolver
+}
+
+_solver_cache = OrderedDict()
+
+
+def make_solver(mode, endmembers):
+    """Returns a solver for an endmember matrix, reusing one built for earlier runs
+
+    The pseudo-inverse, Gram matrix and passive set factorizations are
+    computed once per mode and endmember set.
+    """
+    if mode not in SOLVERS:
+        raise ValueError('unknown solver mode %r, expected one of %s' % (mode, list(SOLVERS)))
+
+    A = np.ascontiguousarray(endmembers, dtype=np.float64)
+    key = (mode, A.shape, A.tobytes())
+    solver = _solver_cache.get(key)
+    if solver is None:
+        solver = SOLVERS[mode](A)
+        _solver_cache[key] = solver
+        while len(_solver_cache) > SOLVER_CACHE_SIZE:
+            _solver_cache.popitem(last=False)
+    else:
+        _solver_cache.move_to_end(key)
+    return solver
@@ -1,18 +1,233 @@
-import _utils
+from . import _utils
 
+import csv
+import hashlib
+from collections import OrderedDict
 import numpy as np
 
+# number of parsed files and resampled endmember matrices kept in memory
+ENDMEMBER_CACHE_SIZE = 16
+
+# initial number of rows of a SpectrumStore, doubled whenever it fills up
+STORE_CAPACITY = 256
+
+_table_cache = OrderedDict()
+_matrix_cache = OrderedDict()
+
+
 class Spectrum():
     def __init__(self, name, wavelengths, data):
         self.name = name
         self.wavelengths = wavelengths
         self.data = data
 
-    
+
     def normalize(self):
         self.data = _utils.safe_normalize_max(self.data)
 
 
     def interp_spectrum(self, interp_wavelengths):
-        return np.interp(interp_wavelengths, self.wavelengths, self.data)
-        
\ No newline at end of file
+        return interp_spectra(self.wavelengths, self.data, interp_wavelengths)
+
+
+class SpectrumStore():
+    """Growable store of captured spectra with their coordinates and labels
+
+    Spectra are rows of one preallocated matrix, so they can be plotted,
+    normalized and exported in bulk. Capacity doubles when the store fills up.
+    """
+
+    def __init__(self, nchannels, ndim=2, capacity=STORE_CAPACITY):
+        self.nchannels = nchannels
+        self.ndim = ndim
+        self.labels = []
+        self._data = np.full((capacity, nchannels), np.nan)
+        self._coordinates = np.full((capacity, ndim), np.nan)
+
+
+    def __len__(self):
+        return len(self.labels)
+
+
+    @property
+    def data(self):
+        """Stored spectra with shape (spectra, channels)"""
+        return self._data[:len(self)]
+
+
+    @property
+    def coordinates(self):
+        """Data coordinates of the stored spectra, NaN for loaded spectra"""
+        return self._coordinates[:len(self)]
+
+
+    def append(self, spectrum, coordinates=None, label=None):
+        """Stores one spectrum, labeled by its coordinates unless a label is given"""
+        if coordinates is not None:
+            coordinates = np.asarray(coordinates, dtype=np.float64)
+            if label is None:
+                label = 'spectrum (%s)' % ', '.join(str(int(c)) for c in coordinates)
+        self.extend(np.asarray(spectrum)[np.newaxis],
+                    None if coordinates is None else coordinates[np.newaxis],
+                    [label])
+
+
+    def extend(self, spectra, coordinates=None, labels=None):
+        """Stores a (spectra, channels) matrix of spectra at once"""
+        spectra = np.asarray(spectra)
+        if spectra.ndim != 2 or spectra.shape[1] != self.nchannels:
+            raise ValueError('expected spectra with %d channels, got shape %s'
+                             % (self.nchannels, spectra.shape))
+        n, start = len(spectra), len(self)
+        if labels is None:
+            labels = [None] * n
+        labels = ['spectrum %d' % (start + i + 1) if label is None else label
+                  for i, label in enumerate(labels)]
+
+        self._reserve(start + n)
+        self._data[start:start + n] = spectra
+        if coordinates is not None:
+            self._coordinates[start:start + n] = np.asarray(coordinates)[:, -self.ndim:]
+        self.labels.extend(labels)
+
+
+    def clear(self):
+        self._data[:len(self)] = np.nan
+        self._coordinates[:len(self)] = np.nan
+        self.labels = []
+
+
+    def _reserve(self, size):
+        """Grows the preallocated arrays to hold at least size spectra"""
+        capacity = len(self._data)
+        if size <= capacity:
+            return
+        while capacity < size:
+            capacity *= 2
+        data = np.full((capacity, self.nchannels), np.nan)
+        coordinates = np.full((capacity, self.ndim), np.nan)
+        data[:len(self)] = self.data
+        coordinates[:len(self)] = self.coordinates
+        self._data, self._coordinates = data, coordinates
+
+
+def interp_spectra(wavelengths, data, interp_wavelengths):
+    """Linearly interpolates spectra sampled at wavelengths onto interp_wavelengths
+
+    data holds one spectrum per column (or a single 1-D spectrum). All spectra
+    are resampled in one vectorized pass, matching np.interp, including
+    clamping to the edge values outside the sampled range.
+    """
+    wavelengths = np.asarray(wavelengths, dtype=np.float64)
+    data = np.asarray(data, dtype=np.float64)
+    x = np.asarray(interp_wavelengths, dtype=np.float64)
+
+    # locate the bracketing samples once for every spectrum
+    i = np.clip(np.searchsorted(wavelengths, x, side='right'), 1, len(wavelengths) - 1)
+    x0, x1 = wavelengths[i - 1], wavelengths[i]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        w = np.clip(np.where(x1 > x0, (x - x0) / (x1 - x0), 0), 0, 1)
+    w = w.reshape(w.shape + (1,) * (data.ndim - 1))
+    return data[i - 1] * (1 - w) + data[i] * w
+
+
+def parse_endmembers(text, delimiter=','):
+    """Parses an endmember table into names, wavelengths and a data matrix
+
+    The first row holds a header with one name per endmember after the
+    wavelength column, and every following row holds a wavelength followed by
+    one value per endmember, as in FPbase exports. Missing or empty cells are
+    read as zero. The data matrix has one endmember per column.
+    """
+    rows = [r for r in csv.reader(text.splitlines(), delimiter=delimiter) if r]
+    header, rows = rows[0], rows[1:]
+    ncols = len(header)
+
+    # pad short rows, then convert the whole table at once
+    table = np.array([r[:ncols] + [''] * (ncols - len(r)) for r in rows], dtype=object)
+    table[table == ''] = 'nan'
+    table = table.astype(np.float64).reshape(len(rows), ncols)
+
+    names = [name.strip() for name in header[1:]]
+    return names, table[:, 0], np.nan_to_num(table[:, 1:])
+
+
+def read_endmembers(path):
+    """Reads endmember spectra from a CSV file or a tab-delimited .ref file
+
+    Returns a list of max-normalized Spectrum objects whose data are columns
+    of one contiguous matrix.
+    """
+    names, wavelengths, data = read_spectra(path)
+    data = normalize_columns(data)
+    return [Spectrum(name, wavelengths, data[:, i]) for i, name in enumerate(names)]
+
+
+def read_spectra(path):
+    """Reads names, wavelengths and a (wavelengths, spectra) matrix from a CSV or .ref file"""
+    return _read_table(path)[1:]
+
+
+def write_spectra(path, names, wavelengths, data):
+    """Writes spectra as a CSV file or a tab-delimited .ref file
+
+    data holds one spectrum per column, as returned by read_spectra, so
+    written files can be read back as spectra or endmembers.
+    """
+    delimiter = '\t' if str(path).lower().endswith('.ref') else ','
+    table = np.column_stack([np.asarray(wavelengths, dtype=np.float64), data])
+    header = delimiter.join(['wavelength'] + [str(name).replace(delimiter, ' ') for name in names])
+    np.savetxt(path, table, fmt='%.10g', delimiter=delimiter, header=header, comments='')
+
+
+def endmember_matrix(path, wavelengths=None):
+    """Returns endmember names and a solver-ready (channels, endmembers) matrix
+
+    Endmembers are max-normalized and, given the image's wavelength grid,
+    resampled onto it. Results are cached by file content and wavelength grid,
+    so repeated runs skip parsing and interpolation.
+    """
+    digest, names, x, data = _read_table(path)
+    grid = None if wavelengths is None else tuple(np.asarray(wavelengths, dtype=np.float64))
+
+    def build():
+        A = normalize_columns(data)
+        if grid is not None:
+            A = interp_spectra(x, A, grid)
+        A = np.ascontiguousarray(A)
+        A.flags.writeable = False
+        return names, A
+
+    return _cached(_matrix_cache, (digest, grid), build)
+
+
+def normalize_columns(data):
+    """Scales each column to a maximum of one, leaving all-zero columns at zero"""
+    m = np.max(data, axis=0, initial=0)
+    return data / np.where(m > 0, m, 1)
+
+
+def _read_table(path):
+    """Reads and parses an endmember file, reusing the parse for unchanged content"""
+    with open(path, 'rb') as f:
+        content = f.read()
+    digest = hashlib.sha1(content).hexdigest()
+    delimiter = '\t' if str(path).lower().endswith('.ref') else ','
+
+    def parse():
+        return (digest,) + parse_endmembers(content.decode('utf-8-sig'), delimiter)
+
+    return _cached(_table_cache, (digest, delimiter), parse)
+
+
+def _cached(cache, key, build):
+    """Looks up key in a bounded LRU cache, building and storing missing values"""
+    value = cache.get(key)
+    if value is None:
+        value = build()
+        cache[key] = value
+        while len(cache) > ENDMEMBER_CACHE_SIZE:
+            cache.popitem(last=False)
+    else:
+        cache.move_to_end(key)
+    return value
@@ -1,9 +1,13 @@
-import _spectrum
-import csv
+import copy
+import logging
+import os
+import threading
+import time
+from contextlib import closing
 import numpy as np
-from scipy.optimize import nnls
-from napari import view_image
+from . import _compress, _extract, _lazy, _metadata, _pipeline, _profiling, _solvers, _spectrum, _writer
 from napari.layers import Image
+from napari.qt.threading import thread_worker
 from napari.utils.theme import get_theme
 from matplotlib.figure import Figure
 from matplotlib.backends.backend_qtagg import FigureCanvas
@@ -17,9 +21,57 @@ from qtpy.QtWidgets import (
     QFileDialog,
     QLabel,
     QPushButton,
-    QComboBox
+    QComboBox,
+    QSpinBox,
+    QDoubleSpinBox,
+    QProgressBar,
+    QCheckBox
 )
 
+logger = logging.getLogger(__name__)
+
+# colormaps cycled through for abundance layers
+ABUNDANCE_COLORMAPS = ['magenta', 'green', 'cyan', 'yellow', 'red', 'blue']
+
+# minimum time in seconds between redraws of partially unmixed layers
+REFRESH_INTERVAL = 0.25
+
+# tile extent used when the visible region is unmixed first
+PREVIEW_TILE_SIZE = 128
+
+# where abundances are written, with the file extension of file outputs
+OUTPUTS = {'memory': None, 'OME-Zarr': '.zarr', 'memmap': '.npy'}
+
+
+@thread_worker
+def _unmix_tiles(data, solver, out, channel_axis, tiles, workers, cancel, summaries=None,
+                 wavelengths=None):
+    """Unmixes tiles in a background thread, yielding each finished tile and its maxima
+
+    Setting cancel stops the run once the tiles in progress are done.
+    """
+    with closing(_pipeline.iter_unmix(data, solver, out, channel_axis, tiles, workers=workers,
+                                      summaries=summaries, wavelengths=wavelengths,
+                                      maxima=True)) as finished:
+        for result in finished:
+            yield result
+            if cancel.is_set():
+                return
+
+
+@thread_worker
+def _extract_endmembers(data, n, channel_axis, method, wavelengths):
+    """Extracts endmembers from a sample of the image in a background thread"""
+    return _extract.extract_endmembers(data, n, channel_axis, method, wavelengths)
+
+
+@thread_worker
+def _compress_cube(data, channel_axis, rank):
+    """Compresses the image in a background thread, yielding tiles done and in total"""
+    cube = yield from _compress.iter_compress(data, channel_axis, rank)
+    return cube
+
+
 class UnmixingWidget(QWidget):
     def __init__(self, napari_viewer):
         super().__init__()
@@ -35,15 +87,123 @@ class UnmixingWidget(QWidget):
         # controls
         self._button_import = QPushButton('import')
         self._button_import.clicked.connect(self._import_endmembers)
+        self._button_extract = QPushButton('extract')
+        self._button_extract.clicked.connect(self._extract)
+        self._sbox_nendmembers = QSpinBox()
+        self._sbox_nendmembers.setRange(1, 64)
+        self._sbox_nendmembers.setValue(4)
+        self._cbox_extract = QComboBox()
+        self._cbox_extract.addItems(list(_extract.METHODS))
+        self._button_compress = QPushButton('compress')
+        self._button_compress.clicked.connect(self._compress)
+        self._sbox_rank = QSpinBox()
+        self._sbox_rank.setRange(0, 256)
+        self._sbox_rank.setSpecialValueText('auto')
+        self._sbox_rank.setPrefix('rank ')
+        self._label_compress = QLabel('')
         self._button_unmix = QPushButton('unmix')
         self._button_unmix.clicked.connect(self._unmix)
+        self._sbox_workers = QSpinBox()
+        self._sbox_workers.setRange(1, os.cpu_count() or 1)
+        self._sbox_workers.setValue(os.cpu_count() or 1)
+        self._button_cancel = QPushButton('cancel')
+        self._button_cancel.clicked.connect(self._cancel_unmix)
+        self._button_cancel.setDisabled(True)
+        self._progress = QProgressBar()
+        self._progress.setValue(0)
+        self._cbox_solver = QComboBox()
+        self._cbox_solver.addItems(list(_solvers.SOLVERS))
+        self._cbox_dedup = QCheckBox('deduplicate spectra')
+        self._cbox_dedup.toggled.connect(self._dedup_toggled)
+        self._sbox_quantum = QDoubleSpinBox()
+        self._sbox_quantum.setRange(0, 1e6)
+        self._sbox_quantum.setSpecialValueText('exact')
+        self._sbox_quantum.setDisabled(True)
+        self._cbox_preview = QCheckBox('visible region first')
+        self._cbox_preview.setChecked(True)
+        self._cbox_summaries = QCheckBox('summary images')
+        self._cbox_profile = QCheckBox('profile')
+        self._button_profile = QPushButton('save profile')
+        self._button_profile.clicked.connect(self._save_profile)
+        self._button_profile.setDisabled(True)
+        self._cbox_output = QComboBox()
+        self._cbox_output.addItems(list(OUTPUTS))
+        self._cbox_dtype = QComboBox()
+        self._cbox_dtype.addItems(list(_writer.OUTPUT_DTYPES))
+        self._cbox_dtype.setCurrentText('float32')
+        self._cbox_lazy = QCheckBox('unmix lazily')
+        self._cbox_lazy.toggled.connect(self._lazy_toggled)
+        self._sbox_cache = QSpinBox()
+        self._sbox_cache.setRange(16, 1024**2)
+        self._sbox_cache.setSuffix(' MB')
+        self._sbox_cache.setValue(_lazy.DEFAULT_CACHE_BYTES // 1024**2)
+        self._sbox_cache.valueChanged.connect(self._cache_size_changed)
 
         # layout
+        layout_extract = QHBoxLayout()
+        layout_extract.addWidget(self._button_extract)
+        layout_extract.addWidget(self._sbox_nendmembers)
+        layout_extract.addWidget(self._cbox_extract)
+
+        layout_compress = QHBoxLayout()
+        layout_compress.addWidget(self._button_compress)
+        layout_compress.addWidget(self._sbox_rank)
+        layout_compress.addWidget(self._label_compress)
+        layout_compress.addStretch(1)
+
+        layout_solver = QHBoxLayout()
+        layout_solver.addWidget(QLabel('solver:'))
+        layout_solver.addWidget(self._cbox_solver)
+
+        layout_dedup = QHBoxLayout()
+        layout_dedup.addWidget(self._cbox_dedup)
+        layout_dedup.addStretch(1)
+        layout_dedup.addWidget(QLabel('quantum:'))
+        layout_dedup.addWidget(self._sbox_quantum)
+
+        layout_workers = QHBoxLayout()
+        layout_workers.addWidget(QLabel('workers:'))
+        layout_workers.addWidget(self._sbox_workers)
+        layout_workers.addStretch(1)
+        layout_workers.addWidget(self._cbox_preview)
+
+        layout_summaries = QHBoxLayout()
+        layout_summaries.addWidget(self._cbox_summaries)
+        layout_summaries.addStretch(1)
+        layout_summaries.addWidget(self._cbox_profile)
+        layout_summaries.addWidget(self._button_profile)
+
+        layout_output = QHBoxLayout()
+        layout_output.addWidget(QLabel('output:'))
+        layout_output.addWidget(self._cbox_output)
+        layout_output.addStretch(1)
+        layout_output.addWidget(QLabel('type:'))
+        layout_output.addWidget(self._cbox_dtype)
+
+        layout_lazy = QHBoxLayout()
+        layout_lazy.addWidget(self._cbox_lazy)
+        layout_lazy.addStretch(1)
+        layout_lazy.addWidget(QLabel('cache:'))
+        layout_lazy.addWidget(self._sbox_cache)
+
+        layout_run = QHBoxLayout()
+        layout_run.addWidget(self._button_unmix)
+        layout_run.addWidget(self._button_cancel)
+
         layout_main = QVBoxLayout()
         layout_main.addWidget(self._canvas)
         layout_main.addWidget(self._toolbar)
         layout_main.addWidget(self._button_import)
-        layout_main.addWidget(self._button_unmix)
+        layout_main.addLayout(layout_extract)
+        layout_main.addLayout(layout_compress)
+        layout_main.addLayout(layout_solver)
+        layout_main.addLayout(layout_dedup)
+        layout_main.addLayout(layout_workers)
+        layout_main.addLayout(layout_summaries)
+        layout_main.addLayout(layout_output)
+        layout_main.addLayout(layout_lazy)
+        layout_main.addLayout(layout_run)
+        layout_main.addWidget(self._progress)
         self.setLayout(layout_main)
 
         # define default plotting and layer properties
@@ -54,6 +214,12 @@ class UnmixingWidget(QWidget):
             'xmax': 43.05
         }
         self._endmembers = []
+        self._endmember_path = None
+        self._worker = None
+        self._profiler = None
+        self._run = None
+        self._plane_cache = _lazy.PlaneCache(self._sbox_cache.value() * 1024**2)
+        self._lazy_toggled(False)
 
         # set up callbacks and plot for active selection
         self._set_unmix_button()
@@ -75,7 +241,8 @@ class UnmixingWidget(QWidget):
     
     def _set_unmix_button(self):
         layer = self.viewer.layers.selection.active
-        if layer and isinstance(layer, Image) and (layer.ndim > self.viewer.dims.ndisplay) and self._endmembers:
+        running = self._worker is not None
+        if layer and isinstance(layer, Image) and (layer.ndim > self.viewer.dims.ndisplay) and self._endmembers and not running:
             self._button_unmix.setEnabled(True)
         else:
             self._button_unmix.setDisabled(True)
@@ -85,30 +252,65 @@ class UnmixingWidget(QWidget):
         """Prompts user to choose an endmember file and loads it"""
         fname,ftype = QFileDialog.getOpenFileName(self, 
             caption='Open file', 
-            filter='CSV (*.csv)'
+            filter='Endmembers (*.csv *.ref)'
         )
+        if not fname:
+            return
 
         # load the file
-        with open(fname, 'r', newline='') as f:
-            csv_reader = csv.reader(f, delimiter=',')
-            header = next(csv_reader)
-            self._endmembers = []
-            for name in header[1:]:
-                self._endmembers.append(_spectrum.Spectrum(name, [], []))
-
-            for row in csv_reader:
-                ncols = len(row)
-                for i in range(len(self._endmembers)):
-                    self._endmembers[i].wavelengths.append(float(row[0]))
-                    if i + 1 < ncols and row[i+1]:
-                        self._endmembers[i].data.append(float(row[i+1]))
-                    else:
-                        self._endmembers[i].data.append(0.0)
-            
-            for endmember in self._endmembers:
-                endmember.wavelengths = np.array(endmember.wavelengths)
-                endmember.data = np.array(endmember.data)
-                endmember.normalize()
+        self._endmembers = _spectrum.read_endmembers(fname)
+        self._endmember_path = fname
+
+        self._plot_endmembers()
+        self._set_unmix_button()
+
+
+    def _endmember_matrix(self, layer):
+        """Returns the endmember matrix sampled on the layer's spectral channels"""
+        metadata = layer.metadata['rainbow']
+        nchannels = metadata['axes']['c']['extent']
+
+        # resample onto the image's wavelengths unless they are plain channel indices
+        grid = None if metadata.get('units', 'ch') == 'ch' else metadata['wavelengths']
+        if self._endmember_path is not None:
+            A = _spectrum.endmember_matrix(self._endmember_path, grid)[1]
+        elif grid is not None:
+            A = np.stack([e.interp_spectrum(grid) for e in self._endmembers], axis=1)
+        else:
+            A = np.stack([e.data for e in self._endmembers], axis=1)
+
+        if A.shape[0] != nchannels:
+            raise ValueError(
+                'endmembers have %i wavelengths but the image has %i channels'
+                % (A.shape[0], nchannels)
+            )
+        return A
+
+
+    def _extract(self):
+        """Extracts endmembers from the active layer in the background"""
+        layer = self.viewer.layers.selection.active
+        if not (layer and isinstance(layer, Image) and layer.ndim > self.viewer.dims.ndisplay):
+            return
+        metadata = _metadata.init_metadata(layer, self.viewer.dims.ndisplay)
+        data = layer.data[0] if layer.multiscale else layer.data
+
+        self._button_extract.setDisabled(True)
+        worker = _extract_endmembers(
+            data,
+            self._sbox_nendmembers.value(),
+            metadata['axes']['c']['index'],
+            self._cbox_extract.currentText(),
+            metadata['wavelengths']
+        )
+        worker.returned.connect(self._endmembers_extracted)
+        worker.finished.connect(lambda: self._button_extract.setEnabled(True))
+        worker.start()
+
+
+    def _endmembers_extracted(self, endmembers):
+        self._endmembers = endmembers
+        self._endmember_path = None
 
         self._plot_endmembers()
         self._set_unmix_button()
@@ -122,22 +324,353 @@ class UnmixingWidget(QWidget):
         self._canvas.draw()
 
 
+    def _compress(self):
+        """Compresses the active layer into a low-rank layer in the background"""
+        layer = self.viewer.layers.selection.active
+        if not (layer and isinstance(layer, Image) and layer.ndim > self.viewer.dims.ndisplay):
+            return
+        metadata = _metadata.init_metadata(layer, self.viewer.dims.ndisplay)
+        data = layer.data[0] if layer.multiscale else layer.data
+        if isinstance(data, _compress.CompressedCube):
+            return
+
+        self._button_compress.setDisabled(True)
+        self._progress.setValue(0)
+        worker = _compress_cube(
+            data,
+            metadata['axes']['c']['index'],
+            self._sbox_rank.value() or None
+        )
+        worker.yielded.connect(self._compress_progress)
+        worker.returned.connect(lambda cube: self._cube_compressed(layer, cube))
+        worker.finished.connect(lambda: self._button_compress.setEnabled(True))
+        worker.start()
+
+
+    def _compress_progress(self, progress):
+        done, total = progress
+        self._progress.setRange(0, total)
+        self._progress.setValue(done)
+
+
+    def _cube_compressed(self, layer, cube):
+        """Adds the compressed cube as a layer that inspection and unmixing share"""
+        self._label_compress.setText('rank %d, error %.2f%%' % (cube.rank, 100 * cube.error))
+        self._label_compress.setToolTip('\n'.join(
+            'rank %d: %.2f%%' % (k + 1, 100 * e) for k, e in enumerate(cube.errors[:16])
+        ))
+        self.viewer.add_image(
+            cube,
+            name='%s compressed' % layer.name,
+            metadata={'rainbow': copy.deepcopy(layer.metadata['rainbow'])},
+            contrast_limits=layer.contrast_limits,
+            visible=False,
+            scale=layer.scale,
+            translate=layer.translate
+        )
+
+
+    def _dedup_toggled(self, checked):
+        self._sbox_quantum.setEnabled(checked)
+
+
+    def _lazy_toggled(self, checked):
+        self._sbox_cache.setEnabled(checked)
+        self._cbox_preview.setDisabled(checked)
+        self._cbox_summaries.setDisabled(checked)
+        self._cbox_profile.setDisabled(checked)
+        self._cbox_output.setDisabled(checked)
+        self._cbox_dtype.setDisabled(checked)
+
+
+    def _cache_size_changed(self, value):
+        self._plane_cache.resize(value * 1024**2)
+
+
     def _unmix(self):
+        """Unmixes the active layer lazily or in a background thread"""
         layer = self.viewer.layers.selection.active
-        cidx = layer.metadata['rainbow']['axes']['c']['index']
-        M = layer.metadata['rainbow']['axes']['c']['extent']
-        N = len(self._endmembers)
+        axes = _metadata.init_metadata(layer, self.viewer.dims.ndisplay)['axes']
+
+        # get A and the solver for the current endmembers, both reused across runs
+        A = self._endmember_matrix(layer)
+        solver = _solvers.make_solver(self._cbox_solver.currentText(), A)
+        # unmix the full resolution level of pyramids opened by the reader
+        data = layer.data[0] if layer.multiscale else layer.data
+        if isinstance(data, _compress.CompressedCube):
+            # solve on the low-rank coefficients without reconstructing spectra
+            solver = _solvers.ReducedSolver(solver, data.basis)
+            data = data.coefficients
+        if self._cbox_dedup.isChecked():
+            # solve each distinct (quantized) spectrum once per run
+            solver = _solvers.DedupSolver(solver, quantum=self._sbox_quantum.value() or None)
+
+        if self._cbox_lazy.isChecked():
+            self._unmix_lazily(layer, data, axes, solver)
+        else:
+            if self._cbox_profile.isChecked():
+                # record stage timings and allocations until the run finishes
+                self._profiler = _profiling.Profiler(trace_memory=True)
+                self._profiler.start()
+            self._unmix_in_background(layer, data, axes, solver, A)
+            if self._worker is None:
+                self._stop_profiler()
+
+
+    def _add_abundance_layers(self, layer, abundances, channel_axis, contrast_limits):
+        """Adds one layer per endmember aligned with the spectral layer"""
+        layers = []
+        with _profiling.stage('unmix.layers'):
+            for i, (endmember, abundance) in enumerate(zip(self._endmembers, abundances)):
+                layers.append(self.viewer.add_image(
+                    abundance,
+                    name=endmember.name,
+                    colormap=ABUNDANCE_COLORMAPS[i % len(ABUNDANCE_COLORMAPS)],
+                    blending='additive',
+                    contrast_limits=contrast_limits[i],
+                    scale=np.delete(layer.scale, channel_axis),
+                    translate=np.delete(layer.translate, channel_axis)
+                ))
+        return layers
+
+
+    def _unmix_lazily(self, layer, data, axes, solver):
+        """Adds abundance layers that unmix only the planes being displayed"""
+        cidx = axes['c']['index']
+        # planes span the axes in view, whatever the metadata calls them
+        plane_axes = [a for a in layer._dims_displayed if a != cidx]
+        unmixer = _lazy.LazyUnmixer(data, solver, cidx, plane_axes, self._plane_cache)
+
+        # unmix the plane in view to set contrast limits without touching other planes
+        point = np.round(layer.world_to_data(self.viewer.dims.point)).astype(int)
+        point = np.clip(point, 0, np.array(data.shape) - 1)
+        X = unmixer.plane([point[a] for a in unmixer.slice_axes])
+        limits = [(0, m if m > 0 else 1) for m in X.reshape(X.shape[0], -1).max(axis=1)]
+
+        abundances = [unmixer.abundance(i) for i in range(solver.nendmembers)]
+        self._add_abundance_layers(layer, abundances, cidx, limits)
+
+
+    def _unmix_in_background(self, layer, data, axes, solver, A):
+        """Starts unmixing the active layer in a background thread"""
+        cidx = axes['c']['index']
+        N = solver.nendmembers
+
+        # in preview mode, smaller tiles are handed out starting from the visible region
+        preview = self._cbox_preview.isChecked()
+        if preview:
+            tile_shape = _pipeline.default_tile_shape(data, cidx, PREVIEW_TILE_SIZE)
+        else:
+            tile_shape = _pipeline.default_tile_shape(data, cidx)
+
+        # allocate X in memory (on disk for lazy inputs) or in a file written as tiles finish
+        shape = _pipeline.output_shape(data.shape, cidx, N)
+        dtype = np.dtype(self._cbox_dtype.currentText())
+        if OUTPUTS[self._cbox_output.currentText()] is None:
+            X = _pipeline.allocate_output(shape, dtype, on_disk=not isinstance(data, np.ndarray))
+        else:
+            X = self._create_output_file(layer, data, shape, tile_shape, cidx, dtype, A)
+            if X is None:
+                return
+
+        tiles = _pipeline.TileScheduler(
+            _pipeline.iter_tiles(data.shape, tile_shape, cidx),
+            data.shape,
+            cidx
+        )
+
+        # add one layer per endmember backed by a view of X, so layers fill in as tiles finish
+        views = []
+        for i in range(N):
+            if isinstance(X, np.ndarray):
+                index = [slice(None)] * X.ndim
+                index[cidx] = i
+                views.append(X[tuple(index)])
+            else:
+                # slicing a zarr array would read it
+                views.append(_lazy.AxisView(X, cidx, i))
+        layers = self._add_abundance_layers(layer, views, cidx, [(0, 1)] * N)
+        maxima = [0] * N
+
+        # summary images come from the same tiles, see _pipeline.summarize_block
+        summaries = None
+        wavelengths = layer.metadata['rainbow']['wavelengths']
+        if self._cbox_summaries.isChecked():
+            summaries = _pipeline.allocate_summaries(
+                data.shape, cidx,
+                on_disk=not isinstance(data, np.ndarray)
+            )
+            for name, summary in summaries.items():
+                limits = (min(wavelengths), max(wavelengths)) if name == 'lambda max' else (0, 1)
+                layers.append(self.viewer.add_image(
+                    summary,
+                    name='%s %s' % (layer.name, name),
+                    colormap='turbo' if name == 'lambda max' else 'gray',
+                    contrast_limits=limits,
+                    visible=False,
+                    scale=np.delete(layer.scale, cidx),
+                    translate=np.delete(layer.translate, cidx)
+                ))
+                maxima.append(limits[1])
+
+        self._run = {
+            'X': X,
+            'source': layer,
+            'tiles': tiles,
+            'channel_axis': cidx,
+            'layers': layers,
+            'summaries': summaries or {},
+            'max': np.array(maxima, dtype=np.float64),
+            'refreshed': -np.inf,
+            'cancel': threading.Event()
+        }
+
+        # follow the viewer while tiles are pending
+        if preview:
+            self._viewport_changed()
+            self.viewer.camera.events.center.connect(self._viewport_changed)
+            self.viewer.camera.events.zoom.connect(self._viewport_changed)
+            self.viewer.dims.events.current_step.connect(self._viewport_changed)
+
+        # start the worker
+        self._progress.setRange(0, len(tiles))
+        self._progress.setValue(0)
+        self._worker = _unmix_tiles(
+            data, solver, X, cidx, tiles,
+            self._sbox_workers.value(),
+            self._run['cancel'],
+            summaries,
+            wavelengths
+        )
+        self._worker.yielded.connect(self._tile_unmixed)
+        self._worker.finished.connect(self._unmix_finished)
+        self._button_cancel.setEnabled(True)
+        self._set_unmix_button()
+        self._worker.start()
+
+
+    def _create_output_file(self, layer, data, shape, tile_shape, channel_axis, dtype, A):
+        """Asks for a file name and creates the chosen OME-Zarr or memmap output, or returns None"""
+        output = self._cbox_output.currentText()
+        extension = OUTPUTS[output]
+        fname, ftype = QFileDialog.getSaveFileName(self,
+            caption='Save abundances',
+            directory=layer.name + extension,
+            filter='%s (*%s)' % (output, extension)
+        )
+        if not fname:
+            return None
+        if not fname.lower().endswith(extension):
+            fname += extension
+
+        # endmember names and spectra are stored alongside the abundances
+        names = [endmember.name for endmember in self._endmembers]
+        wavelengths = layer.metadata['rainbow']['wavelengths']
+        if extension == '.zarr':
+            # one chunk per tile, so tiles are written independently
+            chunks = _pipeline.output_shape(
+                [min(t, n) for t, n in zip(tile_shape, data.shape)],
+                channel_axis, len(names)
+            )
+            return _writer.create_zarr(fname, shape, chunks, channel_axis, names, wavelengths, A, dtype)
+        return _writer.create_memmap(fname, shape, names, wavelengths, A, dtype)
+
+
+    def _viewport_changed(self):
+        """Reprioritizes pending tiles around the region and slice in view"""
+        run = self._run
+        layer = run['source']
+        if layer not in self.viewer.layers:
+            return
+
+        # visible extent of displayed axes, current slice of the others
+        point = np.round(layer.world_to_data(self.viewer.dims.point)).astype(int)
+        corners = layer.corner_pixels
+        displayed = list(layer._dims_displayed)
+        region = []
+        slice_axes = []
+        for a in range(layer.ndim):
+            if a in displayed:
+                region.append((corners[0, a], corners[1, a] + 1))
+            else:
+                region.append((point[a], point[a] + 1))
+                if a != run['channel_axis']:
+                    slice_axes.append(a)
+
+        run['tiles'].focus(region, slice_axes)
+
+
+    def _disconnect_viewport(self):
+        for emitter in (self.viewer.camera.events.center,
+                        self.viewer.camera.events.zoom,
+                        self.viewer.dims.events.current_step):
+            emitter.disconnect(self._viewport_changed)
+
 
-        # construct A and B
-        A = np.vstack([e.data for e in self._endmembers]).T
-        B = layer.data
+    def _tile_unmixed(self, result):
+        """Updates progress and partially unmixed layers as tiles finish"""
+        run = self._run
+        self._progress.setValue(self._progress.value() + 1)
 
-        # apply NNLS along spectral dimension
-        nnlsA = lambda b: nnls(A, b)[0]
-        X = np.apply_along_axis(nnlsA, cidx, B)
+        # grow the contrast limits with the brightest abundance seen so far, as
+        # computed by the worker so tiles are not read back from the output
+        index, maxima = result
+        run['max'] = np.maximum(run['max'], maxima)
 
-        # display X in new viewer
-        view_image(X, channel_axis=cidx, name=[e.name for e in self._endmembers])
+        now = time.monotonic()
+        if now - run['refreshed'] > REFRESH_INTERVAL:
+            self._refresh_abundances()
+            run['refreshed'] = now
+
+
+    def _refresh_abundances(self):
+        """Redraws the abundance layers of the current run"""
+        run = self._run
+        for layer, m in zip(run['layers'], run['max']):
+            if layer not in self.viewer.layers:
+                continue
+            if m > layer.contrast_limits[1]:
+                layer.contrast_limits_range = (0, m)
+                layer.contrast_limits = (0, m)
+            layer.refresh()
+
+
+    def _cancel_unmix(self):
+        """Stops unmixing after the tiles in progress, keeping finished tiles"""
+        if self._worker is not None:
+            self._run['cancel'].set()
+            self._button_cancel.setDisabled(True)
+
+
+    def _unmix_finished(self):
+        self._disconnect_viewport()
+        self._refresh_abundances()
+        self._stop_profiler()
+        self._worker = None
+        self._button_cancel.setDisabled(True)
+        self._set_unmix_button()
+
+
+    def _stop_profiler(self):
+        """Stops profiling the run and logs where its time and memory went"""
+        if self._profiler is None or self._profiler.stopped is not None:
+            return
+        self._profiler.stop()
+        report = _profiling.format_report(self._profiler.report())
+        logger.info('unmixing profile\n%s', report)
+        self._button_profile.setToolTip(report)
+        self._button_profile.setEnabled(True)
+
+
+    def _save_profile(self):
+        """Saves the profile of the last profiled run as JSON"""
+        fname, ftype = QFileDialog.getSaveFileName(self,
+            caption='Save profile',
+            filter='JSON files (*.json)'
+        )
+        if not fname:
+            return
+        self._profiler.dump(fname)
 
 
     def _theme_changed(self):
@@ -1,20 +1,60 @@
 import numpy as np
 
+# number of values read when estimating statistics from a strided sample
+SAMPLE_SIZE = 2**20
+
 def effective_bit_depth(img):
-    return np.ceil(np.log2(np.max(img)))
-
-def safe_normalize_max(array):
-    m = np.max(array)
-    if m:
-        return np.divide(array, np.max(array))
-    else:
-        return np.full_like(array, np.NaN)
-        
-
-def safe_normalize_sum(array):
-    s = np.sum(array)
-    if s:
-        return np.divide(array, np.sum(array))
-    else:
-        return np.full_like(array, np.NaN)
-    
\ No newline at end of file
+    return np.ceil(np.log2(float(np.max(img))))
+
+def bit_depth_of(value):
+    """Bit depth needed to represent a maximum value"""
+    return np.ceil(np.log2(value)) if value > 0 else 0
+
+def strided_sample(img, size=SAMPLE_SIZE, channel_axis=None):
+    """Reads a strided subsample of at most ~size values
+
+    Every channel of channel_axis is read. Of the other axes, the two
+    innermost are sampled with a stride and the rest at a few positions, so
+    only a bounded number of planes is read from lazy data.
+    """
+    shape = img.shape
+    ndim = len(shape)
+    channel_axis = None if channel_axis is None else channel_axis % ndim
+    spatial = [a for a in range(ndim) if a != channel_axis][-2:]
+    index = [slice(None)] * ndim
+    for a in range(ndim):
+        if a != channel_axis and a not in spatial:
+            index[a] = slice(None, None, max(1, -(-shape[a] // 2)))
+    nleading = np.prod([len(range(*index[a].indices(shape[a]))) for a in range(ndim) if a not in spatial],
+                       dtype=int)
+    step = max(1, int(np.ceil(np.sqrt(nleading * np.prod([shape[a] for a in spatial]) / size))))
+    for a in spatial:
+        index[a] = slice(None, None, step)
+    return np.asarray(img[tuple(index)])
+
+def estimate_bit_depth(img, contrast_limits_range=None, channel_axis=None):
+    """Estimates the effective bit depth without reading the whole image
+
+    Uses the dtype for 8-bit images, then existing contrast limits, then a
+    strided sample of every channel. Returns the bit depth and whether it
+    came from the sample, in which case an exact pass may refine it.
+    """
+    dtype = np.dtype(img.dtype)
+    if dtype.kind in 'ub' and dtype.itemsize == 1:
+        return 8.0, False
+    if contrast_limits_range is not None and contrast_limits_range[1] > 0:
+        return bit_depth_of(contrast_limits_range[1]), False
+    return bit_depth_of(float(np.max(strided_sample(img, channel_axis=channel_axis), initial=0))), True
+
+def safe_normalize_max(array, axis=None):
+    """Scales to a maximum of one along axis, returning NaN where the maximum is zero"""
+    m = np.max(array, axis=axis, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(m != 0, np.divide(array, m), np.nan)
+
+
+def safe_normalize_sum(array, axis=None):
+    """Scales to a sum of one along axis, returning NaN where the sum is zero"""
+    s = np.sum(array, axis=axis, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(s != 0, np.divide(array, s), np.nan)
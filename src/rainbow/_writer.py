@@ -0,0 +1,105 @@
+import json
+import numpy as np
+
+from ._pipeline import default_tile_shape, output_shape, unmix
+from ._solvers import make_solver
+
+# data types abundance maps can be stored as
+OUTPUT_DTYPES = ('float64', 'float32', 'float16')
+
+# blosc settings of zarr outputs
+COMPRESSOR = {'cname': 'zstd', 'clevel': 5}
+
+
+def create_zarr(path, shape, chunks, channel_axis, names, wavelengths=None, endmembers=None,
+                dtype=np.float32, axes=None):
+    """Creates a chunked, compressed OME-Zarr image for abundance maps
+
+    chunks should match the unmixing tiles (with the whole endmember axis), so
+    every tile is written to its own chunks and tiles can be written in
+    parallel. Endmember names become OME channel labels, and names,
+    wavelengths and endmember spectra are stored under the 'rainbow'
+    attribute. Returns the zarr array, which can be passed as out to unmix.
+    """
+    import numcodecs
+    import zarr
+
+    ndim = len(shape)
+    channel_axis = channel_axis % ndim
+    if axes is None:
+        axes = 'tzyx'[-(ndim - 1):] if ndim <= 5 else None
+        axes = axes[:channel_axis] + 'c' + axes[channel_axis:] if axes else None
+    compressor = numcodecs.Blosc(shuffle=numcodecs.Blosc.BITSHUFFLE, **COMPRESSOR)
+
+    group = zarr.open_group(str(path), mode='w', zarr_format=2) \
+        if hasattr(zarr, 'create_array') else zarr.open_group(str(path), mode='w')
+    if hasattr(group, 'create_array'):
+        array = group.create_array('0', shape=shape, chunks=chunks, dtype=dtype,
+                                   compressors=compressor, fill_value=0)
+    else:
+        array = group.create_dataset('0', shape=shape, chunks=chunks, dtype=dtype,
+                                     compressor=compressor, fill_value=0)
+
+    multiscale = {'version': '0.4', 'datasets': [{'path': '0'}]}
+    if axes:
+        types = {'t': 'time', 'c': 'channel'}
+        multiscale['axes'] = [{'name': a, 'type': types.get(a, 'space')} for a in axes.lower()]
+        multiscale['datasets'][0]['coordinateTransformations'] = [{'type': 'scale', 'scale': [1.0] * ndim}]
+    group.attrs['multiscales'] = [multiscale]
+    group.attrs['omero'] = {'channels': [{'label': str(name)} for name in names]}
+    group.attrs['rainbow'] = _endmember_metadata(names, wavelengths, endmembers)
+    return array
+
+
+def create_memmap(path, shape, names, wavelengths=None, endmembers=None, dtype=np.float32):
+    """Creates a memory-mapped .npy file for abundance maps
+
+    Names, wavelengths and endmember spectra are written next to it as JSON
+    (path + '.json'). The file-backed memmap can be passed as out to unmix,
+    including with process workers, which attach to it by file name.
+    """
+    out = np.lib.format.open_memmap(str(path), mode='w+', dtype=dtype, shape=shape)
+    with open(str(path) + '.json', 'w') as f:
+        json.dump(_endmember_metadata(names, wavelengths, endmembers), f, indent=2)
+    return out
+
+
+def write_abundances(path, data, endmembers, names=None, channel_axis=0, wavelengths=None,
+                     dtype=np.float32, tile_shape=None, workers=1, executor='thread',
+                     mode='nnls', solver=None):
+    """Unmixes data straight into an OME-Zarr store (.zarr) or a .npy memmap
+
+    Tiles are written as they are solved, in parallel with workers, so
+    neither the spectral image nor the abundance maps need to fit in memory.
+    Returns the output array.
+    """
+    if solver is None:
+        solver = make_solver(mode, endmembers)
+    if names is None:
+        names = ['endmember %d' % (i + 1) for i in range(solver.nendmembers)]
+    if tile_shape is None:
+        tile_shape = default_tile_shape(data, channel_axis)
+    shape = output_shape(data.shape, channel_axis, solver.nendmembers)
+
+    if str(path).rstrip('/\\').lower().endswith('.zarr'):
+        chunks = output_shape([min(t, n) for t, n in zip(tile_shape, shape)], channel_axis,
+                              solver.nendmembers)
+        out = create_zarr(path, shape, chunks, channel_axis, names, wavelengths, endmembers, dtype)
+    else:
+        out = create_memmap(path, shape, names, wavelengths, endmembers, dtype)
+
+    unmix(data, endmembers, channel_axis, solver=solver, tile_shape=tile_shape, out=out,
+          workers=workers, executor=executor)
+    if isinstance(out, np.memmap):
+        out.flush()
+    return out
+
+
+def _endmember_metadata(names, wavelengths, endmembers):
+    """Describes the endmembers behind abundance maps as JSON-compatible values"""
+    metadata = {'endmembers': [str(name) for name in names]}
+    if wavelengths is not None:
+        metadata['wavelengths'] = [float(w) for w in wavelengths]
+    if endmembers is not None:
+        metadata['spectra'] = np.asarray(endmembers, dtype=np.float64).T.tolist()
+    return metadata
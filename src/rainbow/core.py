@@ -0,0 +1,86 @@
+"""Numerical core of rainbow, importable without napari, Qt or matplotlib
+
+Spectra, unmixing, endmember extraction, region statistics, phasors and
+readers/writers for headless scripts and cluster jobs. Optional
+dependencies (dask, tifffile, zarr) are imported only by the functions
+that need them.
+"""
+from ._compress import CompressedCube, compress, spectral_basis
+from ._extract import extract_endmembers, sample_pixels
+from ._lazy import LazyUnmixer, PlaneCache
+from ._phasor import PhasorHistogram, phasor_coordinates
+from ._pipeline import (
+    allocate_output,
+    default_tile_shape,
+    iter_tiles,
+    iter_unmix,
+    output_shape,
+    unmix,
+    unmix_lazy
+)
+from ._reader import read_tiff, read_zarr
+from ._roi import region_spectra, write_region_table
+from ._solvers import (
+    SOLVERS,
+    DedupSolver,
+    FCLSSolver,
+    LeastSquaresSolver,
+    NNLSSolver,
+    ReducedSolver,
+    WarmNNLSSolver,
+    make_solver
+)
+from ._spectrum import (
+    Spectrum,
+    SpectrumStore,
+    endmember_matrix,
+    interp_spectra,
+    read_endmembers,
+    read_spectra,
+    write_spectra
+)
+from ._utils import safe_normalize_max, safe_normalize_sum
+from ._writer import create_memmap, create_zarr, write_abundances
+
+__all__ = (
+    "CompressedCube",
+    "DedupSolver",
+    "FCLSSolver",
+    "LazyUnmixer",
+    "LeastSquaresSolver",
+    "NNLSSolver",
+    "PhasorHistogram",
+    "PlaneCache",
+    "ReducedSolver",
+    "SOLVERS",
+    "Spectrum",
+    "SpectrumStore",
+    "WarmNNLSSolver",
+    "allocate_output",
+    "compress",
+    "create_memmap",
+    "create_zarr",
+    "default_tile_shape",
+    "endmember_matrix",
+    "extract_endmembers",
+    "interp_spectra",
+    "iter_tiles",
+    "iter_unmix",
+    "make_solver",
+    "output_shape",
+    "phasor_coordinates",
+    "read_endmembers",
+    "read_spectra",
+    "read_tiff",
+    "read_zarr",
+    "region_spectra",
+    "safe_normalize_max",
+    "safe_normalize_sum",
+    "sample_pixels",
+    "spectral_basis",
+    "unmix",
+    "unmix_lazy",
+    "write_abundances",
+    "write_region_table",
+    "write_spectra",
+)
@@ -0,0 +1,13 @@
+from benchmarks.import_time import BUDGET, FORBIDDEN, import_times
+
+
+def test_core_imports_no_gui_packages():
+    times = import_times('rainbow.core')
+    forbidden = sorted(n for n in times if n.split('.')[0] in FORBIDDEN)
+    assert not forbidden
+
+
+def test_core_import_time():
+    # the fastest of a few runs is the least disturbed by disk caches and other processes
+    total = min(import_times('rainbow.core')['rainbow.core'][1] for _ in range(5))
+    assert total < BUDGET
@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+
+from rainbow import _pipeline
+
+
+def _image(shape=(2, 48, 40), nchannels=12, nendmembers=3, seed=0):
+    """Returns endmembers and a (channels,) + shape image mixed from them"""
+    rng = np.random.default_rng(seed)
+    A = rng.random((nchannels, nendmembers))
+    X = rng.random((nendmembers,) + shape)
+    return A, np.tensordot(A, X, axes=1)
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_negative_channel_axis_with_summaries(workers):
+    A, B = _image()
+    summaries = _pipeline.allocate_summaries(B.shape, 0)
+    X = _pipeline.unmix(B, A, tile_shape=(12, 1, 16, 16), summaries=summaries)
+
+    B_last = np.moveaxis(B, 0, -1)
+    summaries_last = _pipeline.allocate_summaries(B_last.shape, -1)
+    X_last = _pipeline.unmix(B_last, A, channel_axis=-1, tile_shape=(1, 16, 16, 12),
+                             summaries=summaries_last, workers=workers)
+
+    np.testing.assert_allclose(np.moveaxis(X_last, -1, 0), X)
+    for name, summary in summaries.items():
+        np.testing.assert_allclose(summaries_last[name], summary)
+
+
+@pytest.mark.parametrize('channel_axis, tile_shape', [(0, (12, 1, 16, 16)), (-1, (1, 16, 16, 12))])
+def test_tile_maxima(channel_axis, tile_shape):
+    A, B = _image()
+    B = np.moveaxis(B, 0, channel_axis)
+    summaries = _pipeline.allocate_summaries(B.shape, channel_axis)
+    out = _pipeline.allocate_output(_pipeline.output_shape(B.shape, channel_axis, A.shape[1]))
+    tiles = _pipeline.iter_tiles(B.shape, tile_shape, channel_axis)
+    solver = _pipeline.make_solver('nnls', A)
+    for index, maxima in _pipeline.iter_unmix(B, solver, out, channel_axis, tiles,
+                                              summaries=summaries, maxima=True):
+        tile = np.moveaxis(out[index], channel_axis, 0)
+        spatial_index = tuple(s for a, s in enumerate(index) if a != channel_axis % B.ndim)
+        expected = [t.max() for t in tile] + [s[spatial_index].max() for s in summaries.values()]
+        np.testing.assert_allclose(maxima, expected)
@@ -0,0 +1,19 @@
+import pytest
+
+from rainbow import _reader, _writer
+
+pytest.importorskip('zarr')
+
+
+@pytest.mark.parametrize('axes', ['cyx', 'lyx', 'qyx'])
+def test_zarr_wavelengths_on_any_spectral_axis(tmp_path, axes):
+    wavelengths = [450, 500, 550, 600]
+    path = str(tmp_path / 'cube.zarr')
+    _writer.create_zarr(path, (4, 8, 8), (4, 8, 8), 0, ['%g nm' % w for w in wavelengths],
+                        axes=axes)
+
+    _, kwargs, _ = _reader.read_zarr(path)[0]
+    rainbow = kwargs['metadata']['rainbow']
+    assert rainbow['axes']['c'] == {'index': 0, 'extent': 4}
+    assert rainbow['wavelengths'] == wavelengths
+    assert rainbow['units'] == 'nm'
@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+from scipy.optimize import nnls
+
+from rainbow import _solvers
+
+# tolerance documented by NNLSSolver, relative to the largest abundance of each pixel
+RTOL = 1e-8
+
+
+def _problem(nchannels=32, nendmembers=8, npixels=2000, seed=0):
+    """Returns well-conditioned endmembers and sparse nonnegative mixtures with noise"""
+    rng = np.random.default_rng(seed)
+    A = rng.random((nchannels, nendmembers)) + 0.1 * np.eye(nchannels, nendmembers)
+    X = rng.random((nendmembers, npixels)) * (rng.random((nendmembers, npixels)) < 0.4)
+    B = A @ X + rng.normal(0, 0.05, (nchannels, npixels))
+    assert np.linalg.cond(A) < 1e4
+    return A, B
+
+
+def _reference(A, B):
+    return np.stack([nnls(A, b)[0] for b in B.T], axis=1)
+
+
+def _assert_matches(X, reference):
+    scale = np.where(reference.max(axis=0) > 0, reference.max(axis=0), 1)
+    assert np.all(np.abs(X - reference) <= RTOL * scale)
+
+
+@pytest.mark.parametrize('nendmembers', [4, 8, 16])
+def test_nnls_matches_scipy(nendmembers):
+    A, B = _problem(nendmembers=nendmembers)
+    _assert_matches(_solvers.NNLSSolver(A).solve(B), _reference(A, B))
+
+
+@pytest.mark.parametrize('stride', [1, 4, 8])
+def test_warm_nnls_matches_scipy(stride):
+    A, B = _problem(nendmembers=12)
+    _assert_matches(_solvers.WarmNNLSSolver(A, stride=stride).solve(B), _reference(A, B))
+
+
+def test_dedup_matches_scipy():
+    A, B = _problem(npixels=500)
+    # repeat spectra within and across blocks
+    B = np.round(B, 1)
+    B = np.concatenate([B, B[:, ::-1], B[:, :100]], axis=1)
+    solver = _solvers.DedupSolver(_solvers.NNLSSolver(A))
+    X = np.concatenate([solver.solve(B[:, :700]), solver.solve(B[:, 700:])], axis=1)
+    _assert_matches(X, _reference(A, B))
+    assert solver.hits > 0
+
+
+def test_nnls_warns_without_convergence():
+    A, B = _problem(nendmembers=16, npixels=200)
+    with pytest.warns(RuntimeWarning, match='did not converge'):
+        _solvers.NNLSSolver(A, max_iter=1).solve(B)
+
+
+def test_factor_cache_is_bounded(monkeypatch):
+    monkeypatch.setattr(_solvers, 'FACTOR_CACHE_BYTES', 4096)
+    A, B = _problem(nendmembers=16, npixels=300)
+    solver = _solvers.NNLSSolver(A)
+    solver._group_limit = np.inf
+    solver.solve(B)
+    assert 0 < solver._factor_bytes <= 4096
+    assert solver._factor_bytes == sum(inv.nbytes for inv in solver._factor_cache.values())
+
+
+def test_dedup_cache_is_bounded():
+    A, B = _problem(npixels=4000)
+    # few distinct spectra per block, many across blocks
+    B = np.repeat(np.round(B, 1), 4, axis=1)
+    solver = _solvers.DedupSolver(_solvers.NNLSSolver(A), max_bytes=20000)
+    X = np.concatenate([solver.solve(B[:, i:i + 800]) for i in range(0, B.shape[1], 800)], axis=1)
+    _assert_matches(X[:, ::4], _reference(A, B[:, ::4]))
+    assert 0 < solver.nbytes <= 20000